@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# The benchmarks save synthetic model versions, they never use the real
+# behavior directory
+os.environ.setdefault('PSY_BEHAVIOR_DIR', os.path.join(tempfile.gettempdir(),
+    'licking_behavior_NP_benchmarks'))
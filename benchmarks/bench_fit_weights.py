@@ -0,0 +1,80 @@
+import copy
+import numpy as np
+
+import licking_behavior_NP.psy_tools as ps
+from .common import build_session_data, FORMAT_OPTIONS
+
+STRATEGIES = ['bias','task0','timing1D','omissions','omissions1']
+
+
+class FitWeights:
+    '''
+        Fits the full model with each fitting backend, on sessions of 
+        increasing length to show how each backend scales
+    '''
+    params = [['psytrack','banded'], [2400, 4800, 19200]]
+    param_names = ['backend','num_images']
+    timeout = 600
+
+    def setup(self, backend, num_images):
+        session = build_session_data(num_images)
+        self.psydata = ps.format_session(session, copy.copy(FORMAT_OPTIONS))
+
+    def time_fit_weights(self, backend, num_images):
+        ps.fit_weights(self.psydata, STRATEGIES, backend=backend)
+
+    def peakmem_fit_weights(self, backend, num_images):
+        ps.fit_weights(self.psydata, STRATEGIES, backend=backend)
+
+
+class CrossValidation:
+    '''
+        Fits each cross validation fold, starting from fixed hyperparameters
+    '''
+    params = [['psytrack','banded'], [2400, 4800]]
+    param_names = ['backend','num_images']
+    timeout = 1200
+
+    def setup(self, backend, num_images):
+        import psytrack as psy
+        session = build_session_data(num_images)
+        psydata = ps.format_session(session, copy.copy(FORMAT_OPTIONS))
+        folds = FORMAT_OPTIONS['num_cv_folds']
+        self.psydata = psy.trim(psydata, 
+            END=int(np.floor(len(psydata['y'])/folds)*folds))
+        self.weights = dict((strategy, 1) for strategy in STRATEGIES)
+        self.hyp = {'sigInit':2**4., 'sigma':[2**-4.]*len(STRATEGIES),
+            'sigDay':2**4}
+
+    def time_compute_cross_validation(self, backend, num_images):
+        ps.compute_cross_validation(self.psydata, self.hyp, self.weights,
+            folds=FORMAT_OPTIONS['num_cv_folds'], backend=backend)
+
+    def peakmem_compute_cross_validation(self, backend, num_images):
+        ps.compute_cross_validation(self.psydata, self.hyp, self.weights,
+            folds=FORMAT_OPTIONS['num_cv_folds'], backend=backend)
+
+
+class MatchPsytrack:
+    '''
+        Checks the banded backend against psy.hyperOpt on several sessions.
+        Setup fails if the banded evidence is lower than psytrack's, see
+        psy_banded_tools.compare_to_psytrack
+    '''
+    params = [[0, 1, 2, 3, 4]]
+    param_names = ['seed']
+    timeout = 600
+
+    def setup(self, seed):
+        import licking_behavior_NP.psy_banded_tools as pbt
+        session = build_session_data(1500, seed=seed)
+        psydata = ps.format_session(session, copy.copy(FORMAT_OPTIONS))
+        weights = dict((strategy, 1) for strategy in STRATEGIES)
+        hyper = {'sigInit':2**4., 'sigma':[2**-4.]*len(STRATEGIES),
+            'sigDay':2**4}
+        self.comparison = pbt.compare_to_psytrack(psydata, hyper, weights,
+            ['sigma'])
+
+    def track_evidence_difference(self, seed):
+        return self.comparison['banded_evidence'] - \
+            self.comparison['psytrack_evidence']
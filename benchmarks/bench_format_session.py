@@ -0,0 +1,33 @@
+import copy
+import numpy as np
+
+import licking_behavior_NP.psy_tools as ps
+from .common import build_session_data, FORMAT_OPTIONS
+
+
+class FormatSession:
+    '''
+        Formats a typical session (4800 images), and a long synthetic session
+    '''
+    params = [4800, 100000]
+    param_names = ['num_images']
+
+    def setup(self, num_images):
+        self.session = build_session_data(num_images)
+
+    def time_format_session(self, num_images):
+        ps.format_session(self.session, copy.copy(FORMAT_OPTIONS))
+
+    def peakmem_format_session(self, num_images):
+        ps.format_session(self.session, copy.copy(FORMAT_OPTIONS))
+
+
+class TimingSigmoid:
+    params = [4800, 100000]
+    param_names = ['num_images']
+
+    def setup(self, num_images):
+        self.x = np.arange(num_images) % 20
+
+    def time_timing_sigmoid(self, num_images):
+        ps.timing_sigmoid(self.x, FORMAT_OPTIONS['timing_params'])
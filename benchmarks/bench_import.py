@@ -0,0 +1,91 @@
+import sys
+import subprocess
+
+'''
+Import time of the modules that cluster jobs and summary scripts import.
+
+Each import is measured in a fresh interpreter with python -X importtime. The
+heavy dependencies (AllenSDK, psytrack, and the plotting stacks) are imported
+by the functions that use them, so importing these modules should not import
+any of them. Run this file directly to check the import time of each module
+against the budget:
+
+> python -m benchmarks.bench_import
+'''
+
+MODULES = [
+    'licking_behavior_NP.psy_general_tools',
+    'licking_behavior_NP.psy_tools',
+    'licking_behavior_NP.psy_output_tools',
+    'licking_behavior_NP.psy_training_tools',
+    ]
+
+HEAVY_MODULES = ['allensdk','psytrack','matplotlib','seaborn','sklearn']
+
+# Seconds, the cumulative import time of each module
+IMPORT_TIME_BUDGET = 1.0
+
+
+def get_import_time(module, repeats=3):
+    '''
+        Returns the cumulative import time of module in seconds, the fastest
+        of repeats imports, each in a new interpreter
+    '''
+    times = []
+    for i in range(repeats):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+            'import '+module], capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            parts = [x.strip() for x in line.split('|')]
+            if (len(parts) == 3) and (parts[2] == module):
+                times.append(int(parts[1])*1e-6)
+    return min(times)
+
+
+def get_heavy_imports(module):
+    '''
+        Returns the heavy dependencies that are imported by importing module
+    '''
+    code = 'import sys; import {}; print(" ".join(sys.modules))'.format(module)
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True,
+        text=True, check=True)
+    imported = set(x.split('.')[0] for x in result.stdout.split())
+    return [x for x in HEAVY_MODULES if x in imported]
+
+
+class ImportTime:
+    '''
+        Cumulative import time of each module, in a new interpreter
+    '''
+    params = MODULES
+    param_names = ['module']
+    unit = 'seconds'
+    number = 1
+    repeat = 1
+    timeout = 120
+
+    def track_import_time(self, module):
+        return get_import_time(module)
+
+
+def check_import_budget(budget=IMPORT_TIME_BUDGET):
+    '''
+        Prints the import time of each module, and raises an exception if
+        any module is over budget or imports a heavy dependency
+    '''
+    failed = []
+    for module in MODULES:
+        import_time = get_import_time(module)
+        heavy = get_heavy_imports(module)
+        print('{:45s} {:6.3f} s {}'.format(module, import_time,
+            ', '.join(heavy)))
+        if (import_time > budget) or (len(heavy) > 0):
+            failed.append(module)
+    if len(failed) > 0:
+        raise Exception('Over the import budget of {} s, or importing heavy '\
+            'dependencies: {}'.format(budget, ', '.join(failed)))
+    print('All modules within the import budget of {} s'.format(budget))
+
+
+if __name__ == '__main__':
+    check_import_budget()
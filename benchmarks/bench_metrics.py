@@ -0,0 +1,109 @@
+import numpy as np
+
+import licking_behavior_NP.psy_general_tools as pgt
+import licking_behavior_NP.psy_metrics_tools as pm
+from .common import build_session_data
+
+
+class AnnotateBouts:
+    '''
+        Assigns licking bouts to images, a typical session has about 1000 bouts
+    '''
+    params = [4800, 20000]
+    param_names = ['num_images']
+
+    def setup(self, num_images):
+        self.session = build_session_data(num_images, annotate=False)
+        pm.annotate_licks(self.session)
+
+    def time_annotate_bouts(self, num_images):
+        pm.annotate_bouts(self.session)
+
+    def peakmem_annotate_bouts(self, num_images):
+        pm.annotate_bouts(self.session)
+
+
+class AnnotateLicks:
+    '''
+        Segments licks into bouts and assigns rewards to licks
+    '''
+    params = [4800, 20000]
+    param_names = ['num_images']
+
+    def setup(self, num_images):
+        self.session = build_session_data(num_images, annotate=False)
+
+    def time_annotate_licks(self, num_images):
+        pm.annotate_licks(self.session)
+
+    def peakmem_annotate_licks(self, num_images):
+        pm.annotate_licks(self.session)
+
+
+class AnnotateImageRollingMetrics:
+    '''
+        Computes the rolling rate metrics on each image
+    '''
+    params = [4800, 20000]
+    param_names = ['num_images']
+
+    def setup(self, num_images):
+        self.session = build_session_data(num_images, annotate=False)
+        pm.annotate_licks(self.session)
+        pm.annotate_bouts(self.session)
+
+    def time_annotate_image_rolling_metrics(self, num_images):
+        pm.annotate_image_rolling_metrics(self.session)
+
+    def peakmem_annotate_image_rolling_metrics(self, num_images):
+        pm.annotate_image_rolling_metrics(self.session)
+
+
+class AddLicksEachFlash:
+    '''
+        Finds the licks during each image
+    '''
+    params = [4800, 20000]
+    param_names = ['num_images']
+
+    def setup(self, num_images):
+        session = build_session_data(num_images, annotate=False)
+        self.stimulus = session.stimulus_presentations_np
+        self.licks = session.licks
+
+    def time_add_licks_each_flash_inner(self, num_images):
+        pgt.add_licks_each_flash_inner(self.stimulus, self.licks)
+
+    def peakmem_add_licks_each_flash_inner(self, num_images):
+        pgt.add_licks_each_flash_inner(self.stimulus, self.licks)
+
+
+class RollingMean:
+    '''
+        Smooths indicators with a few valid images (sparse), or with every 
+        image valid (dense). Setup fails if rolling_mean does not match 
+        pandas within 1e-12, or a rate of a 0/1 indicator is above 1
+    '''
+    params = [['sparse','dense'], [4800, 20000]]
+    param_names = ['density','num_images']
+
+    def setup(self, density, num_images):
+        import pandas as pd
+        rng = np.random.default_rng(7)
+        fractions = [0.002, 0.01, 0.05] if density == 'sparse' else [1]
+        self.values = np.column_stack([np.where(
+            rng.random(num_images) < fraction, 
+            rng.random(num_images) < 0.5, np.nan) for fraction in fractions])
+        mean = pm.rolling_mean(self.values, 640, win_std=60)
+        for dex in range(self.values.shape[1]):
+            expected = pd.Series(self.values[:,dex]).rolling(640, 
+                min_periods=1, win_type='gaussian', center=True)\
+                .mean(std=60).values
+            if not np.allclose(mean[:,dex], expected, rtol=0, atol=1e-12, 
+                equal_nan=True):
+                raise Exception('rolling_mean does not match pandas')
+        if np.nanmax(mean) > 1:
+            raise Exception('rolling_mean is above 1')
+
+    def time_rolling_mean(self, density, num_images):
+        pm.rolling_mean(self.values, 640, win_std=60)
@@ -0,0 +1,108 @@
+import licking_behavior_NP.psy_output_tools as po
+import licking_behavior_NP.psy_general_tools as pgt
+from .common import build_synthetic_version, use_synthetic_sessions
+from .common import build_synthetic_summary_table
+from .common import SUMMARY_VERSION
+
+'''
+Benchmarks of the summary tables, built from the saved outputs of synthetic
+sessions. The outputs are saved once, in setup_cache, for the largest number
+of sessions. Each benchmark uses the first num_sessions of them.
+'''
+
+NUM_SESSIONS = [50, 200]
+
+
+class SummaryTables:
+    params = NUM_SESSIONS
+    param_names = ['num_sessions']
+    timeout = 1800
+
+    def setup_cache(self):
+        build_synthetic_version(max(NUM_SESSIONS))
+
+    def setup(self, num_sessions):
+        use_synthetic_sessions(num_sessions)
+        self.summary_df = po.build_core_table(SUMMARY_VERSION)
+
+    def time_build_core_table(self, num_sessions):
+        po.build_core_table(SUMMARY_VERSION)
+
+    def peakmem_build_core_table(self, num_sessions):
+        po.build_core_table(SUMMARY_VERSION)
+
+    def time_add_time_aligned_session_info(self, num_sessions):
+        po.add_time_aligned_session_info(self.summary_df.copy(), 
+            SUMMARY_VERSION)
+
+    def peakmem_add_time_aligned_session_info(self, num_sessions):
+        po.add_time_aligned_session_info(self.summary_df.copy(), 
+            SUMMARY_VERSION)
+
+
+class EngagementMetrics:
+    '''
+        Averages of the image by image columns over engaged and disengaged
+        images, for summary tables of many sessions
+    '''
+    params = [1000, 2000]
+    param_names = ['num_sessions']
+    timeout = 600
+
+    def setup(self, num_sessions):
+        self.summary_df = build_synthetic_summary_table(num_sessions)
+
+    def time_add_engagement_metrics(self, num_sessions):
+        po.add_engagement_metrics(self.summary_df)
+
+    def peakmem_add_engagement_metrics(self, num_sessions):
+        po.add_engagement_metrics(self.summary_df)
+
+
+class BuildLicksTable:
+    '''
+        Streams the licks of each session into the partitioned licks table
+    '''
+    params = NUM_SESSIONS
+    param_names = ['num_sessions']
+    timeout = 1800
+
+    def setup_cache(self):
+        build_synthetic_version(max(NUM_SESSIONS))
+
+    def setup(self, num_sessions):
+        use_synthetic_sessions(num_sessions)
+        self.summary_df = pgt.get_np_manifest()
+        po.build_licks_table(self.summary_df, SUMMARY_VERSION, load=False)
+
+    def time_build_licks_table(self, num_sessions):
+        po.build_licks_table(self.summary_df, SUMMARY_VERSION, 
+            incremental=False, load=False)
+
+    def peakmem_build_licks_table(self, num_sessions):
+        po.build_licks_table(self.summary_df, SUMMARY_VERSION, 
+            incremental=False, load=False)
+
+    def time_get_licks_table_bout_columns(self, num_sessions):
+        po.get_licks_table(SUMMARY_VERSION, columns=po.BOUT_TABLE_COLUMNS)
+
+
+class BuildBoutTable:
+    params = NUM_SESSIONS
+    param_names = ['num_sessions']
+    timeout = 1800
+
+    def setup_cache(self):
+        build_synthetic_version(max(NUM_SESSIONS))
+
+    def setup(self, num_sessions):
+        use_synthetic_sessions(num_sessions)
+        summary_df = pgt.get_np_manifest()
+        self.licks_df, crashed = po.build_licks_table(summary_df, 
+            SUMMARY_VERSION)
+
+    def time_build_bout_table(self, num_sessions):
+        po.build_bout_table(self.licks_df)
+
+    def peakmem_build_bout_table(self, num_sessions):
+        po.build_bout_table(self.licks_df)
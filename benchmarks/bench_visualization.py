@@ -0,0 +1,27 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import licking_behavior_NP.psy_visualization as pv
+from .common import build_session_data
+
+
+class PlotSession:
+    '''
+        Plots the licks, bouts, and rewards of an annotated session
+    '''
+    params = [4800, 20000]
+    param_names = ['num_images']
+    timeout = 300
+
+    def setup(self, num_images):
+        self.session = build_session_data(num_images)
+
+    def teardown(self, num_images):
+        plt.close('all')
+
+    def time_plot_session(self, num_images):
+        pv.plot_session(self.session)
+
+    def peakmem_plot_session(self, num_images):
+        pv.plot_session(self.session)
@@ -0,0 +1,169 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+import licking_behavior_NP.psy_tools as ps
+import licking_behavior_NP.psy_metrics_tools as pm
+import licking_behavior_NP.psy_general_tools as pgt
+import licking_behavior_NP.psy_synthetic_tools as psyn
+
+'''
+Synthetic sessions for benchmarking. The sessions are built by 
+psy_synthetic_tools, and have the structure of an SDK session. 
+'''
+
+FORMAT_OPTIONS = {
+    'timing0/1':True,
+    'mean_center':True,
+    'timing_params':[-5,4],
+    'timing_params_session':[-5,4],
+    'ignore_trial_errors':False,
+    'num_cv_folds':10,
+    }
+
+# A model version with the strategies of the synthetic fits
+SUMMARY_VERSION = 100
+STRATEGIES = ['bias','omissions','omissions1','task0','timing1D']
+
+
+def build_session_data(num_images=4800, seed=0, annotate=True):
+    '''
+        Builds a synthetic session with <num_images> images, and processes it
+        the way get_data does. If annotate, adds the licking and rolling 
+        metrics annotations
+    '''
+    session = pgt.get_active_session(psyn.build_synthetic_session(num_images,
+        seed=seed))
+    if annotate:
+        pm.get_metrics(session)
+    return session
+
+
+def use_synthetic_sessions(num_sessions, num_images=4800, seed=0):
+    '''
+        Points get_cache at a synthetic cache of <num_sessions> sessions, and
+        refreshes the manifest snapshot
+    '''
+    os.environ['PSY_SYNTHETIC_CACHE'] = \
+        'num_sessions={},num_images={},seed={}'.format(num_sessions,
+        num_images, seed)
+    pgt.get_cache.cache_clear()
+    pgt.refresh_np_manifest()
+
+
+def build_synthetic_version(num_sessions, num_images=4800, seed=0, 
+    version=SUMMARY_VERSION):
+    '''
+        Saves the session metrics, strategy_df, and licks_df of each synthetic
+        session in model <version>, as if every session had been fit. The 
+        weights are random walks, and the metrics are random. Sessions that
+        were already saved are skipped, so the data is built once
+    '''
+    use_synthetic_sessions(num_sessions, num_images, seed)
+    for subdirectory in ['metrics','strategy_df','licks_df','summary']:
+        os.makedirs(pgt.get_directory(version, subdirectory=subdirectory),
+            exist_ok=True)
+    for bsid in pgt.get_np_manifest()['behavior_session_id'].values:
+        filename = pgt.get_directory(version, subdirectory='metrics')+\
+            str(bsid)+'.json'
+        if os.path.isfile(filename):
+            continue
+        session = pgt.get_data(bsid, use_cache=False)
+        pm.get_metrics(session)
+        rng = np.random.default_rng([seed, bsid])
+        fit = build_synthetic_fit(session, rng)
+        ps.build_session_strategy_df(bsid, version, fit=fit, session=session)
+        ps.build_session_licks_df(session, bsid, version)
+
+        # Saved last, marks the session as done
+        metrics = build_synthetic_metrics(fit, rng)
+        with open(filename, 'w') as json_file:
+            json.dump(metrics, json_file, indent=4)
+
+
+def build_synthetic_fit(session, rng):
+    '''
+        Returns the parts of a model fit that build_session_strategy_df uses,
+        with weights that follow random walks
+    '''
+    num_images = np.sum(~session.stimulus_presentations_np['in_lick_bout'])
+    wMode = np.cumsum(rng.normal(0, 0.05, (len(STRATEGIES), num_images)),
+        axis=1) + rng.normal(0, 1, (len(STRATEGIES), 1))
+    return {
+        'wMode':wMode,
+        'weights':dict((strategy, 1) for strategy in STRATEGIES),
+        'hyp':{'sigma':2.0**rng.uniform(-8, -2, len(STRATEGIES))},
+        }
+
+
+def build_synthetic_metrics(fit, rng):
+    '''
+        Returns random session metrics with the keys of 
+        ps.compute_session_metrics
+    '''
+    metrics = {}
+    metrics['session_roc'] = rng.uniform(0.6, 0.95)
+    metrics['visual_only_dropout_index'] = -rng.uniform(0, 30)
+    metrics['timing_only_dropout_index'] = -rng.uniform(0, 30)
+    metrics['strategy_dropout_index'] = \
+        metrics['timing_only_dropout_index'] - \
+        metrics['visual_only_dropout_index']
+    for dex, strategy in enumerate(STRATEGIES):
+        metrics['prior_'+strategy] = fit['hyp']['sigma'][dex]
+    for strategy in STRATEGIES:
+        metrics['dropout_cv_'+strategy] = -rng.uniform(0, 30)
+        metrics['dropout_'+strategy] = -rng.uniform(0, 30)
+    for dex, strategy in enumerate(STRATEGIES):
+        metrics['avg_weight_'+strategy] = np.mean(fit['wMode'][dex,:])
+    return dict((k, float(v)) for k,v in metrics.items())
+
+
+def build_synthetic_summary_table(num_sessions, num_images=4800, seed=0):
+    '''
+        Returns a summary_df of <num_sessions> sessions with the image by 
+        image columns that add_engagement_metrics uses. Each column is one
+        (sessions x images) matrix, and each row holds a view of its row, as
+        in a loaded summary table. Sessions have random lengths, and are 
+        padded with NaN. Some sessions are always engaged, and some are never 
+        engaged.
+    '''
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(num_images//2, num_images+1, num_sessions)
+    padding = np.arange(num_images)[np.newaxis,:] >= lengths[:,np.newaxis]
+    shape = (num_sessions, num_images)
+
+    # Engagement switches state every few hundred images
+    switches = rng.random(shape) < 1/300
+    engaged = (np.cumsum(switches, axis=1) + 
+        rng.integers(0, 2, (num_sessions, 1))) % 2
+    engaged[0:num_sessions//20] = 1
+    engaged[num_sessions//20:num_sessions//10] = 0
+
+    # Outcomes are only defined on some images
+    is_change = rng.random(shape) < 0.05
+    lick_bout_start = rng.random(shape) < 0.1
+    hit = np.where(is_change, lick_bout_start, np.nan)
+    columns = {
+        'engaged':engaged,
+        'lick_bout_rate':rng.random(shape),
+        'reward_rate':rng.random(shape),
+        'lick_hit_fraction_rate':rng.random(shape),
+        'hit':hit,
+        'miss':1-hit,
+        'image_false_alarm':np.where(is_change, np.nan, lick_bout_start),
+        'image_correct_reject':np.where(is_change, np.nan, ~lick_bout_start),
+        'RT':np.where(lick_bout_start, rng.uniform(0.15, 0.75, shape), np.nan),
+        }
+    for strategy in STRATEGIES:
+        columns['weight_'+strategy] = np.cumsum(rng.normal(0, 0.05, shape), 
+            axis=1)
+
+    summary_df = pd.DataFrame({'behavior_session_id':np.arange(num_sessions)})
+    for column in columns:
+        matrix = np.where(padding, np.nan, columns[column])
+        views = np.empty(num_sessions, dtype=object)
+        for dex in range(num_sessions):
+            views[dex] = matrix[dex]
+        summary_df[column] = views
+    return summary_df
@@ -82,12 +82,14 @@ def make_figure_1_timing_regressor():
     df = b.build_timing_regressor(version=BEHAVIOR_VERSION, savefig=SAVEFIG)
     b.plot_timing_thumbnail(savefig=SAVEFIG, version=BEHAVIOR_VERSION)
 
-    licks_df = po.get_licks_table(BEHAVIOR_VERSION)
+    licks_df = po.get_licks_table(BEHAVIOR_VERSION,
+        columns=po.BOUT_TABLE_COLUMNS)
     bouts_df = po.build_bout_table(licks_df)
     pv.plot_chronometric(bouts_df,BEHAVIOR_VERSION,savefig=SAVEFIG)
 
 def make_figure_1_timing_end_of_lick_bout():
-    licks_df = po.get_licks_table(BEHAVIOR_VERSION)
+    licks_df = po.get_licks_table(BEHAVIOR_VERSION,
+        columns=po.BOUT_TABLE_COLUMNS)
     bouts_df = po.build_bout_table(licks_df)
     pv.plot_interlick_interval(bouts_df,key='pre_ibi',version=BEHAVIOR_VERSION,
         categories='post_reward',savefig=SAVEFIG,filetype=FIGTYPE)
@@ -110,7 +112,8 @@ def make_figure_1_supplement_task():
 
 
 def make_figure_1_supplement_licking():
-    licks_df = po.get_licks_table(BEHAVIOR_VERSION)
+    licks_df = po.get_licks_table(BEHAVIOR_VERSION,
+        columns=po.BOUT_TABLE_COLUMNS)
     bouts_df = po.build_bout_table(licks_df)
     summary_df = po.get_np_summary_table(BEHAVIOR_VERSION)
     summary_df['all'] = True
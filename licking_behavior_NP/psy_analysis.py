@@ -37,14 +37,20 @@ def build_session_interval_df(esid,version):
     pm.get_metrics(session)
 
     df = session.stimulus_presentations_np
-    df['first_lick_time'] = [row.licks[0] if len(row.licks) > 0 else np.nan
-        for index, row in df.iterrows()]
-    df['last_lick_time'] = [row.licks[-1] if len(row.licks) > 0 else np.nan
-        for index, row in df.iterrows()]
+    lick_times, offsets, counts = pgt.get_image_events(session, 'licks')
+    licked = counts > 0
+    df['first_lick_time'] = np.nan
+    df.loc[licked, 'first_lick_time'] = lick_times[offsets[licked]]
+    df['last_lick_time'] = np.nan
+    df.loc[licked, 'last_lick_time'] = lick_times[offsets[licked]+counts[licked]-1]
 
     print('saving')
-    df.to_csv(pgt.get_directory(version, \
-        subdirectory='interval_df')+str(esid)+'.csv') 
+    pgt.save_session_table(df.reset_index(), esid, version, 'interval_df')
+
+# Columns of the interval_df used by compute_interval_duration
+INTERVAL_COLUMNS = ['start_time','bout_number','in_lick_bout','bout_start',
+    'bout_end','rewarded','omitted','is_change','first_lick_time',
+    'last_lick_time','time_from_last_change']
 
 def compute_interval_duration(df):
     
@@ -98,15 +104,25 @@ def compute_interval_duration(df):
     return bout_df,df
 
 
-def compile_interval_duration(summary_df,version):
-    
+def compile_interval_duration(summary_df,version,columns=None):
+    '''
+        Loads the interval_df of each session, and computes the duration of
+        the intervals between licking bouts
+
+        columns (list), the columns of each interval_df to load, in addition
+            to the columns compute_interval_duration uses. If None, loads 
+            every column
+    '''
+    if columns is not None:
+        columns = INTERVAL_COLUMNS + [x for x in columns 
+            if x not in INTERVAL_COLUMNS]
     dfs = []
     b_dfs = []
     crash = 0
     for index, row in tqdm(summary_df.iterrows(),total=summary_df.shape[0]):
         try:
-            strategy_dir = pgt.get_directory(version, subdirectory='interval_df')
-            interval_df = pd.read_csv(strategy_dir+str(row.behavior_session_id)+'.csv')
+            interval_df = pgt.load_session_table(row.behavior_session_id,
+                version, 'interval_df', columns=columns)
         except Exception as e:
             crash += 1
             print(e)
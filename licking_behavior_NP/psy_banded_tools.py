@@ -0,0 +1,503 @@
+import numpy as np
+from scipy.linalg import cholesky_banded, cho_solve_banded
+from scipy.optimize import minimize
+from scipy.sparse import diags
+from psytrack.helper.helperFunctions import myblk_diags
+
+'''
+A fitting backend for the time varying regression model that works directly
+with the banded structure of the posterior.
+
+The model has K weights that follow a random walk over N images. If the
+weights are ordered by image, then the negative Hessian of the log posterior
+is block tridiagonal, and has a lower bandwidth of K. Every step here uses
+banded Cholesky factorizations, so the time and memory of a fit are linear
+in N.
+
+hyper_opt() has the same inputs and outputs as psytrack's hyperOpt, and finds
+the hyperparameters the same way: alternating between the MAP estimate of the
+weights, and maximizing the decoupled Laplace approximation of the evidence
+over the hyperparameters. The gradient of the approximate evidence with
+respect to the smoothing priors is computed analytically from a selected
+inversion of the posterior precision, instead of numerically.
+
+Internally, arrays are (N,K), ordered by image. The outputs are reordered to
+match psytrack, which orders by weight.
+'''
+
+
+# Bounds on the log2 hyperparameters. When a weight is constant the evidence
+# keeps increasing as sigma goes to 0, and the posterior precision becomes too
+# badly conditioned to factor. 2**-16 is effectively a constant weight
+LOG2_BOUNDS = (-16, 8)
+
+
+def hyper_opt(dat, hyper, weights, optList, jump=2, hess_calc='weights',
+    maxiter=100, gtol=1e-7, evd_tol=1e-4, max_map_evaluations=50, 
+    counts=None):
+    '''
+        Optimizes the hyperparameters and weights.
+
+        dat, dictionary with the data, with keys 'y', 'inputs', and optionally
+            'missing_trials' and 'dayLength', as for psytrack
+        hyper, dictionary of initial hyperparameters, 'sigma', 'sigInit', and
+            'sigDay'
+        weights, dictionary of the number of weights for each input
+        optList, hyperparameters to optimize, 'sigma', and optionally 'sigDay'
+        jump, the number of times a worse evidence is found before stopping
+        hess_calc, if 'weights', computes the standard deviation of the weights
+        maxiter, gtol, the maximum iterations and the gradient tolerance of 
+            each hyperparameter optimization
+        evd_tol, the optimization stops once the hyperparameters stop moving
+            and the MAP evidence improves by less than evd_tol
+        max_map_evaluations, the maximum number of MAP estimates
+        counts, if not None, a dictionary that is filled with the number of
+            MAP estimates (num_map_evaluations), and evaluations of the 
+            decoupled evidence (num_evidence_evaluations)
+
+        Returns (best_hyper, best_logEvd, best_wMode, hess_info), with the same
+            format as psytrack.hyperOpt
+    '''
+    for val in optList:
+        if val not in ['sigma','sigDay']:
+            raise Exception('Can only optimize sigma and sigDay, not '+val)
+        if (val not in hyper) or (hyper[val] is None):
+            raise Exception('cannot optimize a hyperparameter not given')
+
+    g, y, missing, days = get_model_data(dat, weights)
+    N, K = g.shape
+    evaluations = {'num_map_evaluations':0,'num_evidence_evaluations':0}
+
+    current_hyper = format_hyper(hyper, K)
+    best_logEvd = None
+    current_jump = jump
+    converged = False
+    w = np.zeros((N,K))
+    while True:
+        # MAP estimate at the current hyperparameters
+        w, logEvd, llstruct = get_map(g, y, current_hyper, missing, days, w0=w)
+        evaluations['num_map_evaluations'] += 1
+
+        # Update best variables
+        if best_logEvd is None:
+            best_logEvd = logEvd
+        improvement = logEvd - best_logEvd
+        if logEvd >= best_logEvd:
+            current_jump = jump
+            best_hyper = copy_hyper(current_hyper)
+            best_logEvd = logEvd
+            best_w = w
+            best_llstruct = llstruct
+        else:
+            # If a worse logEvd found, move hypers to midpoints
+            current_jump -= 1
+            for val in optList:
+                current_hyper[val] = (current_hyper[val] + best_hyper[val])/2
+        if not current_jump:
+            break
+
+        # Stop once the hyperparameters stopped moving, and the evidence at 
+        # the new MAP is no longer improving
+        if (converged and (improvement < evd_tol)) or \
+            (evaluations['num_map_evaluations'] >= max_map_evaluations):
+            break
+
+        # Maximize the decoupled Laplace approximation of the evidence. The
+        # MAP is always re-estimated at the new hyperparameters, because 
+        # small steps in the hyperparameters can still improve the evidence
+        optVals = pack_hyper(current_hyper, optList)
+        result = minimize(decoupled_evidence, optVals, jac=True,
+            method='L-BFGS-B', options={'maxiter':maxiter,'gtol':gtol},
+            bounds=[LOG2_BOUNDS]*len(optVals),
+            args=(g, llstruct, current_hyper, optList, missing, days, 
+            evaluations))
+
+        diff = np.linalg.norm((optVals - result.x)/optVals)
+        converged = diff <= 0.1
+        current_hyper = unpack_hyper(result.x, current_hyper, optList)
+
+    # Package results in the format of psytrack
+    hess_info = {'hess':get_psytrack_hess(best_llstruct)}
+    if hess_calc in ['weights','All']:
+        Z, _ = selected_inversion(best_llstruct['chol'], K)
+        hess_info['W_std'] = np.sqrt(np.diagonal(Z, axis1=1, axis2=2)).T
+    if counts is not None:
+        counts.update(evaluations)
+    return best_hyper, best_logEvd, best_w.T, hess_info
+
+
+def compare_to_psytrack(dat, hyper, weights, optList, tol=0.01):
+    '''
+        Fits the same data with psytrack's hyperOpt and with hyper_opt, and 
+        raises an exception if the evidence of hyper_opt is lower than the 
+        evidence of psytrack by more than tol. 
+
+        The evidence is flat along some hyperparameters, for example the
+        smoothing prior of a weight that is nearly constant, so the two fits
+        can find the same evidence at different hyperparameters.
+
+        Returns a dictionary with the evidence of each fit, and the largest
+            differences in log2 sigma and in the weights
+    '''
+    import copy
+    import psytrack as psy
+    psy_hyper, psy_evd, psy_wMode, _ = psy.hyperOpt(dat, copy.deepcopy(hyper),
+        weights, optList)
+    banded_hyper, banded_evd, banded_wMode, _ = hyper_opt(dat, 
+        copy.deepcopy(hyper), weights, optList)
+    comparison = {
+        'psytrack_evidence':psy_evd,
+        'banded_evidence':banded_evd,
+        'max_log2_sigma_difference':np.max(np.abs(
+            np.log2(psy_hyper['sigma'])-np.log2(banded_hyper['sigma']))),
+        'max_weight_difference':np.max(np.abs(psy_wMode-banded_wMode)),
+        }
+    if banded_evd < psy_evd - tol:
+        raise Exception('Banded evidence {} is lower than psytrack {}'.format(
+            banded_evd, psy_evd))
+    return comparison
+
+
+def get_model_data(dat, weights):
+    '''
+        Returns the inputs g (N,K) with weights in sorted order, choices y
+        (0/1), the number of missing trials before each trial, and the first
+        trial of each day
+    '''
+    N = len(dat['y'])
+    K = int(np.sum([weights[i] for i in weights]))
+    g = np.zeros((N,K))
+    g_ind = 0
+    for i in sorted(weights.keys()):
+        if i == 'bias':
+            g[:, g_ind:g_ind+1] = 1
+        elif weights[i] > 0:
+            if i not in dat['inputs']:
+                raise Exception(str(i)+' given in weights not in dataset inputs')
+            g[:, g_ind:g_ind+weights[i]] = dat['inputs'][i][:, :weights[i]]
+        g_ind += weights[i]
+
+    y = np.asarray(dat['y'])
+    if np.array_equal(np.unique(y), [0,1]):
+        y = y + 1
+    elif not np.array_equal(np.unique(y), [1,2]):
+        raise Exception('y must be parametrized as 1 and 2 only.')
+    y = (y - 1).astype(float)
+
+    missing = dat.get('missing_trials',None)
+    if missing is not None:
+        missing = np.asarray(missing,dtype=float).reshape(-1)
+        if len(missing) != N:
+            raise Exception('missing_trials must be length N if used')
+    day_length = dat.get('dayLength',None)
+    if day_length is None:
+        day_length = np.array([],dtype=int)
+    days = np.cumsum(day_length, dtype=int)[:-1]
+    return g, y, missing, days
+
+
+def format_hyper(hyper, K):
+    '''
+        Returns a copy of hyper with sigma as an array of length K
+    '''
+    hyper = copy_hyper(hyper)
+    sigma = np.array(hyper['sigma'],dtype=float)
+    if sigma.ndim == 0:
+        sigma = np.ones(K)*sigma
+    if len(sigma) != K:
+        raise Exception('number of sigmas is not K')
+    hyper['sigma'] = sigma
+    return hyper
+
+
+def copy_hyper(hyper):
+    return {k:(np.array(v) if np.ndim(v) else v) for k,v in hyper.items()}
+
+
+def pack_hyper(hyper, optList):
+    '''
+        Returns the log2 values of the hyperparameters being optimized
+    '''
+    optVals = []
+    for val in optList:
+        optVals += np.atleast_1d(np.log2(hyper[val])).tolist()
+    return np.array(optVals)
+
+
+def unpack_hyper(optVals, hyper, optList):
+    '''
+        Returns a copy of hyper with the values in optVals
+    '''
+    hyper = copy_hyper(hyper)
+    count = 0
+    for val in optList:
+        if val == 'sigma':
+            K = len(hyper['sigma'])
+            hyper['sigma'] = 2**optVals[count:count+K]
+            count += K
+        else:
+            hyper[val] = 2**optVals[count]
+            count += 1
+    return hyper
+
+
+def get_prior_variance(hyper, missing, days, N):
+    '''
+        Returns the (N,K) prior variance of the change in each weight on each
+        image, matching psytrack's make_invSigma
+    '''
+    sigma = hyper['sigma']
+    sigInit = hyper.get('sigInit',None)
+    sigDay = hyper.get('sigDay',None)
+    if sigInit is None:
+        sigInit = sigma
+    if sigDay is None:
+        sigDay = sigma
+    var = np.ones((N,1))*sigma[np.newaxis,:]**2
+    var[days,:] = np.asarray(sigDay)**2
+    var[0,:] = np.asarray(sigInit)**2
+    if missing is not None:
+        var += missing[:,np.newaxis]*sigma[np.newaxis,:]**2
+    return var
+
+
+def diff_weights(w):
+    '''
+        Returns e = D @ w, the change in each weight on each image
+    '''
+    return np.concatenate([w[0:1], np.diff(w,axis=0)])
+
+
+def diff_transpose(x):
+    '''
+        Returns D.T @ x
+    '''
+    return x - np.concatenate([x[1:], np.zeros((1,x.shape[1]))])
+
+
+def build_precision(lam, g, h):
+    '''
+        Builds the lower banded form of the negative Hessian of the log
+        posterior, D.T @ diag(lam) @ D + H, with H the block diagonal Hessian of
+        the negative log likelihood
+
+        lam, (N,K) prior precision of the change in each weight
+        g, (N,K) inputs
+        h, (N,) p*(1-p) on each image
+
+        Returns ab, (K+1,N*K), with ab[d,j] = P[j+d,j]
+    '''
+    N, K = g.shape
+    ab = np.zeros((K+1, N*K))
+
+    # Main diagonal, prior terms and likelihood
+    prior = lam.copy()
+    prior[:-1] += lam[1:]
+    ab[0] = (prior + h[:,np.newaxis]*g**2).reshape(-1)
+
+    # Within-image likelihood terms
+    for d in range(1,K):
+        block = np.zeros((N,K))
+        block[:,:K-d] = h[:,np.newaxis]*g[:,d:]*g[:,:K-d]
+        ab[d] = block.reshape(-1)
+
+    # Coupling between the same weight on sequential images
+    ab[K,:-K] = -lam[1:].reshape(-1)
+    return ab
+
+
+def get_likelihood_terms(g, y, w):
+    '''
+        Returns the log likelihood, its gradient (N,K), and p*(1-p) (N,)
+    '''
+    gw = np.sum(g*w, axis=1)
+    p = 1/(1+np.exp(-gw))
+    logli = np.sum(y*gw - np.logaddexp(0,gw))
+    dlogli = g*(y-p)[:,np.newaxis]
+    h = p*(1-p)
+    return logli, dlogli, h
+
+
+def get_map(g, y, hyper, missing, days, w0=None, tol=1e-9, maxiter=100):
+    '''
+        Finds the MAP estimate of the weights with Newton's method, using
+        banded solves of the posterior precision.
+
+        Returns the MAP weights (N,K), the Laplace approximation to the log
+            evidence, and a dictionary of the terms needed for the decoupled
+            Laplace approximation at these weights
+    '''
+    N, K = g.shape
+    lam = 1/get_prior_variance(hyper, missing, days, N)
+    w = np.zeros((N,K)) if w0 is None else w0.copy()
+
+    def log_posterior(w):
+        e = diff_weights(w)
+        logli, dlogli, h = get_likelihood_terms(g, y, w)
+        logprior = 0.5*(np.sum(np.log(lam)) - np.sum(lam*e**2))
+        return logli + logprior, logli, logprior, dlogli, h, e
+
+    f, logli, logprior, dlogli, h, e = log_posterior(w)
+    for i in range(maxiter):
+        grad = dlogli - diff_transpose(lam*e)
+        chol = cholesky_banded(build_precision(lam, g, h), lower=True)
+        step = cho_solve_banded((chol,True), grad.reshape(-1)).reshape(N,K)
+
+        # Backtracking line search
+        alpha = 1
+        while True:
+            new = log_posterior(w + alpha*step)
+            if (new[0] >= f) or (alpha < 1e-8):
+                break
+            alpha = alpha/2
+        w = w + alpha*step
+        decrease = new[0] - f
+        f, logli, logprior, dlogli, h, e = new
+        if (np.max(np.abs(alpha*step)) < tol) or (abs(decrease) < tol*abs(f)):
+            break
+
+    chol = cholesky_banded(build_precision(lam, g, h), lower=True)
+    logdet = 2*np.sum(np.log(chol[0]))
+    logEvd = logli + logprior - 0.5*logdet
+    llstruct = {'w':w, 'g':g, 'y':y, 'logli':logli, 'dlogli':dlogli, 'h':h, 
+        'chol':chol, 'lam':lam}
+    return w, logEvd, llstruct
+
+
+def decoupled_evidence(optVals, g, llstruct, hyper, optList, missing, days,
+    counts=None):
+    '''
+        The negative decoupled Laplace approximation of the log evidence, and
+        its gradient with respect to the log2 hyperparameters in optVals.
+
+        As in psytrack's hyperOpt_lossfun, the new weights are the MAP of the
+        quadratic expansion of the log likelihood around the MAP weights in
+        llstruct, and the evidence is the Laplace approximation at the new
+        weights, with the log likelihood and its Hessian at the new weights.
+
+        The gradient with respect to the prior precision lam_i of each weight
+        change e_i has a direct term
+            0.5/lam_i - 0.5*e_i**2 - 0.5*Var(e_i)
+        where Var(e_i) comes from a selected inversion of the posterior
+        precision at the new weights, and a term from the change in the new
+        weights
+            -(D @ inv(P0) @ v)_i*e_i
+        where P0 is the precision of the quadratic expansion, and v is the
+        gradient of the evidence with respect to the new weights.
+    '''
+    if counts is not None:
+        counts['num_evidence_evaluations'] += 1
+    N, K = g.shape
+    new_hyper = unpack_hyper(optVals, hyper, optList)
+    var = get_prior_variance(new_hyper, missing, days, N)
+    lam = 1/var
+
+    # New MAP under the quadratic likelihood
+    w0 = llstruct['w']
+    h0 = llstruct['h']
+    b = h0[:,np.newaxis]*g*np.sum(g*w0,axis=1)[:,np.newaxis] + llstruct['dlogli']
+    chol0 = cholesky_banded(build_precision(lam, g, h0), lower=True)
+    w = cho_solve_banded((chol0,True), b.reshape(-1)).reshape(N,K)
+    e = diff_weights(w)
+
+    # Approximate evidence, with the likelihood terms at the new weights
+    logli, dlogli, h = get_likelihood_terms(g, llstruct['y'], w)
+    logprior = 0.5*(np.sum(np.log(lam)) - np.sum(lam*e**2))
+    chol = cholesky_banded(build_precision(lam, g, h), lower=True)
+    evd = logli + logprior - np.sum(np.log(chol[0]))
+
+    # Direct gradient with respect to the prior precision of each weight change
+    Z, Zsub = selected_inversion(chol, K)
+    Zdiag = np.diagonal(Z, axis1=1, axis2=2)
+    var_e = Zdiag.copy()
+    var_e[1:] += Zdiag[:-1] - 2*Zsub
+    dlam = 0.5/lam - 0.5*e**2 - 0.5*var_e
+
+    # Gradient through the new weights. d(h)/d(g @ w) = h*(1-2p)
+    p = 1/(1+np.exp(-np.sum(g*w,axis=1)))
+    quad = np.einsum('nk,nkj,nj->n', g, Z, g)
+    v = dlogli - diff_transpose(lam*e) - 0.5*(h*(1-2*p)*quad)[:,np.newaxis]*g
+    u = cho_solve_banded((chol0,True), v.reshape(-1)).reshape(N,K)
+    dlam -= diff_weights(u)*e
+
+    # Chain rule to log2 hyperparameters, d(lam)/d(var) = -lam**2
+    dvar = -lam**2*dlam
+    grad = []
+    for val in optList:
+        if val == 'sigma':
+            # derivative of the variance with respect to sigma**2
+            weight = np.ones((N,1))
+            weight[days] = 0
+            weight[0] = 0
+            if missing is not None:
+                weight += missing[:,np.newaxis]
+            dsig2 = np.sum(dvar*weight,axis=0)
+            grad += (dsig2*2*np.log(2)*new_hyper['sigma']**2).tolist()
+        else:
+            dsig2 = np.sum(dvar[days])
+            grad += [dsig2*2*np.log(2)*new_hyper['sigDay']**2]
+    return -evd, -np.array(grad)
+
+
+def selected_inversion(chol, K):
+    '''
+        Computes the diagonal blocks, and the diagonal of the first 
+        sub-diagonal blocks, of the inverse of the block tridiagonal matrix
+        with lower banded Cholesky factor chol.
+
+        The factor L is block bidiagonal with lower triangular diagonal blocks
+        L_t and sub-diagonal blocks M_t. The blocks of Z = inv(L @ L.T) are
+        computed backwards in time
+            Z_{t+1,t} = -Z_{t+1,t+1} @ M_t @ inv(L_t)
+            Z_{t,t}   = inv(L_t).T @ (inv(L_t) - M_t.T @ Z_{t+1,t})
+
+        Returns Z (N,K,K), each Z_{t,t}, and Zsub (N-1,K), the diagonal of 
+            each Z_{t+1,t}
+    '''
+    N = int(chol.shape[1]/K)
+    L = get_blocks(chol, K, N, 0)
+    M = get_blocks(chol, K, N-1, K)
+    Linv = np.linalg.inv(L)
+
+    Zblocks = np.zeros((N,K,K))
+    Zsub = np.zeros((max(N-1,0),K))
+    Z = Linv[-1].T @ Linv[-1]
+    Zblocks[-1] = Z
+    for t in range(N-2,-1,-1):
+        Z_sub = -Z @ M[t] @ Linv[t]
+        Z = Linv[t].T @ (Linv[t] - M[t].T @ Z_sub)
+        Zblocks[t] = Z
+        Zsub[t] = np.diag(Z_sub)
+    return Zblocks, Zsub
+
+
+def get_blocks(chol, K, num_blocks, offset):
+    '''
+        Returns the first num_blocks K by K blocks of the banded lower factor
+        chol, either the diagonal blocks (offset=0), or the sub-diagonal blocks
+        (offset=K). Entries of the block outside the band are 0
+
+        Returns an array (num_blocks, K, K)
+    '''
+    rows, cols = np.meshgrid(np.arange(K), np.arange(K), indexing='ij')
+    d = offset + rows - cols
+    inband = (d >= 0) & (d <= K)
+    columns = np.arange(num_blocks)[:,np.newaxis]*K + cols[inband][np.newaxis,:]
+    blocks = np.zeros((num_blocks, K, K))
+    blocks[:, rows[inband], cols[inband]] = chol[d[inband][np.newaxis,:], columns]
+    return blocks
+
+
+def get_psytrack_hess(llstruct):
+    '''
+        Returns the Hessian terms in the sparse format of psytrack, ordered by
+        weight. ddlogprior is the Hessian of the log prior of e, and H is the
+        Hessian of the log likelihood of w
+    '''
+    g = llstruct['g']
+    lam = llstruct['lam']
+    N, K = lam.shape
+    ddlogprior = diags(-lam.T.reshape(-1))
+    H = myblk_diags(-llstruct['h'][:,np.newaxis,np.newaxis]*\
+        (g[:,:,np.newaxis] @ g[:,np.newaxis,:]))
+    return {'ddlogprior':ddlogprior, 'H':H, 'K':K}
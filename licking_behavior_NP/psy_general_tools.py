@@ -1,10 +1,14 @@
+import os
 import json
+import functools
+import importlib.metadata
 import numpy as np
 import pandas as pd
+from tqdm import tqdm
 from pathlib import Path
+from types import SimpleNamespace
 
-from allensdk.brain_observatory.behavior.behavior_project_cache import \
-    VisualBehaviorNeuropixelsProjectCache
+import licking_behavior_NP.psy_storage_tools as pst
 
 '''
 This is a set of general purpose functions for interacting with the SDK
@@ -17,7 +21,61 @@ updated 02/11/2022
 ported to NP data 05/2023
 '''
 
-BEHAVIOR_DIR = '/allen/programs/braintv/workgroups/nc-ophys/alex.piet/NP/behavior/'
+BEHAVIOR_DIR = os.environ.get('PSY_BEHAVIOR_DIR',
+    '/allen/programs/braintv/workgroups/nc-ophys/alex.piet/NP/behavior/')
+BEHAVIOR_DIR = os.path.join(BEHAVIOR_DIR, '')
+SESSION_CACHE_DIR = BEHAVIOR_DIR+'session_cache/'
+NP_MANIFEST_FILE = BEHAVIOR_DIR+'np_manifest_snapshot.pkl'
+
+# dtypes of the columns of the tables saved for each session, see
+# save_session_table. Columns that are not listed keep their dtype
+SESSION_TABLE_SCHEMAS = {
+    'strategy_df':{
+        'stimulus_presentations_id':'int64',
+        'stimulus_block':'int64',
+        'active':'bool',
+        'is_change':'bool',
+        'omitted':'bool',
+        'flashes_since_change':'int64',
+        'licked':'bool',
+        'lick_bout_start':'bool',
+        'lick_bout_end':'bool',
+        'in_lick_bout':'bool',
+        'bout_number':'float64',
+        'num_licks':'int64',
+        'rewarded':'bool',
+        'hit':'float64',
+        'miss':'float64',
+        'image_false_alarm':'float64',
+        'image_correct_reject':'float64',
+        'RT':'float64',
+        'engaged':'bool',
+        },
+    'licks_df':{
+        'timestamps':'float64',
+        'frame':'int64',
+        'pre_ili':'float64',
+        'post_ili':'float64',
+        'bout_start':'bool',
+        'bout_end':'bool',
+        'bout_number':'int64',
+        'rewarded':'bool',
+        'num_rewards':'int64',
+        'bout_rewarded':'bool',
+        'bout_num_rewards':'int64',
+        },
+    'interval_df':{
+        'is_change':'bool',
+        'omitted':'bool',
+        'bout_start':'bool',
+        'bout_end':'bool',
+        'in_lick_bout':'bool',
+        'rewarded':'bool',
+        'bout_number':'float64',
+        'first_lick_time':'float64',
+        'last_lick_time':'float64',
+        },
+    }
 
 
 def get_directory(version,verbose=False,subdirectory=None,group=None):
@@ -38,6 +96,10 @@ def get_directory(version,verbose=False,subdirectory=None,group=None):
         subdir = 'figures_sessions/'
     elif subdirectory == 'training_figures':
         subdir = 'figures_training/'
+    elif subdirectory == 'checkpoints':
+        subdir = 'session_checkpoints/'
+    elif subdirectory == 'metrics':
+        subdir = 'session_metrics/'
     elif subdirectory is None:
         subdir = ''
     else:
@@ -48,19 +110,156 @@ def get_directory(version,verbose=False,subdirectory=None,group=None):
     directory = root_directory+'psy_fits_v'+str(version)+'/'+subdir
     return directory
 
+def get_session_table_filename(bsid, version, subdirectory):
+    '''
+        Returns the filename of a table saved for this session, either 
+        Parquet, or csv for sessions saved before Parquet was used. Returns
+        None if the table has not been saved
+
+        subdirectory (str), 'strategy_df', 'licks_df', or 'interval_df'
+    '''
+    directory = get_directory(version, subdirectory=subdirectory)
+    for extension in ['.parquet','.csv']:
+        if os.path.isfile(directory+str(bsid)+extension):
+            return directory+str(bsid)+extension
+    return None
+
+def save_session_table(df, bsid, version, subdirectory):
+    '''
+        Saves a table for this session with the schema in 
+        SESSION_TABLE_SCHEMAS, see psy_storage_tools. A csv of the same 
+        session is removed, so only the new table is loaded
+    '''
+    filename = get_directory(version, subdirectory=subdirectory)+str(bsid)
+    pst.save_table(filename+pst.get_table_extension(), df, 
+        SESSION_TABLE_SCHEMAS[subdirectory])
+    if (pst.get_table_extension() != '.csv') and os.path.isfile(filename+'.csv'):
+        os.remove(filename+'.csv')
+
+def load_session_table(bsid, version, subdirectory, columns=None):
+    '''
+        Loads a table saved for this session
+
+        columns (list), the columns to load, columns that are not in the 
+            table are skipped. If None, loads every column 
+    '''
+    filename = get_session_table_filename(bsid, version, subdirectory)
+    if filename is None:
+        raise Exception('No {} saved for session {}'.format(subdirectory, bsid))
+    return pst.load_table(filename, columns=columns, 
+        schema=SESSION_TABLE_SCHEMAS[subdirectory])
+
+def convert_session_tables(version, subdirectories=['strategy_df','licks_df',
+    'interval_df'], remove_csv=False):
+    '''
+        Converts the csv tables of each session in this version to Parquet.
+        Sessions that were already converted are skipped
+
+        remove_csv (bool), if True, removes each csv once it is converted
+    '''
+    if pst.get_table_extension() != '.parquet':
+        raise Exception('Converting to Parquet needs pyarrow')
+    for subdirectory in subdirectories:
+        directory = get_directory(version, subdirectory=subdirectory)
+        if not os.path.isdir(directory):
+            continue
+        filenames = sorted([x for x in os.listdir(directory) 
+            if x.endswith('.csv')])
+        num_converted = 0
+        for filename in tqdm(filenames, desc=subdirectory):
+            parquet_file = directory+filename[:-4]+'.parquet'
+            if not os.path.isfile(parquet_file):
+                df = pst.load_table(directory+filename, 
+                    schema=SESSION_TABLE_SCHEMAS[subdirectory])
+                pst.save_table(parquet_file, df, 
+                    SESSION_TABLE_SCHEMAS[subdirectory])
+                num_converted +=1
+            if remove_csv:
+                os.remove(directory+filename)
+        print('Converted {} of {} {} tables'.format(num_converted, 
+            len(filenames), subdirectory))
+
+def fit_exists(bsid, version):
+    '''
+        Returns True if the model fit for this session has been saved, either 
+        as a fit store (.npz), or as a legacy pickle (.pkl)
+    '''
+    directory = get_directory(version, subdirectory='fits')
+    return os.path.isfile(directory+str(bsid)+'.npz') or \
+        os.path.isfile(directory+str(bsid)+'.pkl')
+
+@functools.lru_cache(maxsize=None)
 def get_cache():
+    '''
+        Returns the SDK project cache. The cache is built once per process,
+        use get_cache.cache_clear() to rebuild it. The AllenSDK is only 
+        imported here, so fitting cached sessions does not import it
+
+        If the environment variable PSY_SYNTHETIC_CACHE is set, returns a 
+        cache of synthetic sessions instead, see psy_synthetic_tools. 
+        PSY_BEHAVIOR_DIR must also be set, so the synthetic sessions are 
+        never saved with the real data
+    '''
+    if 'PSY_SYNTHETIC_CACHE' in os.environ:
+        if 'PSY_BEHAVIOR_DIR' not in os.environ:
+            raise Exception('Set PSY_BEHAVIOR_DIR to use a synthetic cache')
+        import licking_behavior_NP.psy_synthetic_tools as psyn
+        return psyn.get_synthetic_cache(os.environ['PSY_SYNTHETIC_CACHE'])
+    from allensdk.brain_observatory.behavior.behavior_project_cache import \
+        VisualBehaviorNeuropixelsProjectCache
     cache_dir = '/allen/programs/mindscope/workgroups/np-behavior/vbn_data_release/vbn_s3_cache/'
     cache = VisualBehaviorNeuropixelsProjectCache.from_s3_cache(cache_dir=Path(cache_dir))
     return cache
 
-def get_np_manifest():
+def get_np_manifest(refresh=False):
     '''
         Returns a dataframe of the NP sessions
+
+        The table is loaded from a snapshot in NP_MANIFEST_FILE, so it does
+        not need the SDK cache, see get_np_manifest_snapshot
+    '''
+    return get_np_manifest_snapshot(refresh=refresh)['np_table'].copy()
+
+def get_np_manifest_snapshot(refresh=False):
     '''
+        Returns the snapshot of the NP session table, and the AllenSDK and 
+        cache manifest version it was built from. The snapshot is built from
+        the SDK cache the first time, or when refresh is True. Refresh the 
+        snapshot after updating the AllenSDK or a new data release, which 
+        also starts a new session cache, see get_cache_version
+    '''
+    if refresh or not os.path.isfile(NP_MANIFEST_FILE):
+        refresh_np_manifest()
+    return load_np_manifest_snapshot(os.path.getmtime(NP_MANIFEST_FILE))
+
+def refresh_np_manifest():
+    '''
+        Rebuilds the snapshot of the NP session table from the SDK cache
+    '''
+    print('Building NP manifest snapshot')
     cache = get_cache()
     np_table = cache.get_ecephys_session_table(filter_abnormalities=False)
     np_table = np_table.sort_index()
-    return np_table
+    snapshot = {
+        'np_table':np_table,
+        'cache_version':'allensdk_{}_{}'.format(
+            getattr(cache, 'sdk_version', None) or \
+            importlib.metadata.version('allensdk'),
+            os.path.splitext(cache.current_manifest())[0])
+        }
+    os.makedirs(os.path.dirname(NP_MANIFEST_FILE), exist_ok=True)
+    temp_file = NP_MANIFEST_FILE+'.tmp'
+    pd.to_pickle(snapshot, temp_file)
+    os.replace(temp_file, NP_MANIFEST_FILE)
+    load_np_manifest_snapshot.cache_clear()
+
+@functools.lru_cache(maxsize=1)
+def load_np_manifest_snapshot(modified_time):
+    '''
+        Loads the snapshot once per process. modified_time is part of the 
+        key, so a snapshot refreshed by another process is reloaded
+    '''
+    return pd.read_pickle(NP_MANIFEST_FILE)
  
 
 def load_version_parameters(VERSION):
@@ -69,17 +268,40 @@ def load_version_parameters(VERSION):
         format_options = json.load(json_file)
     return format_options
 
-def get_data(bsid):
+def get_data(bsid, use_cache=True):
     '''
         Loads data from SDK interface
         ARGS: behavior_session_id to load
+        use_cache, if True, loads the session from the session cache in 
+            SESSION_CACHE_DIR if it has been cached for this AllenSDK and 
+            cache manifest version. Otherwise loads from the SDK, and caches
+            the session. 
+
+        Returns a session with stimulus_presentations_np, licks, rewards, and
+        metadata, see get_session_tables
     '''
+    if use_cache:
+        filename = get_session_cache_filename(bsid)
+        if os.path.isfile(filename):
+            print('Loading session from cache')
+            return load_cached_session(filename)
 
     # Get SDK session object
     print('Loading SDK object')
     cache = get_cache()
     session = cache.get_behavior_session(behavior_session_id=bsid)
+    session = get_active_session(session)
+    if use_cache:
+        print('Saving session to cache')
+        save_cached_session(filename, session)
+    return session
 
+def get_active_session(session):
+    '''
+        Keeps the images of the active behavior block of the SDK session, and
+        returns the parts of the session the model uses, see 
+        get_session_tables
+    '''
     # Remove Passive session:
     print('removing passive session stimuli')
     session.stimulus_presentations_np = session.stimulus_presentations.query('active')
@@ -92,18 +314,111 @@ def get_data(bsid):
     session.stimulus_presentations_np.drop(columns=drop_cols,inplace=True)
 
     print('Adding stimulus annotations')
-    # Get extended stimulus presentations
-    add_licks_each_flash(session) 
-    add_rewards_each_flash(session)
+    # Get licks and rewards on each image
+    return get_session_tables(session)
 
-    return session
+class SessionData:
+    '''
+        The parts of a session the model uses, without the SDK session object.
+        The annotation and formatting functions accept it in place of the SDK
+        session. 
+
+        stimulus_presentations_np, licks, rewards, metadata, as in the SDK 
+            session. stimulus_presentations_np does not have the licks and 
+            rewards columns of event arrays
+        lick_times, lick_offsets, lick_counts, the licks on each image, see
+            bin_events. The licks on image i are 
+            lick_times[lick_offsets[i]:lick_offsets[i]+lick_counts[i]]
+        reward_times, reward_offsets, reward_counts, the same for rewards
+    '''
+    __slots__ = ['stimulus_presentations_np','licks','rewards','metadata',
+        'lick_times','lick_offsets','lick_counts',
+        'reward_times','reward_offsets','reward_counts']
+
+    def __init__(self, **tables):
+        for key in self.__slots__:
+            setattr(self, key, tables[key])
+
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+    def __setstate__(self, state):
+        for key in self.__slots__:
+            setattr(self, key, state[key])
+
+def get_session_tables(session):
+    '''
+        Returns a SessionData with the parts of the session the model uses. 
+        session can be an SDK session with stimulus_presentations_np, or an
+        older session with the licks and rewards columns of event arrays
+    '''
+    if isinstance(session, SessionData):
+        return session
+    stimulus = session.stimulus_presentations_np.copy()
+    tables = {
+        'licks':session.licks,
+        'rewards':session.rewards,
+        'metadata':session.metadata,
+        }
+    for events, name in [('licks','lick'),('rewards','reward')]:
+        if events in stimulus:
+            times, offsets, counts = get_event_offsets(stimulus[events])
+            stimulus.drop(columns=[events], inplace=True)
+        else:
+            times, offsets, counts = bin_events_each_flash(stimulus,
+                getattr(session, events)['timestamps'].values)
+        tables[name+'_times'] = times
+        tables[name+'_offsets'] = offsets
+        tables[name+'_counts'] = counts
+    if 'licked' not in stimulus:
+        stimulus['licked'] = tables['lick_counts'] > 0
+    tables['stimulus_presentations_np'] = stimulus
+    return SessionData(**tables)
+
+def get_image_events(session, events='licks'):
+    '''
+        Returns the times, offsets, and counts of the licks or rewards on each
+        image, see bin_events. Works with a SessionData, or a session with the
+        licks and rewards columns of event arrays
+
+        events, 'licks' or 'rewards'
+    '''
+    if isinstance(session, SessionData):
+        name = {'licks':'lick','rewards':'reward'}[events]
+        return getattr(session, name+'_times'), \
+            getattr(session, name+'_offsets'), getattr(session, name+'_counts')
+    return get_event_offsets(session.stimulus_presentations_np[events])
+
+def get_cache_version():
+    '''
+        Returns a string of the AllenSDK version and the manifest of the SDK 
+        cache, as recorded in the NP manifest snapshot. Cached sessions are 
+        only used with the same versions
+    '''
+    return get_np_manifest_snapshot()['cache_version']
+
+def get_session_cache_filename(bsid):
+    return SESSION_CACHE_DIR+'{}_{}.npz'.format(bsid, get_cache_version())
+
+def save_cached_session(filename, session):
+    '''
+        Saves the session tables as a fit store, see psy_storage_tools
+    '''
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    pst.save_store(filename, get_session_tables(session).__getstate__())
+
+def load_cached_session(filename):
+    tables = pst.load_store(filename)
+    if all(key in tables for key in SessionData.__slots__):
+        return SessionData(**tables)
+    return get_session_tables(SimpleNamespace(**tables))
 
 def add_licks_each_flash(session):
-    licks_each_flash = add_licks_each_flash_inner(session.stimulus_presentations_np,
-                                            session.licks)
-    session.stimulus_presentations_np['licks'] = licks_each_flash
-    session.stimulus_presentations_np['licked'] = [True if len(licks) > 0 else False \
-        for licks in session.stimulus_presentations_np.licks.values]   
+    lick_times, offsets, counts = bin_events_each_flash(
+        session.stimulus_presentations_np, session.licks['timestamps'].values)
+    session.stimulus_presentations_np['licks'] = split_events(lick_times, 
+        offsets, counts, index=session.stimulus_presentations_np.index)
+    session.stimulus_presentations_np['licked'] = counts > 0
 
 def add_licks_each_flash_inner(stimulus_presentations_df, licks_df,
                      range_relative_to_stimulus_start=[0, 0.75]):
@@ -121,21 +436,10 @@ def add_licks_each_flash_inner(stimulus_presentations_df, licks_df,
         licks_each_flash (pd.Series): lick times that fell within the window 
     '''
 
-    lick_times = licks_df['timestamps'].values
-    stimulus_presentations_df['next_start'] = stimulus_presentations_df['start_time'].shift(-1)
-    stimulus_presentations_df.at[stimulus_presentations_df.index[-1], 'next_start'] = \
-        stimulus_presentations_df.iloc[-1]['start_time'] + .75
-    licks_each_flash = stimulus_presentations_df.apply(
-        lambda row: lick_times[
-            ((
-                lick_times > row["start_time"]
-            ) & (
-                lick_times <= row["next_start"]
-            ))
-        ],
-        axis=1,
-    )
-    stimulus_presentations_df.drop(columns=['next_start'], inplace=True)
+    lick_times, offsets, counts = bin_events_each_flash(
+        stimulus_presentations_df, licks_df['timestamps'].values)
+    licks_each_flash = split_events(lick_times, offsets, counts,
+        index=stimulus_presentations_df.index)
     return licks_each_flash
 
 def add_rewards_each_flash(session):
@@ -173,24 +477,69 @@ def add_rewards_each_flash_inner(stimulus_presentations_df, rewards_df,
         rewards_each_flash (pd.Series): reward times that fell within the window
     '''
 
-    reward_times = rewards_df['timestamps'].values
-    stimulus_presentations_df['next_start'] = stimulus_presentations_df['start_time'].shift(-1)
-    stimulus_presentations_df.at[stimulus_presentations_df.index[-1], 'next_start'] = \
-        stimulus_presentations_df.iloc[-1]['start_time'] + .75
-    rewards_each_flash = stimulus_presentations_df.apply(
-        lambda row: reward_times[
-            ((
-                reward_times > row["start_time"]
-            ) & (
-                reward_times <= row["next_start"]
-            ))
-        ],
-        axis=1,
-    )
-    stimulus_presentations_df.drop(columns=['next_start'], inplace=True)
-
+    reward_times, offsets, counts = bin_events_each_flash(
+        stimulus_presentations_df, rewards_df['timestamps'].values)
+    rewards_each_flash = split_events(reward_times, offsets, counts,
+        index=stimulus_presentations_df.index)
     return rewards_each_flash
 
+def bin_events(event_times, start_times, end_times):
+    '''
+        Bins events into the windows (start_times, end_times]. 
+        
+        event_times, sorted array of event times
+        start_times, end_times, arrays with the start and end of each window
+
+        Returns offsets, counts. The events in window i are
+            event_times[offsets[i]:offsets[i]+counts[i]]
+    '''
+    offsets = np.searchsorted(event_times, start_times, side='right')
+    counts = np.searchsorted(event_times, end_times, side='right') - offsets
+    return offsets, np.maximum(counts, 0)
+
+def bin_events_each_flash(stimulus_presentations_df, event_times):
+    '''
+        Bins events into each image. Each image window starts at the start of
+        the image, and ends at the start of the next image. The last image 
+        ends 750ms after it starts. 
+
+        Returns the sorted event times, and the offsets and counts of the events
+        in each image, see bin_events
+    '''
+    event_times = np.sort(np.asarray(event_times, dtype=float))
+    start_times = stimulus_presentations_df['start_time'].values.astype(float)
+    end_times = np.append(start_times[1:], start_times[-1] + .75)
+    offsets, counts = bin_events(event_times, start_times, end_times)
+    return event_times, offsets, counts
+
+def split_events(event_times, offsets, counts, index=None):
+    '''
+        Returns a series with the array of events in each window, in the 
+        format of the licks and rewards columns of stimulus_presentations_np
+    '''
+    events = pd.Series([event_times[o:o+c] for o,c in zip(offsets,counts)],
+        index=index, dtype=object)
+    return events
+
+def get_event_offsets(events):
+    '''
+        Converts a column of event arrays, such as the licks column of 
+        stimulus_presentations_np, into the concatenated event times, and the 
+        offsets and counts of the events in each image, see bin_events
+    '''
+    counts = count_events(events)
+    offsets = np.cumsum(counts) - counts
+    if np.sum(counts) == 0:
+        return np.array([], dtype=float), offsets, counts
+    event_times = np.concatenate([x for x in events if len(x) > 0]).astype(float)
+    return event_times, offsets, counts
+
+def count_events(events):
+    '''
+        Returns the number of events in each entry of a column of event arrays
+    '''
+    return np.fromiter(map(len, events), dtype=int, count=len(events))
+
 
 def moving_mean(values, window,mode='valid'):
     '''
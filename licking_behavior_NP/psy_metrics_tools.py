@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.stats import norm
 import licking_behavior_NP.psy_general_tools as pgt
 
 '''
@@ -98,36 +97,30 @@ def annotate_licks(session):
     session.licks['bout_number'] = np.cumsum(session.licks['bout_start'])
 
     # Annotate rewards
-    # Iterate through rewards
-    session.licks['rewarded'] = False # Setting default to False
-    session.licks['num_rewards'] = 0 
-    for index, row in session.rewards.iterrows():
-        if row.auto_rewarded:
-            # Assign to nearest lick
-            mylick = np.abs(session.licks.timestamps - row.timestamps).idxmin()
-        else:
-            # Assign reward to last lick before reward time
-            this_reward_lick_times=np.where(session.licks.timestamps<=row.timestamps)[0]
-            if len(this_reward_lick_times) == 0:
-                raise Exception('First lick was after first reward')
-            else:
-                mylick = this_reward_lick_times[-1]
-        session.licks.at[mylick,'rewarded'] = True 
-        # licks can be double assigned to rewards because of auto-rewards
-        session.licks.at[mylick,'num_rewards'] +=1  
+    # Auto-rewards are assigned to the nearest lick, earned rewards are 
+    # assigned to the last lick before the reward
+    lick_times = session.licks['timestamps'].values
+    reward_times = session.rewards['timestamps'].values
+    auto_rewarded = session.rewards['auto_rewarded'].values.astype(bool)
+    reward_licks = np.empty(len(reward_times), dtype=int)
+    reward_licks[auto_rewarded] = get_nearest_lick(lick_times, 
+        reward_times[auto_rewarded])
+    reward_licks[~auto_rewarded] = np.searchsorted(lick_times, 
+        reward_times[~auto_rewarded], side='right') - 1
+    if np.any(reward_licks[~auto_rewarded] < 0):
+        raise Exception('First lick was after first reward')
+
+    # licks can be double assigned to rewards because of auto-rewards
+    num_rewards = np.bincount(reward_licks, minlength=len(lick_times))
+    session.licks['rewarded'] = num_rewards > 0
+    session.licks['num_rewards'] = num_rewards
 
     # Annotate bout rewards  
-    x = session.licks.groupby('bout_number').any('rewarded').\
-        rename(columns={'rewarded':'bout_rewarded'})
-    y = session.licks.groupby('bout_number')['num_rewards'].sum().\
-        rename('bout_num_rewards')
-    session.licks['bout_rewarded'] = False
-    temp = session.licks.reset_index().set_index('bout_number')
-    temp.update(x)
-    temp['bout_num_rewards'] = y
-    temp = temp.reset_index().set_index('index')
-    session.licks['bout_rewarded'] = temp['bout_rewarded']
-    session.licks['bout_num_rewards'] = temp['bout_num_rewards']
+    bout_number = session.licks['bout_number'].values
+    bout_num_rewards = np.bincount(bout_number[reward_licks], 
+        minlength=bout_number.max(initial=0)+1)
+    session.licks['bout_rewarded'] = bout_num_rewards[bout_number] > 0
+    session.licks['bout_num_rewards'] = bout_num_rewards[bout_number]
 
     # QC
     # Check that all rewards are matched to a lick
@@ -153,6 +146,21 @@ def annotate_licks(session):
     assert num_bout_start == num_bouts, "Number of bouts is incorrect"
 
 
+def get_nearest_lick(lick_times, times):
+    '''
+        Returns the position of the lick nearest to each time in times. Ties
+        go to the earlier lick. lick_times must be sorted
+    '''
+    after = np.clip(np.searchsorted(lick_times, times, side='left'), 
+        0, len(lick_times)-1)
+    before = np.clip(after-1, 0, len(lick_times)-1)
+    nearest = np.where(np.abs(lick_times[before]-times) <= \
+        np.abs(lick_times[after]-times), before, after)
+    
+    # If several licks have the same time, use the first 
+    return np.searchsorted(lick_times, lick_times[nearest], side='left')
+
+
 def annotate_bouts(session):
     '''
         Uses the bout annotations in licks to annotate stimulus_presentations_np
@@ -170,41 +178,41 @@ def annotate_bouts(session):
 
     '''
     # Annotate Bout Starts
+    # Mark the last stimulus that started before the bout started
     bout_starts = session.licks[session.licks['bout_start']]
-    session.stimulus_presentations_np['bout_start'] = False
-    session.stimulus_presentations_np['num_bout_start'] = 0
-    for index,x in bout_starts.iterrows():
-        filter_start = session.stimulus_presentations_np.query('start_time < @x.timestamps')
-        if len(filter_start) > 0:
-            # Mark the last stimulus that started before the bout started
-            start_index = filter_start.index[-1]
-            session.stimulus_presentations_np.at[start_index,'bout_start'] = True
-            session.stimulus_presentations_np.at[start_index,'num_bout_start'] += 1
-            session.stimulus_presentations_np.at[start_index,'bout_number'] = x.bout_number
-        elif x.timestamps <= session.stimulus_presentations_np.iloc[0].start_time:
-            # Bout started before stimulus, mark the first stimulus as start
-            session.stimulus_presentations_np.at[0,'bout_start'] = True
-            session.stimulus_presentations_np.at[0,'num_bout_start'] += 1
-        else:
-            raise Exception('couldnt annotate bout start (bout number: {})'.format(index))
+    start_index = get_image_index(session.stimulus_presentations_np, 
+        bout_starts, 'bout start')
+    num_images = len(session.stimulus_presentations_np)
+    valid = start_index >= 0
+    num_bout_start = np.bincount(start_index[valid], minlength=num_images)
+    session.stimulus_presentations_np['bout_start'] = num_bout_start > 0
+    session.stimulus_presentations_np['num_bout_start'] = num_bout_start
+    if np.any(valid):
+        # If several bouts start on one image, keep the last bout number
+        images, last = np.unique(start_index[valid][::-1], return_index=True)
+        bout_number = np.full(num_images, np.nan)
+        bout_number[images] = bout_starts['bout_number'].values[valid][::-1][last]
+        session.stimulus_presentations_np['bout_number'] = bout_number
+    num_before = np.sum(~valid)
+    if num_before > 0:
+        # Bout started before stimulus, mark the first stimulus as start
+        session.stimulus_presentations_np.at[0,'bout_start'] = True
+        session.stimulus_presentations_np.at[0,'num_bout_start'] += num_before
 
     # Annotate Bout Ends
+    # Mark the last stimulus that started before the bout ended
     bout_ends = session.licks[session.licks['bout_end']]
-    session.stimulus_presentations_np['bout_end'] = False
-    session.stimulus_presentations_np['num_bout_end'] = 0
-    for index,x in bout_ends.iterrows():
-        filter_end = session.stimulus_presentations_np.query('start_time < @x.timestamps')
-        if len(filter_end) > 0:
-            # Mark the last stimulus that started before the bout ended
-            end_index = filter_end.index[-1]
-            session.stimulus_presentations_np.at[end_index,'bout_end'] = True
-            session.stimulus_presentations_np.at[end_index,'num_bout_end'] += 1   
-        elif x.timestamps <= session.stimulus_presentations_np.iloc[0].start_time:
-            # Bout started before stimulus, mark the first stimulus as start
-            session.stimulus_presentations_np.at[0,'bout_end'] = True
-            session.stimulus_presentations_np.at[0,'num_bout_end'] += 1
-        else:
-            raise Exception('couldnt annotate bout end (bout number: {})'.format(index))
+    end_index = get_image_index(session.stimulus_presentations_np, 
+        bout_ends, 'bout end')
+    valid = end_index >= 0
+    num_bout_end = np.bincount(end_index[valid], minlength=num_images)
+    session.stimulus_presentations_np['bout_end'] = num_bout_end > 0
+    session.stimulus_presentations_np['num_bout_end'] = num_bout_end
+    num_before = np.sum(~valid)
+    if num_before > 0:
+        # Bout started before stimulus, mark the first stimulus as start
+        session.stimulus_presentations_np.at[0,'bout_end'] = True
+        session.stimulus_presentations_np.at[0,'num_bout_end'] += num_before
 
     # Annotate In-Bout
     session.stimulus_presentations_np['in_lick_bout'] = \
@@ -238,6 +246,94 @@ def annotate_bouts(session):
         "Cant be in a bout and a bout_start"
 
 
+def get_image_index(stimulus_presentations_np, licks, label):
+    '''
+        Returns the position of the last stimulus that started before each 
+        lick in licks, or -1 if the lick was before the first stimulus.
+        Assumes stimulus_presentations_np is sorted by start_time
+
+        label, describes the licks in the error message
+    '''
+    lick_times = licks['timestamps'].values
+    missing = np.isnan(lick_times)
+    if np.any(missing):
+        raise Exception('couldnt annotate {} (bout number: {})'.format(label,
+            licks.index[np.where(missing)[0][0]]))
+    start_times = stimulus_presentations_np['start_time'].values
+    return np.searchsorted(start_times, lick_times, side='left') - 1
+
+
+def rolling_mean(values, win_dur, win_type='gaussian', win_std=60, 
+    min_periods=1, small_weight=0.1):
+    '''
+        Computes the centered rolling mean of each column of values in one 
+        pass. Gives the same result, to floating point precision, as 
+        pd.Series(column).rolling(win_dur, min_periods=min_periods,
+            win_type=win_type, center=True).mean(std=win_std)
+        
+        NaN values are ignored by normalizing by the window weight of the 
+        values that are not NaN. Images with fewer than min_periods values in
+        the window are NaN. The weighted sums are computed with FFT 
+        convolutions, so the cost does not grow with the window duration. 
+        The roundoff of the FFT is large relative to a small window weight, 
+        so images whose window weight is below small_weight*window.max() are 
+        recomputed with direct sums. The mean is clipped to the range of each
+        column, so the rate of a 0/1 indicator is never above 1.
+
+        values, 1D or 2D array (images x metrics)
+        win_type, a scipy window. For 'gaussian' the window has standard
+            deviation win_std
+        
+        Returns an array with the same shape as values
+    '''
+    from scipy import signal
+    values = np.asarray(values, dtype=float)
+    shape = values.shape
+    values = values.reshape(shape[0], -1)
+    if win_type == 'gaussian':
+        window = signal.get_window((win_type, win_std), win_dur, fftbins=False)
+    else:
+        window = signal.get_window(win_type, win_dur, fftbins=False)
+    valid = ~np.isnan(values)
+
+    # Weighted sums over the window centered on each image
+    start = win_dur - 1 - win_dur//2
+    def window_sum(x):
+        return signal.fftconvolve(x, window[::-1,None], mode='full', 
+            axes=0)[start:start+shape[0]]
+    filled = np.where(valid, values, 0)
+    total = window_sum(filled)
+    weight = window_sum(valid.astype(float))
+
+    # Count the values in each window exactly, for min_periods
+    cumulative = np.concatenate([np.zeros((1,values.shape[1]),dtype=int),
+        np.cumsum(valid, axis=0)])
+    first = np.clip(np.arange(shape[0]) - win_dur//2, 0, shape[0])
+    last = np.clip(np.arange(shape[0]) + win_dur - win_dur//2, 0, shape[0])
+    count = cumulative[last] - cumulative[first]
+
+    # Recompute windows with a small weight with direct sums
+    enough = count >= min_periods
+    rows, columns = np.nonzero(enough & (weight < small_weight*window.max()))
+    offsets = np.arange(win_dur) - win_dur//2
+    chunk = max(1, 2**22//win_dur)
+    for i in range(0, len(rows), chunk):
+        index = rows[i:i+chunk,np.newaxis] + offsets
+        inside = (index >= 0) & (index < shape[0])
+        index = np.clip(index, 0, shape[0]-1)
+        column = columns[i:i+chunk,np.newaxis]
+        total[rows[i:i+chunk], columns[i:i+chunk]] = \
+            np.sum(np.where(inside, filled[index, column], 0)*window, axis=1)
+        weight[rows[i:i+chunk], columns[i:i+chunk]] = \
+            np.sum((inside & valid[index, column])*window, axis=1)
+
+    mean = np.full(values.shape, np.nan)
+    mean[enough] = total[enough]/weight[enough]
+    mean = np.clip(mean, np.min(np.where(valid, values, np.inf), axis=0),
+        np.max(np.where(valid, values, -np.inf), axis=0))
+    return mean.reshape(shape)
+
+
 def annotate_image_rolling_metrics(session,win_dur=640, win_type='gaussian',win_std=60):
     '''
         Get rolling image level metrics for lick rate, reward rate, and bout_rate
@@ -270,103 +366,92 @@ def annotate_image_rolling_metrics(session,win_dur=640, win_type='gaussian',win_
             RT,                     (float)
             engaged,                (boolean)
     '''
-    # Get Lick Rate / second
-    session.stimulus_presentations_np['num_licks'] = [len(x) for x in \
-        session.stimulus_presentations_np['licks']]
-    session.stimulus_presentations_np['lick_rate'] = \
-        session.stimulus_presentations_np['num_licks'].\
-        rolling(win_dur, min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std)/.75
-
-    # Get Reward Rate / second
-    session.stimulus_presentations_np['rewarded'] = [len(this_reward) > 0 \
-        for this_reward in session.stimulus_presentations_np['rewards']]
-    session.stimulus_presentations_np['reward_rate'] = \
-        session.stimulus_presentations_np['rewarded'].\
-        rolling(win_dur,min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std)/.75
-
-    # Get Bout Rate / second
-    session.stimulus_presentations_np['bout_rate'] = \
-        session.stimulus_presentations_np['bout_start'].\
-        rolling(win_dur,min_periods=1, win_type=win_type,center=True).\
-        mean(std=win_std)/.75
+    stimulus = session.stimulus_presentations_np
+
+    # Get the offsets and counts of licks and rewards on each image
+    lick_times, lick_offsets, num_licks = pgt.get_image_events(session,'licks')
+    reward_times, reward_offsets, num_rewards = pgt.get_image_events(session,
+        'rewards')
+    rewarded = num_rewards > 0
+    is_change = stimulus['is_change'].values.astype(bool)
+    bout_start = stimulus['bout_start'].values.astype(bool)
+    licked = stimulus['licked'].values.astype(bool)
+
+    # Build the indicator of each metric, NaN on images that are not counted
+    # hit_bout, whether this is the start of a rewarded bout
+    # change_with_lick, whether this change had a reward
+    # change_without_lick, whether this change did not have a reward 
+    # non_change_with_lick, whether this non-change had a lick bout start
+    # non_change_without_lick, whether this non-change did not have a lick 
+    indicators = {
+        'num_licks':num_licks,
+        'rewarded':rewarded,
+        'bout_start':bout_start,
+        'hit_bout':np.where(bout_start, rewarded, np.nan),
+        'change_with_lick':np.where(is_change, rewarded, np.nan),
+        'change_without_lick':np.where(is_change, ~rewarded, np.nan),
+        'non_change_with_lick':np.where(is_change, np.nan, bout_start),
+        'non_change_without_lick':np.where(is_change | (licked & ~bout_start),
+            np.nan, ~bout_start),
+        }
+
+    # Smooth every indicator in one pass
+    rates = rolling_mean(np.column_stack(list(indicators.values())), 
+        win_dur, win_type=win_type, win_std=win_std)
+    rates = dict((key, rates[:,dex]) for dex, key in enumerate(indicators))
+
+    # Lick, reward, and bout rates / second
+    stimulus['num_licks'] = num_licks
+    stimulus['lick_rate'] = rates['num_licks']/.75
+    stimulus['rewarded'] = rewarded
+    stimulus['reward_rate'] = rates['rewarded']/.75
+    stimulus['bout_rate'] = rates['bout_start']/.75
 
     # Get Hit Fraction. % of lick bouts that are rewarded
-    session.stimulus_presentations_np['hit_bout'] = \
-        [np.nan if (not x[0]) else 1 if (x[1]==1) else 0 
-        for x in zip(session.stimulus_presentations_np['bout_start'], \
-        session.stimulus_presentations_np['rewarded'])]
-    session.stimulus_presentations_np['lick_hit_fraction'] = \
-        session.stimulus_presentations_np['hit_bout'].\
-        rolling(win_dur,min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std).fillna(0)
-    
+    stimulus['hit_bout'] = indicators['hit_bout']
+    stimulus['lick_hit_fraction'] = np.nan_to_num(rates['hit_bout'], nan=0)
+
     # Get Hit Rate, % of change images with licks
-    session.stimulus_presentations_np['change_with_lick'] = \
-        [np.nan if (not x[0]) else 1 if (x[1]) else 0 
-        for x in zip(session.stimulus_presentations_np['is_change'],\
-        session.stimulus_presentations_np['rewarded'])]
-    session.stimulus_presentations_np['hit_rate'] = \
-        session.stimulus_presentations_np['change_with_lick'].\
-        rolling(win_dur, min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std).fillna(0)
-  
+    stimulus['change_with_lick'] = indicators['change_with_lick']
+    stimulus['hit_rate'] = np.nan_to_num(rates['change_with_lick'], nan=0)
+
     # Get Miss Rate, % of change images without licks
-    session.stimulus_presentations_np['change_without_lick'] = \
-        [np.nan if (not x[0]) else 0 if (x[1]) else 1 
-        for x in zip(session.stimulus_presentations_np['is_change'],\
-        session.stimulus_presentations_np['rewarded'])]
-    session.stimulus_presentations_np['miss_rate'] = \
-        session.stimulus_presentations_np['change_without_lick'].\
-        rolling(win_dur,min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std).fillna(0)
+    stimulus['change_without_lick'] = indicators['change_without_lick']
+    stimulus['miss_rate'] = np.nan_to_num(rates['change_without_lick'], nan=0)
 
     # Get False Alarm Rate, % of non-change images with licks
-    session.stimulus_presentations_np['non_change_with_lick'] = \
-        [np.nan if (x[0]) else 1 if (x[1]) else 0 
-        for x in zip(session.stimulus_presentations_np['is_change'],\
-        session.stimulus_presentations_np['bout_start'])]
-    session.stimulus_presentations_np['false_alarm_rate'] = \
-        session.stimulus_presentations_np['non_change_with_lick'].\
-        rolling(win_dur,min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std).fillna(0)
+    stimulus['non_change_with_lick'] = indicators['non_change_with_lick']
+    stimulus['false_alarm_rate'] = np.nan_to_num(rates['non_change_with_lick'],
+        nan=0)
 
     # Get Correct Reject Rate, % of non-change images without licks
-    session.stimulus_presentations_np['non_change_without_lick'] = \
-        [np.nan if (x[0] or (x[2] and not x[1])) else 0 if (x[1]) else 1 
-        for x in zip(session.stimulus_presentations_np['is_change'],\
-        session.stimulus_presentations_np['bout_start'],\
-        session.stimulus_presentations_np['licked'])]
-    session.stimulus_presentations_np['correct_reject_rate'] = \
-        session.stimulus_presentations_np['non_change_without_lick'].\
-        rolling(win_dur,min_periods=1,win_type=win_type,center=True).\
-        mean(std=win_std).fillna(0)
+    stimulus['non_change_without_lick'] = indicators['non_change_without_lick']
+    stimulus['correct_reject_rate'] = np.nan_to_num(
+        rates['non_change_without_lick'], nan=0)
 
     # Get dPrime and Criterion metrics on an image level
     # Computing the criterion to be negative
+    from scipy.stats import norm
     Z = norm.ppf
-    session.stimulus_presentations_np['d_prime'] = \
-        Z(np.clip(session.stimulus_presentations_np['hit_rate'],0.01,0.99)) - \
-        Z(np.clip(session.stimulus_presentations_np['false_alarm_rate'],0.01,0.99)) 
-    session.stimulus_presentations_np['criterion'] = \
-        0.5*(Z(np.clip(session.stimulus_presentations_np['hit_rate'],0.01,0.99)) + \
-        Z(np.clip(session.stimulus_presentations_np['false_alarm_rate'],0.01,0.99)))
+    stimulus['d_prime'] = \
+        Z(np.clip(stimulus['hit_rate'],0.01,0.99)) - \
+        Z(np.clip(stimulus['false_alarm_rate'],0.01,0.99)) 
+    stimulus['criterion'] = \
+        0.5*(Z(np.clip(stimulus['hit_rate'],0.01,0.99)) + \
+        Z(np.clip(stimulus['false_alarm_rate'],0.01,0.99)))
  
     # Add Reaction Time
-    session.stimulus_presentations_np['RT'] = \
-        [x[0][0]-x[1] if (len(x[0]) > 0) &x[2] else np.nan \
-        for x in zip(session.stimulus_presentations_np['licks'], \
-        session.stimulus_presentations_np['start_time'], \
-        session.stimulus_presentations_np['bout_start'])]
+    has_rt = (num_licks > 0) & bout_start
+    RT = np.full(len(num_licks), np.nan)
+    RT[has_rt] = lick_times[lick_offsets[has_rt]] - \
+        stimulus['start_time'].values[has_rt]
+    stimulus['RT'] = RT
 
     # Add engagement classification
     reward_threshold = pgt.get_engagement_threshold()
     lick_bout_threshold = pgt.get_engagement_lick_threshold()
-    session.stimulus_presentations_np['engaged'] = \
-        [(x[0] > reward_threshold) or (x[1] > lick_bout_threshold) for x in \
-            zip(session.stimulus_presentations_np['reward_rate'],\
-            session.stimulus_presentations_np['bout_rate'])]
+    stimulus['engaged'] = (stimulus['reward_rate'].values > reward_threshold) | \
+        (stimulus['bout_rate'].values > lick_bout_threshold)
 
     # QC
     rewards_sp = session.stimulus_presentations_np.rewarded.sum()
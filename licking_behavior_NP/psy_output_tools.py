@@ -1,5 +1,7 @@
 import os
 import json
+import shutil
+import hashlib
 import subprocess
 import numpy as np
 import pandas as pd
@@ -7,8 +9,44 @@ from tqdm import tqdm
 
 import licking_behavior_NP.psy_tools as ps
 import licking_behavior_NP.psy_general_tools as pgt
-
-BEHAVIOR_DIR = '/allen/programs/braintv/workgroups/nc-ophys/alex.piet/NP/behavior/'
+import licking_behavior_NP.psy_storage_tools as pst
+
+BEHAVIOR_DIR = pgt.BEHAVIOR_DIR
+
+# The image by image columns of the summary tables are matrices with one row
+# per session, padded or truncated to this many images. See pgt.get_clean_rate
+TIME_ALIGNED_LENGTH = 4800
+TIME_ALIGNED_STRING_COLUMNS = ['image_name']
+TIME_ALIGNED_STRING_DTYPE = '<U16'
+
+# Session level metrics computed along with the image by image columns
+TIME_ALIGNED_SESSION_METRICS = ['num_hits','num_miss','num_omission_licks',
+    'num_post_omission_licks','num_late_task_licks','num_changes',
+    'num_omissions','num_image_false_alarm','num_image_correct_reject',
+    'num_lick_bouts','lick_fraction','omission_lick_fraction',
+    'post_omission_lick_fraction','lick_hit_fraction','trial_hit_fraction',
+    'strategy_weight_index']
+
+# dtypes of the tables saved with one file per session, see 
+# build_partitioned_table
+TABLE_SCHEMAS = {
+    'change_table':{**pgt.SESSION_TABLE_SCHEMAS['strategy_df'],
+        'behavior_session_id':'int64'},
+    'licks_table':{**pgt.SESSION_TABLE_SCHEMAS['licks_df'],
+        'behavior_session_id':'int64'},
+    }
+
+# Columns of the licks table that build_bout_table uses
+BOUT_TABLE_COLUMNS = ['behavior_session_id','bout_number','timestamps',
+    'pre_ili','post_ili','rewarded','num_rewards','bout_rewarded',
+    'bout_num_rewards']
+
+# The session files each summary table is built from, see get_input_manifest
+TABLE_INPUTS = {
+    'summary_table':['fits','metrics','strategy_df'],
+    'change_table':['strategy_df'],
+    'licks_table':['licks_df'],
+    }
 
 def get_model_versions(vrange=[20,22]):
     '''
@@ -51,14 +89,12 @@ def get_model_inventory(version):
     manifest = pgt.get_np_manifest().copy()
 
     # Check what is actually available. 
-    fit_directory=pgt.get_directory(version_num,subdirectory='fits')
-    df_directory=pgt.get_directory(version_num,subdirectory='strategy_df') 
     for index, row in manifest.iterrows():
-        fit_filename = fit_directory + str(row.behavior_session_id) + ".pkl"         
-        manifest.at[index, 'behavior_fit_available'] = os.path.exists(fit_filename)
-
-        summary_filename = df_directory+ str(row.behavior_session_id)+'.csv'
-        manifest.at[index, 'strategy_df_available'] = os.path.exists(summary_filename)
+        manifest.at[index, 'behavior_fit_available'] = \
+            pgt.fit_exists(row.behavior_session_id, version_num)
+        manifest.at[index, 'strategy_df_available'] = \
+            pgt.get_session_table_filename(row.behavior_session_id, version_num,
+            'strategy_df') is not None
 
     # Summarize inventory for this model version
     inventory = {}    
@@ -107,7 +143,7 @@ def make_version(VERSION):
     root_directory  = BEHAVIOR_DIR 
     directory = root_directory+'psy_fits_v'+str(VERSION)
     if not os.path.isdir(directory):
-        os.mkdir(directory)
+        os.makedirs(directory)
         os.mkdir(directory+'/figures_summary')
         os.mkdir(directory+'/figures_sessions')
         os.mkdir(directory+'/figures_training')
@@ -116,6 +152,8 @@ def make_version(VERSION):
         os.mkdir(directory+'/session_licks_df')
         os.mkdir(directory+'/summary_data')
         os.mkdir(directory+'/psytrack_logs')
+        os.mkdir(directory+'/session_checkpoints')
+        os.mkdir(directory+'/session_metrics')
     else:
         print('directory already exists')
     
@@ -126,10 +164,11 @@ def make_version(VERSION):
     print('Done!')
 
 def save_version_parameters(VERSION):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
     git_branch = subprocess.check_output(['git','branch','--show-current'],\
-        cwd='/allen/programs/braintv/workgroups/nc-ophys/alex.piet/NP/licking_behavior_NP/licking_behavior_NP').strip().decode() 
+        cwd=repo_dir).strip().decode() 
     git_hash = subprocess.check_output(['git','rev-parse','--short','HEAD'],\
-        cwd='/allen/programs/braintv/workgroups/nc-ophys/alex.piet/NP/licking_behavior_NP/licking_behavior_NP').strip().decode()
+        cwd=repo_dir).strip().decode()
     format_options = {
                 'timing0/1':True,
                 'mean_center':True,
@@ -137,6 +176,8 @@ def save_version_parameters(VERSION):
                 'timing_params_session':[-5,4],
                 'ignore_trial_errors':False,
                 'num_cv_folds':10,
+                'warm_start':False,
+                'fit_backend':'psytrack',
                 'git_commit_hash': git_hash,
                 'git_branch':git_branch
                 }
@@ -147,22 +188,63 @@ def save_version_parameters(VERSION):
 
 def get_np_summary_table(version):
     model_dir = pgt.get_directory(version,subdirectory='summary')
-    return pd.read_pickle(model_dir+'_summary_table.pkl')
+    return load_summary_table(model_dir+'_summary_table.pkl',
+        get_time_aligned_directory(version, 'summary_table'))
+
+def load_summary_table(filename, directory):
+    '''
+        Loads the scalar columns of a summary table, and adds views of the
+        image by image matrices in directory. Tables saved before the 
+        matrices existed hold the image by image columns in the pickle
+    '''
+    summary_df = pd.read_pickle(filename)
+    if os.path.isfile(directory+'index.json'):
+        summary_df = load_time_aligned_columns(summary_df, directory)
+    return summary_df
+
+def save_summary_table(summary_df, filename, directory):
+    '''
+        Saves the scalar columns of a summary table. The image by image 
+        columns are saved as matrices in directory, see 
+        add_time_aligned_session_info
+    '''
+    with open(directory+'index.json','r') as json_file:
+        columns = json.load(json_file)['columns']
+    summary_df.drop(columns=columns).to_pickle(filename)
 
-def build_summary_table(version):
+def build_summary_table(version, workers=1, incremental=True):
     ''' 
         Saves out the model summary table as a csv file 
+
+        incremental (bool), if True, only reads the image by image information
+            of sessions that are new or whose inputs changed since the last
+            build, see get_sessions_to_update. Use False to rebuild every
+            session, for example after changing how the table is computed
     '''
     print('Building Summary Table')
     print('Loading Model Fits')
-    summary_df = build_core_table(version)
+    summary_df = build_core_table(version, workers=workers)
     summary_df = build_strategy_labels(summary_df)
 
     #print('Creating strategy matched subset')
     #summary_df = build_strategy_matched_subset(summary_df)
 
     print('Loading image by image information')
-    summary_df = add_time_aligned_session_info(summary_df,version)
+    update, fingerprints = get_sessions_to_update(summary_df, version, 
+        'summary_table', incremental)
+    previous_df = None
+    if len(update) < len(summary_df):
+        previous_df = get_np_summary_table(version)
+        previous_df = previous_df[~previous_df['behavior_session_id'].isin(update)]
+        if 'num_images' not in previous_df:
+            # Saved before the image by image matrices, rebuild every session
+            previous_df = None
+    summary_df, crashed = add_time_aligned_session_info(summary_df,version,
+        previous_df=previous_df)
+
+    # Crashed sessions are not recorded, so the next build retries them
+    for bsid in crashed:
+        fingerprints.pop(str(bsid), None)
 
     print('Adding engagement information') 
     summary_df = add_engagement_metrics(summary_df) 
@@ -170,48 +252,29 @@ def build_summary_table(version):
 
     print('Saving')
     model_dir = pgt.get_directory(version,subdirectory='summary') 
-    summary_df.to_pickle(model_dir+'_summary_table.pkl')
+    save_summary_table(summary_df, model_dir+'_summary_table.pkl',
+        get_time_aligned_directory(version, 'summary_table'))
+    save_input_manifest(version, 'summary_table', fingerprints)
 
     return summary_df 
 
-def build_core_table(version):
+def build_core_table(version, workers=1):
     '''
         Builds a summary_df of model results, each row is a behavioral session. 
+        Reads the session metrics saved with each fit, see 
+        ps.compute_session_metrics
 
         version (int), behavioral model version        
+        workers (int), number of sessions to load concurrently
     
     '''
     summary_df = pgt.get_np_manifest().copy()
 
-    summary_df['behavior_fit_available'] = False 
-    for index, row in tqdm(summary_df.iterrows(),total=summary_df.shape[0]):
-        try:
-            fit = ps.load_fit(row.behavior_session_id,version=version)
-        except:
-            summary_df.at[index,'behavior_fit_available'] = False
-        else:
-            summary_df.at[index,'behavior_fit_available'] = True 
-            summary_df.at[index,'session_roc'] = ps.compute_model_roc(fit)
-            
-            # Get Strategy indices
-            model_dex, taskdex,timingdex = ps.get_timing_index_fit(fit) 
-            summary_df.at[index,'strategy_dropout_index'] = model_dex
-            summary_df.at[index,'visual_only_dropout_index'] = taskdex
-            summary_df.at[index,'timing_only_dropout_index'] = timingdex
-
-            # For each strategy add the hyperparameter, dropout score, and average weight
-            dropout_dict_cv = ps.get_session_dropout(fit,cross_validation=True)
-            dropout_dict_ev = ps.get_session_dropout(fit,cross_validation=False)
-            sigma = fit['hyp']['sigma']
-            wMode = fit['wMode']
-            weights = ps.get_weights_list(fit['weights'])
-            for dex, weight in enumerate(weights):
-                summary_df.at[index, 'prior_'+weight] =sigma[dex]
-            for dex, weight in enumerate(weights):
-                summary_df.at[index, 'dropout_cv_'+weight] = dropout_dict_cv[weight]
-                summary_df.at[index, 'dropout_'+weight] = dropout_dict_ev[weight]
-            for dex, weight in enumerate(weights):
-                summary_df.at[index, 'avg_weight_'+weight] = np.mean(wMode[dex,:])
+    metrics_df, available = ps.load_session_metrics_table(
+        summary_df['behavior_session_id'].values, version, workers=workers)
+    summary_df['behavior_fit_available'] = available
+    metrics_df.index = summary_df.index
+    summary_df = pd.concat([summary_df, metrics_df], axis=1)
 
     # Return only for sessions with fits
     print(str(len(summary_df.query('not behavior_fit_available')))+\
@@ -230,10 +293,6 @@ def add_engagement_metrics(summary_df,min_engaged_fraction=.05):
         Adds average value of columns for engaged and disengaged periods
     '''
 
-    # Add Engaged specific metrics
-    summary_df['fraction_engaged'] = \
-        [np.nanmean(summary_df.loc[x]['engaged']) for x in summary_df.index.values]
-
     # Add average value of strategy weights split by engagement stats
     columns = {
         'task0':'visual',
@@ -241,15 +300,45 @@ def add_engagement_metrics(summary_df,min_engaged_fraction=.05):
         'omissions':'omissions',
         'omissions1':'omissions1',
         'bias':'bias'}
-    for k in columns.keys():  
-        summary_df[columns[k]+'_weight_index_engaged'] = \
-        [np.nanmean(summary_df.loc[x]['weight_'+k][summary_df.loc[x]['engaged'] == True]) 
-            if summary_df.loc[x]['fraction_engaged'] > min_engaged_fraction else np.nan 
-            for x in summary_df.index.values]
-        summary_df[columns[k]+'_weight_index_disengaged'] = \
-        [np.nanmean(summary_df.loc[x]['weight_'+k][summary_df.loc[x]['engaged'] == False])
-            if summary_df.loc[x]['fraction_engaged'] < 1-min_engaged_fraction else np.nan 
-            for x in summary_df.index.values]
+    return add_engagement_split_metrics(summary_df, columns, 
+        min_engaged_fraction)
+
+def add_engagement_split_metrics(summary_df, weight_columns, 
+    min_engaged_fraction=.05):
+    '''
+        Adds the fraction of each session that was engaged, and the average
+        of the image by image columns over the engaged and disengaged images
+        of each session. Engaged averages are NaN for sessions engaged less
+        than min_engaged_fraction, and disengaged averages are NaN for 
+        sessions engaged more than 1-min_engaged_fraction. 
+
+        Each average is one masked reduction over the (sessions x images) 
+        matrix of a column, see get_time_aligned_matrix
+    
+        weight_columns (dict), maps each strategy to the name of its 
+            <name>_weight_index_engaged and _disengaged columns
+    '''
+
+    # Images with a NaN engagement state are neither engaged or disengaged
+    engaged_matrix = get_time_aligned_matrix(summary_df,'engaged').astype(float)
+    engaged = engaged_matrix == 1
+    disengaged = engaged_matrix == 0
+
+    # Add Engaged specific metrics
+    fraction_engaged = get_masked_nanmean(engaged_matrix, 
+        np.ones(engaged_matrix.shape, dtype=bool))
+    summary_df['fraction_engaged'] = fraction_engaged
+    use_engaged = fraction_engaged > min_engaged_fraction
+    use_disengaged = fraction_engaged < 1-min_engaged_fraction
+
+    # Add average value of strategy weights split by engagement stats
+    for k in weight_columns.keys():
+        values = get_time_aligned_matrix(summary_df, 'weight_'+k).astype(float)
+        summary_df[weight_columns[k]+'_weight_index_engaged'] = \
+            np.where(use_engaged, get_masked_nanmean(values, engaged), np.nan)
+        summary_df[weight_columns[k]+'_weight_index_disengaged'] = \
+            np.where(use_disengaged, get_masked_nanmean(values, disengaged), 
+            np.nan)
     summary_df['strategy_weight_index_engaged'] = \
         summary_df['visual_weight_index_engaged'] -\
         summary_df['timing_weight_index_engaged']
@@ -258,50 +347,78 @@ def add_engagement_metrics(summary_df,min_engaged_fraction=.05):
         summary_df['timing_weight_index_disengaged']
 
     # Add average value of columns split by engagement state
-    columns = {'lick_bout_rate','reward_rate','lick_hit_fraction_rate','hit',
-        'miss','image_false_alarm','image_correct_reject','RT'}
+    columns = ['lick_bout_rate','reward_rate','lick_hit_fraction_rate','hit',
+        'miss','image_false_alarm','image_correct_reject','RT']
     for column in columns: 
+        values = get_time_aligned_matrix(summary_df, column).astype(float)
         summary_df[column+'_engaged'] = \
-        [np.nanmean(summary_df.loc[x][column][summary_df.loc[x]['engaged'] == True]) 
-            if summary_df.loc[x]['fraction_engaged'] > min_engaged_fraction else np.nan
-            for x in summary_df.index.values]
+            np.where(use_engaged, get_masked_nanmean(values, engaged), np.nan)
         summary_df[column+'_disengaged'] = \
-        [np.nanmean(summary_df.loc[x][column][summary_df.loc[x]['engaged'] == False]) 
-            if (summary_df.loc[x]['fraction_engaged'] < 1-min_engaged_fraction) &
-            (not np.all(np.isnan(summary_df.loc[x][column][summary_df.loc[x]['engaged']==False]))) 
-            else np.nan for x in summary_df.index.values]
+            np.where(use_disengaged, get_masked_nanmean(values, disengaged), 
+            np.nan)
     return summary_df
 
-def add_time_aligned_session_info(summary_df,version):
+def get_masked_nanmean(values, mask):
+    '''
+        Returns the average of each row of values over the images in mask,
+        ignoring NaNs. Rows without any images are NaN 
+    '''
+    mask = mask & ~np.isnan(values)
+    count = np.sum(mask, axis=1)
+    total = np.sum(values, axis=1, where=mask)
+    return np.divide(total, count, out=np.full(len(count), np.nan), 
+        where=count > 0)
+
+def add_time_aligned_session_info(summary_df,version,table='summary_table',
+    image_column='image_name',previous_df=None):
+    '''
+        Adds the image by image information of each session. Each column is 
+        saved as one (sessions x images) memory-mapped matrix, see 
+        save_time_aligned_matrices, and each row of summary_df holds a view
+        of its row in the matrix
+
+        table (str), the name of the summary table the matrices belong to
+        image_column (str), the column that identifies the image
+        previous_df (dataframe), rows of a previous build of this table. 
+            Sessions in previous_df are copied from it instead of being read
+            from their strategy_df
+
+        Returns summary_df, and a list of the sessions that crashed
+    '''
     
-    # Initializing empty columns
+    # Initializing empty matrices
     weight_columns = pgt.get_strategy_list(version)
-    columns = {'hit','miss','image_false_alarm','image_correct_reject',
+    columns = ['hit','miss','image_false_alarm','image_correct_reject',
         'is_change', 'omitted', 'lick_bout_rate','reward_rate','RT','engaged',
-        'lick_bout_start','image_name'} 
-    for column in weight_columns:
-        summary_df['weight_'+column] = [[]]*len(summary_df)
-    for column in columns:
-        summary_df[column] = [[]]*len(summary_df)      
-    summary_df['strategy_weight_index_by_image'] = [[]]*len(summary_df)
-    summary_df['lick_hit_fraction_rate'] = [[]]*len(summary_df)
+        'lick_bout_start',image_column]
+    directory = get_time_aligned_directory(version, table)
+    matrices = build_time_aligned_matrices(directory, len(summary_df), 
+        ['weight_'+x for x in weight_columns] + columns + 
+        ['strategy_weight_index_by_image','lick_hit_fraction_rate'])
+    num_images = np.zeros(len(summary_df),dtype=int)
+    strategy_columns = weight_columns + columns + ['lick_hit_fraction',
+        'rewarded','licked','task0','timing1D']
+    if previous_df is None:
+        previous_df = summary_df.iloc[0:0]
+    previous_df = previous_df.set_index('behavior_session_id')
 
-    crash = 0
-    for index, row in tqdm(summary_df.iterrows(),total=summary_df.shape[0]):
+    crashed = []
+    for dex, (index, row) in enumerate(tqdm(summary_df.iterrows(),
+        total=summary_df.shape[0])):
+        if row.behavior_session_id in previous_df.index:
+            previous = previous_df.loc[row.behavior_session_id]
+            for column in TIME_ALIGNED_SESSION_METRICS:
+                summary_df.at[index, column] = previous[column]
+            num_images[dex] = previous['num_images']
+            for column in matrices:
+                set_time_aligned_row(matrices[column], dex, previous[column])
+            continue
         try:
-            strategy_dir = pgt.get_directory(version, subdirectory='strategy_df')
-            session_df = pd.read_csv(strategy_dir+str(row.behavior_session_id)+'.csv')
+            session_df = pgt.load_session_table(row.behavior_session_id, 
+                version, 'strategy_df', columns=strategy_columns)
             if version <=20:
                 session_df = session_df_backwards_compatability(session_df)
-        except Exception as e:
-            crash +=1
-            print(e)
-            for column in weight_columns:
-                summary_df.at[index, 'weight_'+column] = np.array([np.nan]*4800)
-            for column in columns:
-                summary_df.at[index, column] = np.array([np.nan]*4800) 
-            summary_df.at[index, column] = np.array([np.nan]*4800)
-        else: 
+
             # Add session level metrics
             summary_df.at[index,'num_hits'] = session_df['hit'].sum()
             summary_df.at[index,'num_miss'] = session_df['miss'].sum()
@@ -333,25 +450,148 @@ def add_time_aligned_session_info(summary_df,version):
                 session_df['rewarded'].sum()/session_df['is_change'].sum() 
 
             # Add time aligned information
+            num_images[dex] = len(session_df)
             for column in weight_columns:
-                summary_df.at[index, 'weight_'+column] = \
-                    pgt.get_clean_rate(session_df[column].values)
+                set_time_aligned_row(matrices['weight_'+column], dex,
+                    session_df[column].values)
             for column in columns:
-                summary_df.at[index, column] = \
-                    pgt.get_clean_rate(session_df[column].values)
-            summary_df.at[index,'lick_hit_fraction_rate'] = \
-                pgt.get_clean_rate(session_df['lick_hit_fraction'].values)
+                set_time_aligned_row(matrices[column], dex, 
+                    session_df[column].values)
+            set_time_aligned_row(matrices['lick_hit_fraction_rate'], dex,
+                session_df['lick_hit_fraction'].values)
 
             # Compute strategy indexes
-            summary_df.at[index,'strategy_weight_index_by_image'] = \
-                pgt.get_clean_rate(session_df['task0'].values) - \
-                pgt.get_clean_rate(session_df['timing1D'].values) 
+            set_time_aligned_row(matrices['strategy_weight_index_by_image'], dex,
+                session_df['task0'].values - session_df['timing1D'].values)
             summary_df.at[index,'strategy_weight_index'] = \
-                np.nanmean(summary_df.at[index,'strategy_weight_index_by_image'])
+                np.nanmean(matrices['strategy_weight_index_by_image'][dex])
+        except Exception as e:
+            # The rows of crashed sessions are left as NaN
+            crashed.append(row.behavior_session_id)
+            print('{} crashed: {}'.format(row.behavior_session_id, e))
+            for column in TIME_ALIGNED_SESSION_METRICS:
+                summary_df.at[index, column] = np.nan
+            num_images[dex] = 0
+            clear_time_aligned_row(matrices, dex)
 
-    if crash > 0:
-        print(str(crash) + ' sessions crashed')
-    return summary_df 
+    if len(crashed) > 0:
+        print(str(len(crashed)) + ' sessions crashed')
+
+    summary_df['num_images'] = num_images
+    save_time_aligned_matrices(directory, matrices, summary_df)
+    return load_time_aligned_columns(summary_df, directory), crashed
+
+def get_time_aligned_directory(version, table='summary_table'):
+    '''
+        Returns the directory of the image by image matrices of a summary table
+    '''
+    model_dir = pgt.get_directory(version,subdirectory='summary')
+    return model_dir+'_'+table+'_time_aligned/'
+
+def build_time_aligned_matrices(directory, num_sessions, columns, 
+    length=TIME_ALIGNED_LENGTH):
+    '''
+        Returns a dictionary of empty (num_sessions x length) matrices for
+        each column, memory-mapped to .npy files in a temporary directory next
+        to directory, see save_time_aligned_matrices. Numeric columns are float
+        and padded with NaN, string columns are padded with ''
+    '''
+    temp_directory = directory[:-1]+'_tmp/'
+    if os.path.isdir(temp_directory):
+        shutil.rmtree(temp_directory)
+    os.makedirs(temp_directory)
+
+    matrices = {}
+    for column in columns:
+        if column in TIME_ALIGNED_STRING_COLUMNS:
+            dtype, fill = TIME_ALIGNED_STRING_DTYPE, ''
+        else:
+            dtype, fill = np.float64, np.nan
+        matrices[column] = np.lib.format.open_memmap(temp_directory+column+'.npy',
+            mode='w+', dtype=dtype, shape=(num_sessions, length))
+        matrices[column][:] = fill
+    return matrices
+
+def set_time_aligned_row(matrix, row, values):
+    '''
+        Copies the first images of values into a row of matrix, the rest of
+        the row keeps its padding. See pgt.get_clean_rate
+    '''
+    values = values[0:matrix.shape[1]]
+    if (matrix.dtype.kind == 'U') and \
+        (np.asarray(values,dtype=str).dtype.itemsize > matrix.dtype.itemsize):
+        raise Exception('Strings are longer than '+TIME_ALIGNED_STRING_DTYPE)
+    matrix[row, 0:len(values)] = values
+
+def clear_time_aligned_row(matrices, row):
+    '''
+        Resets a row of each matrix to its padding, see 
+        build_time_aligned_matrices
+    '''
+    for column in matrices:
+        if matrices[column].dtype.kind == 'U':
+            matrices[column][row] = ''
+        else:
+            matrices[column][row] = np.nan
+
+def save_time_aligned_matrices(directory, matrices, summary_df):
+    '''
+        Saves the matrices from build_time_aligned_matrices in directory, 
+        along with an index of the behavior_session_id and number of images of
+        each row.
+
+        The files are moved into place once they are complete, so summary
+        tables that are already loaded keep reading from the previous files
+    '''
+    temp_directory = directory[:-1]+'_tmp/'
+    for column in matrices:
+        matrices[column].flush()
+    index = {
+        'columns':list(matrices.keys()),
+        'behavior_session_id':[int(x) for x in summary_df['behavior_session_id']],
+        'num_images':[int(x) for x in summary_df['num_images']],
+        'length':matrices[list(matrices.keys())[0]].shape[1]
+        }
+    with open(temp_directory+'index.json','w') as json_file:
+        json.dump(index, json_file)
+
+    os.makedirs(directory, exist_ok=True)
+    for filename in os.listdir(temp_directory):
+        os.replace(temp_directory+filename, directory+filename)
+    shutil.rmtree(temp_directory)
+
+def load_time_aligned_columns(summary_df, directory):
+    '''
+        Adds the image by image columns saved in directory to summary_df. 
+        Each matrix is memory-mapped, and each row of summary_df holds a view
+        of its row, so only the images that are used are read from disk. 
+        Changing a view does not change the saved matrix.
+    '''
+    with open(directory+'index.json','r') as json_file:
+        index = json.load(json_file)
+    rows = pd.Index(index['behavior_session_id'])\
+        .get_indexer(summary_df['behavior_session_id'])
+    if np.any(rows < 0):
+        raise Exception('Sessions are missing from the image by image '+\
+            'matrices in '+directory)
+    summary_df['num_images'] = np.array(index['num_images'])[rows]
+
+    for column in index['columns']:
+        matrix = np.load(directory+column+'.npy', mmap_mode='c')
+        views = np.empty(len(rows), dtype=object)
+        for dex, row in enumerate(rows):
+            views[dex] = matrix[row]
+        summary_df[column] = views
+    return summary_df
+
+def get_time_aligned_matrix(summary_df, column):
+    '''
+        Returns a (sessions x images) matrix of an image by image column, 
+        with the sessions in the order of summary_df. Averages across sessions
+        are then one reduction: 
+        np.nanmean(po.get_time_aligned_matrix(summary_df,'engaged'),axis=0)
+    '''
+    return np.vstack(summary_df[column].values)
 
 def session_df_backwards_compatability(session_df):
     '''
@@ -442,103 +682,328 @@ def build_strategy_matched_subset(summary_df,bin_width=5,bin_range=[-50,50]):
 
     return summary_df
 
-def build_change_table(summary_df, version):
-    ''' 
+def build_change_table(summary_df, version, incremental=True, load=True):
+    '''
         Builds a table of all image changes in the dataset
-        
+
         Loads the session_df for each behavior_session_id in summary_df
-        Saves the change table as "_change_table.pkl"            
+        Saves the change table in "_change_table/", with one file per
+        session, see build_partitioned_table
+
+        incremental (bool), if True, only loads sessions that are new or whose
+            strategy_df changed since the last build. See get_sessions_to_update
+        load (bool), if True, returns the change table. Otherwise returns None,
+            and only one session is in memory at a time
     '''
-    # Build a dataframe for each session
-    dfs = []
-    crashed = []
     print('Processing Sessions')
-    for index, row in tqdm(summary_df.iterrows(),total=summary_df.shape[0]):
-        try:
-            strategy_dir = pgt.get_directory(version, subdirectory='strategy_df')
-            session_df = pd.read_csv(strategy_dir+str(row.behavior_session_id)+'.csv')
-            df = session_df.query('is_change').reset_index(drop=True)
-            df['behavior_session_id'] = row.behavior_session_id
-            df = df.rename(columns={'image_name':'post_change_image'})
-            df['pre_change_image'] = df['post_change_image'].shift(1)
-            df['image_repeats'] = df['stimulus_presentations_id'].diff()
-            df = df.drop(columns=['stimulus_presentations_id','image_name',
-                                  'omitted','is_change','change'],errors='ignore')
-            dfs.append(df)
-        except Exception as e:
-            crashed.append(row.behavior_session_id)
+    crashed = build_partitioned_table(summary_df, version, 'change_table',
+        build_session_change_df, incremental)
 
     # If any sessions crashed, print warning
     if len(crashed) > 0:
-        print(str(len(crashed)) + ' sessions crashed')  
- 
-    print('Concatenating Sessions')
-    change_df = pd.concat(dfs).reset_index(drop=True)
-
-    print('Saving')
-    model_dir = pgt.get_directory(version,subdirectory='summary') 
-    change_df.to_pickle(model_dir+'_change_table.pkl')
+        print(str(len(crashed)) + ' sessions crashed')
 
+    change_df = None
+    if load:
+        print('Loading change table')
+        change_df = get_change_table(version)
     return change_df, crashed
 
- 
-def get_change_table(version):
+
+def build_session_change_df(bsid, version):
+    '''
+        Returns a dataframe of the image changes in one session
+    '''
+    session_df = pgt.load_session_table(bsid, version, 'strategy_df')
+    df = session_df.query('is_change').reset_index(drop=True)
+    df['behavior_session_id'] = bsid
+    df = df.rename(columns={'image_name':'post_change_image'})
+    df['pre_change_image'] = df['post_change_image'].shift(1)
+    df['image_repeats'] = df['stimulus_presentations_id'].diff()
+    df = df.drop(columns=['stimulus_presentations_id','image_name',
+                          'omitted','is_change','change'],errors='ignore')
+    return df
+
+
+def get_change_table(version, columns=None, bsids=None):
     '''
         Loads the summary change_df from file
+
+        columns (list), the columns to load. If None, loads every column
+        bsids (list), the sessions to load. If None, loads every session
     '''
-    model_dir = pgt.get_directory(version,subdirectory='summary') 
-    return pd.read_pickle(model_dir+'_change_table.pkl')
+    return load_partitioned_table(version, 'change_table', columns=columns,
+        bsids=bsids)
 
 
-def build_licks_table(summary_df, version):
-    ''' 
+def build_licks_table(summary_df, version, incremental=True, load=True):
+    '''
         Builds a table of all image licks in the dataset
-        
+
         Loads the session_df for each behavior_session_id in summary_df
-        Saves the licks table as "_licks_table.pkl"            
+        Saves the licks table in "_licks_table/", with one file per session,
+        see build_partitioned_table
+
+        incremental (bool), if True, only loads sessions that are new or whose
+            licks_df changed since the last build. See get_sessions_to_update
+        load (bool), if True, returns the licks table. Otherwise returns None,
+            and only one session is in memory at a time
     '''
-    # Build a dataframe for each session
-    dfs = []
-    crash = 0
-    crashed = []
     print('Processing Sessions')
-    for index, row in tqdm(summary_df.iterrows(),total=summary_df.shape[0]):
-        try:
-            strategy_dir = pgt.get_directory(version, subdirectory='licks_df')
-            df = pd.read_csv(strategy_dir+str(row.behavior_session_id)+'.csv')
-        except Exception as e:
-            crash +=1
-            crashed.append(row.behavior_session_id)
-        else:
-            df.at[0,'pre_ili'] = np.nan
-            df.at[len(df)-1,'post_ili'] = np.nan
-            df.reset_index(drop=True)
-            df = df.drop(columns=['frame'])
-            df['behavior_session_id'] = row.behavior_session_id
-            dfs.append(df)
+    crashed = build_partitioned_table(summary_df, version, 'licks_table',
+        build_session_licks_table, incremental)
 
     # If any sessions crashed, print warning
-    if crash > 0:
-        print(str(crash) + ' sessions crashed')  
+    if len(crashed) > 0:
+        print(str(len(crashed)) + ' sessions crashed')
     else:
         print('Loaded all sessions')
- 
-    print('Concatenating Sessions')
-    licks_df = pd.concat(dfs).reset_index(drop=True)
 
-    print('Saving')
-    model_dir = pgt.get_directory(version,subdirectory='summary') 
-    licks_df.to_pickle(model_dir+'_licks_table.pkl')
+    licks_df = None
+    if load:
+        print('Loading licks table')
+        licks_df = get_licks_table(version)
+    return licks_df, crashed
 
-    return licks_df, crashed 
+
+def build_session_licks_table(bsid, version):
+    '''
+        Returns the licks_df of one session, with the rows of the licks table
+    '''
+    columns = [x for x in pgt.SESSION_TABLE_SCHEMAS['licks_df'] if x != 'frame']
+    df = pgt.load_session_table(bsid, version, 'licks_df', columns=columns)
+    df.at[0,'pre_ili'] = np.nan
+    df.at[len(df)-1,'post_ili'] = np.nan
+    df['behavior_session_id'] = bsid
+    return df
 
 
-def get_licks_table(version):
+def get_licks_table(version, columns=None, bsids=None):
     '''
         Loads the summary licks_df from file
+
+        columns (list), the columns to load. If None, loads every column.
+            BOUT_TABLE_COLUMNS are the columns build_bout_table uses
+        bsids (list), the sessions to load. If None, loads every session
+    '''
+    return load_partitioned_table(version, 'licks_table', columns=columns,
+        bsids=bsids)
+
+
+def get_table_directory(version, table):
+    '''
+        Returns the directory of a table saved with one file per session
+    '''
+    model_dir = pgt.get_directory(version,subdirectory='summary')
+    return model_dir+'_'+table+'/'
+
+
+def get_partition_filename(directory, bsid):
+    '''
+        Returns the filename of the partition of this session, or None if
+        it has not been saved
+    '''
+    for extension in ['.parquet','.csv']:
+        if os.path.isfile(directory+str(bsid)+extension):
+            return directory+str(bsid)+extension
+    return None
+
+
+def build_partitioned_table(summary_df, version, table, build_session,
+    incremental=True):
+    '''
+        Saves a table with one file (partition) for each session. Each
+        session is written as soon as it is built, and reading the table can
+        skip sessions and columns. The partitions are saved with
+        psy_storage_tools, and index.json lists the sessions in the order of
+        summary_df. Partitions of sessions that are not in summary_df are
+        removed.
+
+        build_session (function), build_session(bsid, version) returns the
+            rows of the table for one session
+        incremental (bool), if True, only builds sessions that are new or
+            whose inputs changed. See get_sessions_to_update
+
+        Returns a list of sessions that crashed
+    '''
+    update, fingerprints = get_sessions_to_update(summary_df, version, table,
+        incremental)
+    directory = get_table_directory(version, table)
+    os.makedirs(directory, exist_ok=True)
+
+    crashed = []
+    for bsid in tqdm(update):
+        filename = get_partition_filename(directory, bsid)
+        if filename is not None:
+            os.remove(filename)
+        try:
+            df = build_session(bsid, version)
+        except Exception as e:
+            crashed.append(bsid)
+            print('{} crashed: {}'.format(bsid, e))
+        else:
+            pst.save_table(directory+str(bsid)+pst.get_table_extension(), df,
+                TABLE_SCHEMAS[table])
+
+    # Remove sessions that are no longer in the table
+    bsids = [int(x) for x in summary_df['behavior_session_id'].values]
+    keep = set(str(x) for x in bsids)
+    for filename in os.listdir(directory):
+        if (filename != 'index.json') and (filename.split('.')[0] not in keep):
+            os.remove(directory+filename)
+
+    index = {'behavior_session_id':[x for x in bsids
+        if get_partition_filename(directory, x) is not None]}
+    with open(directory+'index.json.tmp', 'w') as json_file:
+        json.dump(index, json_file)
+    os.replace(directory+'index.json.tmp', directory+'index.json')
+
+    # Crashed sessions are not recorded, so the next build retries them
+    for bsid in crashed:
+        fingerprints.pop(str(bsid), None)
+    save_input_manifest(version, table, fingerprints)
+    return crashed
+
+
+def load_partitioned_table(version, table, columns=None, bsids=None):
+    '''
+        Loads a table saved by build_partitioned_table, reading only the
+        sessions in bsids, and the columns in columns. Tables saved as one
+        pickle, before they were partitioned, are loaded from the pickle
+
+        columns (list), the columns to load. If None, loads every column
+        bsids (list), the sessions to load. If None, loads every session
+    '''
+    directory = get_table_directory(version, table)
+    if not os.path.isfile(directory+'index.json'):
+        model_dir = pgt.get_directory(version,subdirectory='summary')
+        df = pd.read_pickle(model_dir+'_'+table+'.pkl')
+        if bsids is not None:
+            df = df[df['behavior_session_id'].isin(bsids)].reset_index(drop=True)
+        if columns is not None:
+            df = df[[x for x in dict.fromkeys(columns) if x in df]]
+        return df
+
+    with open(directory+'index.json', 'r') as json_file:
+        sessions = json.load(json_file)['behavior_session_id']
+    if bsids is not None:
+        bsids = set(int(x) for x in bsids)
+        sessions = [x for x in sessions if x in bsids]
+    dfs = [pst.load_table(get_partition_filename(directory, bsid),
+        columns=columns, schema=TABLE_SCHEMAS[table]) for bsid in sessions]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs).reset_index(drop=True)
+
+
+def get_input_filename(bsid, version, source):
+    '''
+        Returns the filename of one of the session files a summary table is 
+        built from, see TABLE_INPUTS
+    '''
+    if source == 'fits':
+        directory = pgt.get_directory(version, subdirectory='fits')
+        if os.path.isfile(directory+str(bsid)+'.pkl') and \
+            not os.path.isfile(directory+str(bsid)+'.npz'):
+            return directory+str(bsid)+'.pkl'
+        return directory+str(bsid)+'.npz'
+    elif source == 'metrics':
+        return pgt.get_directory(version, subdirectory='metrics')+\
+            str(bsid)+'.json'
+    elif source in ['strategy_df','licks_df']:
+        filename = pgt.get_session_table_filename(bsid, version, source)
+        if filename is None:
+            return pgt.get_directory(version, subdirectory=source)+\
+                str(bsid)+'.csv'
+        return filename
+    else:
+        raise Exception('Unknown input: '+source)
+
+
+def get_file_fingerprint(filename, previous=None):
+    '''
+        Returns [mtime_ns, size, sha1] of filename, or None if it does not 
+        exist. The file is only hashed if its mtime or size differ from 
+        previous, the fingerprint from the last build
+    '''
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    if (previous is not None) and (previous[0] == stat.st_mtime_ns) and \
+        (previous[1] == stat.st_size):
+        return previous
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            sha1.update(block)
+    return [stat.st_mtime_ns, stat.st_size, sha1.hexdigest()]
+
+
+def get_input_manifest(version):
+    '''
+        Loads the manifest of input fingerprints of each summary table. For 
+        each table, and each session, it holds the fingerprint of each input
+        file when the table was last built. See get_sessions_to_update
+    '''
+    filename = pgt.get_directory(version, subdirectory='summary')+\
+        '_input_manifest.json'
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as json_file:
+        return json.load(json_file)
+
+
+def save_input_manifest(version, table, fingerprints):
+    '''
+        Saves the fingerprints of the inputs of table in the input manifest
+    '''
+    manifest = get_input_manifest(version)
+    manifest[table] = fingerprints
+    filename = pgt.get_directory(version, subdirectory='summary')+\
+        '_input_manifest.json'
+    with open(filename+'.tmp', 'w') as json_file:
+        json.dump(manifest, json_file)
+    os.replace(filename+'.tmp', filename)
+
+
+def get_sessions_to_update(summary_df, version, table, incremental=True):
+    '''
+        Compares the fingerprints of the input files of each session with the
+        input manifest, and returns the sessions in summary_df that are new,
+        or whose inputs were added, removed, or changed content since table
+        was last built. Files with a new mtime but the same content are not
+        changes. Every session is updated if not incremental, or if table 
+        was not saved. 
+        
+        Returns the list of sessions to update, and the current fingerprints
     '''
     model_dir = pgt.get_directory(version,subdirectory='summary') 
-    return pd.read_pickle(model_dir+'_licks_table.pkl')
+    previous = get_input_manifest(version).get(table, {})
+    if table in TABLE_SCHEMAS:
+        saved = os.path.isfile(get_table_directory(version, table)+'index.json')
+    else:
+        saved = os.path.isfile(model_dir+'_'+table+'.pkl')
+    if (not incremental) or (not saved):
+        previous = {}
+
+    update = []
+    fingerprints = {}
+    for bsid in summary_df['behavior_session_id'].values:
+        last = previous.get(str(bsid), {})
+        current = {}
+        for source in TABLE_INPUTS[table]:
+            current[source] = get_file_fingerprint(
+                get_input_filename(bsid, version, source), last.get(source))
+        fingerprints[str(bsid)] = current
+        changed = [(current[x] is None) != (last.get(x) is None) or
+            ((current[x] is not None) and (current[x][1:] != last[x][1:]))
+            for x in current]
+        if (str(bsid) not in previous) or np.any(changed):
+            update.append(bsid)
+    print('{} of {} sessions are new or changed'.format(len(update), 
+        len(summary_df)))
+    return update, fingerprints
 
 
 def build_bout_table(licks_df):
@@ -0,0 +1,284 @@
+import os
+import json
+import pickle
+import fnmatch
+import zipfile
+import functools
+import numpy as np
+import pandas as pd
+
+'''
+Tools for storing nested results, such as model fits, in a compact format
+where each piece can be loaded on its own.
+
+A nested structure of dicts, lists, and tuples is flattened into members
+named by their path, for example 'hyp', 'psydata/y', or 'models/Full/1'.
+Each member is saved as an array in a compressed npz file. Numeric arrays
+are saved directly, and everything else (DataFrames, scalars, strings,
+sparse matrices) is saved as pickled bytes. The member '_types' records the
+structure, so the nested containers can be rebuilt.
+
+Because npz files are zip archives, loading a few members only reads and
+decompresses those members.
+
+Tables, such as the strategy_df of each session, are stored as Parquet
+files, which are columnar, so loading a few columns only reads those columns.
+A schema maps columns to dtypes, so columns have the same dtype in every 
+session. Tables saved as csv files before Parquet was used are loaded with
+the same schema. Parquet needs pyarrow, without it tables are saved as csv.
+'''
+
+TYPES_MEMBER = '_types'
+
+
+def save_store(filename, obj):
+    '''
+        Saves the nested structure obj to the npz file filename. Writes to a
+        temporary file first, so an interrupted save never leaves a partial file
+    '''
+    members = {}
+    types = {}
+    flatten(obj, '', members, types, encode=True)
+    members[TYPES_MEMBER] = np.frombuffer(json.dumps(types).encode(),
+        dtype=np.uint8)
+    temp_file = filename+'.tmp'
+    with open(temp_file, 'wb') as f:
+        np.savez_compressed(f, **members)
+    os.replace(temp_file, filename)
+
+
+def load_store(filename, fields=None):
+    '''
+        Loads the nested structure saved in filename
+
+        fields, a list of member paths to load. If None, loads everything.
+            A path selects that member and everything below it. Each level of
+            the path can be a wildcard, for example 'models/*/1' loads the
+            second item of every model. Containers are rebuilt with only the
+            selected members, lists and tuples keep their length with None in
+            the place of members that were not selected.
+    '''
+    with np.load(filename, allow_pickle=False) as data:
+        types = json.loads(data[TYPES_MEMBER].tobytes().decode())
+        return build(types, lambda path: decode(types[path], data[path]),
+            fields)
+
+
+def list_store(filename):
+    '''
+        Returns the paths of all the members saved in filename
+    '''
+    with np.load(filename, allow_pickle=False) as data:
+        types = json.loads(data[TYPES_MEMBER].tobytes().decode())
+    return [path for path in types if is_leaf(types[path])]
+
+
+def get_store_size(filename, fields=None):
+    '''
+        Returns the number of bytes on disk of the members selected by fields,
+        which is how much is read to load them. If None, the whole file
+    '''
+    if fields is None:
+        return os.path.getsize(filename)
+    if isinstance(fields, str):
+        fields = [fields]
+    with zipfile.ZipFile(filename) as z:
+        sizes = dict((info.filename[:-4], info.compress_size) \
+            for info in z.infolist())
+    return sizes[TYPES_MEMBER] + np.sum([sizes[path] for path in sizes \
+        if any(matches(path, field) for field in fields)])
+
+
+def select_fields(obj, fields=None):
+    '''
+        Returns the parts of the nested structure obj selected by fields, in
+        the same format load_store would return them. Used to give the same
+        output for structures that are already in memory
+    '''
+    members = {}
+    types = {}
+    flatten(obj, '', members, types, encode=False)
+    return build(types, lambda path: members[path], fields)
+
+
+def flatten(obj, path, members, types, encode=True):
+    '''
+        Recursively adds the members of obj to members and types. Dicts with
+        string keys, and lists or tuples that hold containers or arrays, are
+        flattened. Everything else is a single member.
+    '''
+    if is_container(obj):
+        if isinstance(obj, dict):
+            keys = list(obj.keys())
+            types[path] = {'type':'dict','keys':keys}
+        else:
+            keys = list(range(len(obj)))
+            types[path] = {'type':type(obj).__name__,'length':len(obj)}
+        for key in keys:
+            flatten(obj[key], join_path(path, key), members, types, encode)
+    elif isinstance(obj, np.ndarray) and (obj.dtype != object):
+        types[path] = {'type':'array'}
+        members[path] = obj
+    else:
+        types[path] = {'type':'pickle'}
+        if encode:
+            members[path] = np.frombuffer(pickle.dumps(obj,
+                protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+        else:
+            members[path] = obj
+
+
+def is_container(obj):
+    '''
+        Returns True if obj should be flattened
+    '''
+    if isinstance(obj, dict):
+        return all(isinstance(k, str) and (k != '') and ('/' not in k) \
+            and (k != TYPES_MEMBER) for k in obj.keys())
+    if isinstance(obj, (list, tuple)) and (type(obj) in [list, tuple]):
+        return any(isinstance(x, (dict, list, tuple, np.ndarray)) for x in obj)
+    return False
+
+
+def is_leaf(entry):
+    return entry['type'] in ['array','pickle']
+
+
+def join_path(path, key):
+    if path == '':
+        return str(key)
+    return path+'/'+str(key)
+
+
+def decode(entry, value):
+    '''
+        Returns the stored object for this member
+    '''
+    if entry['type'] == 'pickle':
+        return pickle.loads(value.tobytes())
+    return value
+
+
+def matches(path, field):
+    '''
+        Returns True if field selects path, either the member itself, or a
+        container above it
+    '''
+    path_parts = path.split('/')
+    field_parts = field.split('/')
+    if len(field_parts) > len(path_parts):
+        return False
+    return all(fnmatch.fnmatchcase(p, f) for p, f in \
+        zip(path_parts, field_parts))
+
+
+def build(types, get_member, fields=None):
+    '''
+        Rebuilds the nested structure from the flattened members selected by
+        fields. get_member(path) returns the object for one member
+    '''
+    leaves = [path for path in types if is_leaf(types[path]) and (path != '')]
+    if fields is not None:
+        if isinstance(fields, str):
+            fields = [fields]
+        leaves = [path for path in leaves \
+            if any(matches(path, field) for field in fields)]
+
+    # Every container above a selected member
+    needed = set(leaves)
+    for path in leaves:
+        parts = path.split('/')
+        for i in range(len(parts)):
+            needed.add('/'.join(parts[:i]))
+
+    def build_path(path):
+        entry = types[path]
+        if is_leaf(entry):
+            return get_member(path)
+        if entry['type'] == 'dict':
+            return dict((key, build_path(join_path(path, key))) \
+                for key in entry['keys'] if join_path(path, key) in needed)
+        items = [build_path(join_path(path, i)) \
+            if join_path(path, i) in needed else None \
+            for i in range(entry['length'])]
+        if entry['type'] == 'tuple':
+            return tuple(items)
+        return items
+
+    if is_leaf(types['']):
+        return get_member('')
+    return build_path('')
+
+
+@functools.lru_cache(maxsize=None)
+def get_table_extension():
+    '''
+        Returns the file extension tables are saved with, '.parquet' if 
+        pyarrow can be imported, otherwise '.csv'
+    '''
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return '.csv'
+    return '.parquet'
+
+
+def save_table(filename, df, schema=None):
+    '''
+        Saves the dataframe df to filename, as Parquet or csv depending on the
+        extension, with the dtypes in schema. The index is not saved. Writes to
+        a temporary file first, so an interrupted save never leaves a partial
+        file
+    '''
+    df = apply_schema(df, schema)
+    temp_file = filename+'.tmp'
+    if filename.endswith('.parquet'):
+        df.to_parquet(temp_file, index=False)
+    else:
+        df.to_csv(temp_file, index=False)
+    os.replace(temp_file, filename)
+
+
+def load_table(filename, columns=None, schema=None):
+    '''
+        Loads the table saved in filename, as Parquet or csv depending on the
+        extension
+
+        columns, a list of columns to load, in that order. Columns that are
+            not in the table are skipped. If None, loads every column
+        schema, a dictionary of column dtypes. Applied to csv tables, Parquet
+            tables are saved with their dtypes
+    '''
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+    if filename.endswith('.parquet'):
+        if columns is not None:
+            import pyarrow.parquet as pq
+            names = pq.read_schema(filename).names
+            columns = [x for x in columns if x in names]
+        return pd.read_parquet(filename, columns=columns)
+
+    if columns is None:
+        df = pd.read_csv(filename)
+    else:
+        df = pd.read_csv(filename, usecols=lambda x: x in columns)
+        df = df[[x for x in columns if x in df]]
+    return apply_schema(df, schema)
+
+
+def apply_schema(df, schema=None):
+    '''
+        Returns df with the columns in schema cast to their dtype. Boolean 
+        and integer columns with missing values are cast to the nullable 
+        'boolean' and 'Int64' dtypes. Columns that are not in df are skipped
+    '''
+    if schema is None:
+        return df
+    df = df.copy()
+    for column, dtype in schema.items():
+        if (column not in df) or (df[column].dtype == dtype):
+            continue
+        if df[column].isna().any():
+            dtype = {'bool':'boolean','int64':'Int64'}.get(dtype, dtype)
+        df[column] = df[column].astype(dtype)
+    return df
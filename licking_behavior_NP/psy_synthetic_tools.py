@@ -0,0 +1,348 @@
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+
+'''
+Synthetic sessions, and a stand-in for the SDK project cache, so the
+pipeline can be run, benchmarked, and profiled without the /allen file system
+or the VBN S3 cache.
+
+The sessions have the tables of an SDK behavior session that get_data uses:
+stimulus_presentations (an active behavior block, and a passive replay
+block), licks, rewards, and metadata. Images are presented every 0.75s, with
+image changes, and omissions. A simulated mouse starts licking bouts with a
+mix of visual and timing strategies, and its engagement drifts over the
+session. Licks on a change image in the response window earn a reward, and
+the first few changes are auto-rewarded.
+
+To point the pipeline at a synthetic cache, set two environment variables
+before starting python:
+    PSY_BEHAVIOR_DIR, a local directory for model versions, the session
+        cache, and the manifest snapshot
+    PSY_SYNTHETIC_CACHE, the options of the synthetic cache, for example
+        'num_sessions=40,num_images=4800,seed=0'. See get_synthetic_cache
+'''
+
+IMAGES = {
+    'G':['im012_r','im036_r','im044_r','im047_r','im078_r','im083_r',
+        'im111_r','im115_r'],
+    'H':['im005_r','im024_r','im034_r','im083_r','im087_r','im104_r',
+        'im111_r','im114_r'],
+    }
+
+GENOTYPES = [
+    'wt/wt',
+    'Sst-IRES-Cre/wt;Ai32(RCL-ChR2(H134R)_EYFP)/wt',
+    'Vip-IRES-Cre/wt;Ai32(RCL-ChR2(H134R)_EYFP)/wt',
+    ]
+
+RECEPTIVE_FIELD_COLUMNS = ['color','contrast','orientation','position_x',
+    'position_y','spatial_frequency','temporal_frequency']
+
+FRAME_RATE = 60
+RESPONSE_WINDOW = [0.15, 0.75]
+NUM_AUTO_REWARDS = 5
+
+
+def get_synthetic_cache(options=''):
+    '''
+        Returns a SyntheticCache from a string of options, as in the
+        environment variable PSY_SYNTHETIC_CACHE, for example
+        'num_sessions=40,num_images=4800,seed=0'. Options that are not given
+        use the defaults of SyntheticCache
+    '''
+    kwargs = {}
+    for option in options.split(','):
+        if '=' in option:
+            key, value = option.split('=')
+            kwargs[key.strip()] = int(value)
+    return SyntheticCache(**kwargs)
+
+
+class SyntheticCache:
+    '''
+        A stand-in for the VisualBehaviorNeuropixelsProjectCache, with the
+        methods the pipeline uses. Sessions are generated when they are
+        loaded, the same session is generated each time it is loaded
+
+        num_sessions, the number of sessions in the session table. Each
+            mouse has a Familiar and a Novel session
+        num_images, the number of images in the active behavior block of
+            each session
+        seed, the seed of the session table, and of every session
+    '''
+    sdk_version = 'synthetic'
+
+    def __init__(self, num_sessions=20, num_images=4800, seed=0):
+        self.num_sessions = num_sessions
+        self.num_images = num_images
+        self.seed = seed
+        self.session_table = build_synthetic_session_table(num_sessions, seed)
+
+    def current_manifest(self):
+        return 'sessions_{}_images_{}_seed_{}.json'.format(
+            self.num_sessions, self.num_images, self.seed)
+
+    def get_ecephys_session_table(self, filter_abnormalities=True):
+        return self.session_table.copy()
+
+    def get_behavior_session(self, behavior_session_id):
+        table = self.session_table.reset_index()\
+            .set_index('behavior_session_id')
+        if behavior_session_id not in table.index:
+            raise Exception('Unknown behavior_session_id: '\
+                +str(behavior_session_id))
+        row = table.loc[behavior_session_id]
+        metadata = {
+            'behavior_session_id':behavior_session_id,
+            'ecephys_session_id':row['ecephys_session_id'],
+            'session_type':row['session_type'],
+            'mouse_id':row['mouse_id'],
+            'equipment_name':row['equipment_name'],
+            'date_of_acquisition':row['date_of_acquisition'],
+            'full_genotype':row['genotype'],
+            'driver_line':get_driver_line(row['genotype']),
+            'cre_line':(get_driver_line(row['genotype']) or [None])[0],
+            'sex':row['sex'],
+            'age_in_days':row['age_in_days'],
+            'image_set':row['image_set'],
+            'stimulus_frame_rate':float(FRAME_RATE),
+            }
+        return build_synthetic_session(self.num_images,
+            seed=[self.seed, behavior_session_id], metadata=metadata)
+
+
+def get_driver_line(genotype):
+    '''
+        Returns the list of driver lines in genotype, as in the SDK metadata
+    '''
+    return [x.split('/')[0] for x in genotype.split(';') if 'Cre' in x]
+
+
+def build_synthetic_session_table(num_sessions=20, seed=0):
+    '''
+        Returns a table of sessions with the columns of the SDK ecephys
+        session table, indexed by ecephys_session_id. Each mouse has a
+        Familiar session, followed by a Novel session the next day
+    '''
+    rng = np.random.default_rng(seed)
+    num_mice = int(np.ceil(num_sessions/2))
+    mouse_ids = 500000 + rng.choice(100000, num_mice, replace=False)
+    rows = []
+    for index in range(num_sessions):
+        mouse = index//2
+        novel = index % 2 == 1
+        familiar_set = 'G' if mouse % 4 < 3 else 'H'
+        image_set = ({'G':'H','H':'G'}[familiar_set]) if novel \
+            else familiar_set
+        date = pd.Timestamp('2020-01-01') + pd.Timedelta(days=7*mouse+novel)
+        rows.append({
+            'ecephys_session_id':1000000000+index,
+            'behavior_session_id':1000000000+index+50000,
+            'date_of_acquisition':date,
+            'equipment_name':['NP.0','NP.1','NP.2','NP.3'][mouse % 4],
+            'session_type':'EPHYS_1_images_{}_3uL_reward'.format(image_set),
+            'mouse_id':str(mouse_ids[mouse]),
+            'genotype':GENOTYPES[mouse % len(GENOTYPES)],
+            'sex':['M','F'][mouse % 2],
+            'project_code':'NeuropixelVisualBehavior',
+            'age_in_days':120 + (7*mouse) % 60 + int(novel),
+            'session_number':1 + int(novel),
+            'image_set':image_set,
+            'prior_exposures_to_image_set':0 if novel else 30,
+            'prior_exposures_to_omissions':int(novel),
+            'experience_level':'Novel' if novel else 'Familiar',
+            'abnormal_histology':None,
+            'abnormal_activity':None,
+            })
+    return pd.DataFrame(rows).set_index('ecephys_session_id')
+
+
+def build_synthetic_session(num_images=4800, seed=0, metadata=None,
+    passive=True):
+    '''
+        Returns a session with the stimulus_presentations, licks, rewards,
+        and metadata of an SDK behavior session
+
+        num_images, the number of images in the active behavior block
+        seed, the seed of the random number generator, anything
+            np.random.default_rng accepts
+        metadata, the session metadata. If None, a Familiar G session
+        passive, if True, adds a passive replay block of the same images
+    '''
+    rng = np.random.default_rng(seed)
+    if metadata is None:
+        metadata = {
+            'behavior_session_id':0,
+            'session_type':'EPHYS_1_images_G_3uL_reward',
+            'image_set':'G',
+            'driver_line':[],
+            'stimulus_frame_rate':float(FRAME_RATE),
+            }
+    image_set = metadata.get('image_set','G')
+
+    stimulus = build_synthetic_stimulus(num_images, image_set, rng)
+    lick_times, reward_times, auto_rewarded = simulate_licking(stimulus, rng)
+
+    if passive:
+        replay = stimulus.copy()
+        replay['stimulus_block'] = 5
+        replay['active'] = False
+        offset = np.round((stimulus['end_time'].values[-1] + 600)*FRAME_RATE)\
+            /FRAME_RATE
+        replay['start_time'] += offset
+        replay['end_time'] += offset
+        replay['start_frame'] += int(offset*FRAME_RATE)
+        replay['end_frame'] += int(offset*FRAME_RATE)
+        stimulus = pd.concat([stimulus, replay], ignore_index=True)
+    stimulus.index.name = 'stimulus_presentations_id'
+
+    licks = pd.DataFrame({
+        'timestamps':lick_times,
+        'frame':np.round(lick_times*FRAME_RATE).astype(int),
+        })
+    rewards = pd.DataFrame({
+        'volume':np.where(auto_rewarded, 0.005, 0.003),
+        'timestamps':reward_times,
+        'auto_rewarded':auto_rewarded,
+        })
+    return SimpleNamespace(
+        stimulus_presentations=stimulus,
+        licks=licks,
+        rewards=rewards,
+        metadata=metadata,
+        )
+
+
+def build_synthetic_stimulus(num_images, image_set, rng):
+    '''
+        Returns the stimulus table of the active behavior block. Images change
+        every 4 to 11 images. 5% of images are omitted, but not changes or
+        the image before a change
+    '''
+    start_frame = 5*FRAME_RATE + 45*np.arange(num_images)
+    start_time = start_frame/FRAME_RATE
+
+    # Image changes
+    is_change = np.zeros(num_images, dtype=bool)
+    change = rng.integers(4, 12)
+    while change < num_images:
+        is_change[change] = True
+        change += rng.integers(4, 12)
+
+    # Image identity changes on each change
+    images = IMAGES[image_set]
+    identity = np.zeros(num_images, dtype=int)
+    current = rng.integers(len(images))
+    for index in range(num_images):
+        if is_change[index]:
+            current = (current + rng.integers(1, len(images))) % len(images)
+        identity[index] = current
+    image_name = np.array(images, dtype=object)[identity]
+
+    omitted = rng.random(num_images) < 0.05
+    omitted &= ~is_change & ~np.roll(is_change, -1)
+    omitted[0] = False
+    image_name[omitted] = 'omitted'
+
+    last_change = np.maximum.accumulate(np.where(is_change,
+        np.arange(num_images), 0))
+    flashes_since_change = np.arange(num_images) - last_change
+
+    stimulus = pd.DataFrame({
+        'stimulus_block':0,
+        'stimulus_name':'Natural_Images_Lum_Matched_set_ophys_{}_2019'\
+            .format(image_set),
+        'active':True,
+        'image_name':image_name,
+        'is_change':is_change,
+        'omitted':omitted,
+        'flashes_since_change':flashes_since_change,
+        'start_time':start_time,
+        'end_time':start_time + 0.25,
+        'duration':0.25,
+        'start_frame':start_frame,
+        'end_frame':start_frame + 15,
+        })
+    for column in RECEPTIVE_FIELD_COLUMNS:
+        stimulus[column] = np.nan
+    return stimulus
+
+
+def simulate_licking(stimulus, rng):
+    '''
+        Simulates a mouse that starts licking bouts with a mix of strategies,
+        and returns the times of licks, the times of rewards, and whether each
+        reward was an auto-reward
+
+        On each image when the mouse is not licking, it starts a bout with a
+        probability that depends on a drifting bias, the visual strategy
+        (image changes), the timing strategy (images since the last bout),
+        and omissions. Bouts are separated by more than the bout threshold of
+        0.7s. The first lick in the response window after a change earns a
+        reward, and is followed by a longer consumption bout. The first
+        NUM_AUTO_REWARDS changes are auto-rewarded.
+    '''
+    start_time = stimulus['start_time'].values
+    is_change = stimulus['is_change'].values
+    omitted = stimulus['omitted'].values
+    num_images = len(start_time)
+
+    # Session strategy, and a slow drift in engagement
+    visual = rng.uniform(0.5, 4)
+    timing = rng.uniform(1, 6)
+    omission = rng.uniform(-1, 1)
+    drift = np.cumsum(rng.normal(0, 0.05, num_images))
+    drift -= np.linspace(0, 2, num_images) + np.mean(drift)
+    bias = -2.5 + drift
+
+    lick_times = []
+    reward_times = []
+    auto_rewarded = []
+    num_changes = 0
+    last_bout_end = -np.inf
+    next_free = -np.inf
+    for index in range(num_images):
+        change = is_change[index]
+        if change:
+            num_changes += 1
+        auto = change and (num_changes <= NUM_AUTO_REWARDS)
+        if auto:
+            reward_times.append(start_time[index] + RESPONSE_WINDOW[0])
+            auto_rewarded.append(True)
+        if start_time[index] < next_free:
+            continue
+
+        # Probability of starting a bout on this image
+        images_since = (start_time[index] - last_bout_end)/0.75
+        logit = bias[index] + visual*change + omission*omitted[index] + \
+            timing*(1/(1+np.exp(-(images_since - 5)*1.5)) - 0.5)
+        if (not auto) and (rng.random() >= 1/(1+np.exp(-logit))):
+            continue
+
+        # Lick latency, faster on changes
+        if change:
+            latency = rng.gamma(8, 0.05)
+        else:
+            latency = rng.uniform(0.05, 0.75)
+        bout_start = max(start_time[index] + latency, next_free)
+        rewarded = change and (not auto) and \
+            (RESPONSE_WINDOW[0] <= bout_start - start_time[index] \
+            < RESPONSE_WINDOW[1])
+        consuming = rewarded or auto
+        num_licks = rng.integers(8, 20) if consuming else rng.geometric(0.3)
+        bout = bout_start + np.concatenate([[0],
+            np.cumsum(rng.uniform(0.11, 0.2, num_licks - 1))])
+        bout = np.round(bout*FRAME_RATE)/FRAME_RATE
+        if rewarded:
+            reward_times.append(bout[0])
+            auto_rewarded.append(False)
+        lick_times.append(bout)
+        last_bout_end = bout[-1]
+        next_free = last_bout_end + 0.75
+
+    lick_times = np.concatenate(lick_times) if len(lick_times) > 0 \
+        else np.array([])
+    order = np.argsort(reward_times, kind='stable')
+    return lick_times, np.array(reward_times)[order], \
+        np.array(auto_rewarded, dtype=bool)[order]
@@ -1,20 +1,21 @@
 import os
+import sys
 import copy
+import json
+import time
 import pickle
+import shutil
+import importlib
+import types
 import numpy as np
 import pandas as pd
-import seaborn as sns
 from tqdm import tqdm
-from sklearn import metrics
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor
 
-import psytrack as psy
-from psytrack.helper.crossValidation import split_data
-from psytrack.helper.crossValidation import xval_loglike
-
-import licking_behavior_NP.psy_style as pstyle
 import licking_behavior_NP.psy_metrics_tools as pm
 import licking_behavior_NP.psy_general_tools as pgt
+import licking_behavior_NP.psy_storage_tools as pst
 
 
 def load(filepath):
@@ -36,13 +37,25 @@ def save(filepath, variables):
     file_temp.close()
 
    
-def process_session(bsid,complete=True,version=None,format_options={},refit=False):
+def process_session(bsid,complete=True,version=None,format_options={},refit=False,
+    workers=1,checkpoint=True,resume=False):
     '''
         Fits the model, dropout analysis, and cross validation
         bsid, behavior_session_id
         complete, if True, does a dropout analysis 
         version, the version of the model, where to save the results. Defaults to "dev"
         format_options, a dictionary of options 
+        workers, the number of processes used to fit the cross validation folds 
+            and the dropout models
+        checkpoint, if True, each stage is saved to a checkpoint directory for
+            this session as it finishes. If the fit is interrupted, rerunning
+            resumes after the last completed stage. The checkpoints are
+            removed once the fit is saved. Checkpoints made with different
+            format_options, including the fit backend and warm start, are 
+            discarded and recomputed. See get_checkpoint_directory
+        resume, if True, a refit resumes from the checkpoints of this session 
+            instead of clearing them. Used by process_sessions, which clears 
+            them only when the refit of a session first starts
     '''
     
     # Process directory, filename, and bsid
@@ -57,28 +70,52 @@ def process_session(bsid,complete=True,version=None,format_options={},refit=Fals
     print(filename) 
 
     # Check if this fit has already completed
-    if os.path.isfile(filename+".pkl") & (not refit):
+    if pgt.fit_exists(bsid, version) & (not refit):
         print('Already completed this fit, quitting')
         return
 
+    # Set up checkpoints
+    checkpoint_dir = None
+    if checkpoint:
+        checkpoint_dir = get_checkpoint_directory(bsid, version)
+        if refit and (not resume):
+            clear_checkpoints(checkpoint_dir)
+
     print('Starting Fit now')
-    print("Pulling Data")
-    session = pgt.get_data(bsid)
+    session = load_checkpoint(checkpoint_dir, 'session')
+    if session is None:
+        print("Pulling Data")
+        session = pgt.get_data(bsid)
 
-    print("Annotating lick bouts")
-    pm.annotate_licks(session) 
-    pm.annotate_bouts(session)
+        print("Annotating lick bouts")
+        pm.annotate_licks(session) 
+        pm.annotate_bouts(session)
+        session = get_session_checkpoint(session)
+        save_checkpoint(checkpoint_dir, 'session', session)
    
     print("Formating Data")
     format_options = get_format_options(version, format_options)
-    psydata = format_session(session,format_options)
+    psydata = load_checkpoint(checkpoint_dir, 'psydata', format_options)
+    if psydata is None:
+        psydata = format_session(session,format_options)
+        save_checkpoint(checkpoint_dir, 'psydata', psydata, format_options)
+    else:
+        annotate_stimulus_presentations_np(session,
+            ignore_trial_errors = format_options['ignore_trial_errors'])
 
     print("Initial Fit")
     strategies={'bias','task0','timing1D','omissions','omissions1'}
     if np.sum(session.stimulus_presentations_np.omitted) == 0:
        strategies.remove('omissions')
        strategies.remove('omissions1')
-    hyp, evd, wMode, hess, credibleInt,weights = fit_weights(psydata,strategies)
+    backend = format_options.get('fit_backend','psytrack')
+    initial_fit = load_checkpoint(checkpoint_dir, 'initial_fit', format_options)
+    if initial_fit is None:
+        initial_fit = fit_weights(psydata,strategies,backend=backend)
+        save_checkpoint(checkpoint_dir, 'initial_fit', initial_fit, 
+            format_options)
+    hyp, evd, wMode, hess, credibleInt,weights,counts = initial_fit
+    import psytrack as psy
     ypred,ypred_each = compute_ypred(psydata, wMode,weights)
     plot_weights(wMode, weights,psydata,errorbar=credibleInt, ypred=ypred,
         filename=fig_filename)
@@ -87,13 +124,19 @@ def process_session(bsid,complete=True,version=None,format_options={},refit=Fals
     cross_psydata = psy.trim(psydata, 
         END=int(np.floor(len(psydata['y'])/format_options['num_cv_folds'])\
         *format_options['num_cv_folds'])) 
-    cross_results = compute_cross_validation(cross_psydata, hyp, weights,
-        folds=format_options['num_cv_folds'])
+    cross_results = load_checkpoint(checkpoint_dir, 'cross_validation', 
+        format_options)
+    if cross_results is None:
+        cross_results = compute_cross_validation(cross_psydata, hyp, weights,
+            folds=format_options['num_cv_folds'],workers=workers,backend=backend)
+        save_checkpoint(checkpoint_dir, 'cross_validation', cross_results,
+            format_options)
     cv_pred = compute_cross_validation_ypred(cross_psydata, cross_results,ypred)
     
     if complete:
         print("Dropout Analysis")
-        models = dropout_analysis(psydata, strategies, format_options)
+        models = dropout_analysis(psydata, strategies, format_options, 
+            workers=workers, checkpoint_dir=checkpoint_dir)
 
     print('Packing up and saving')
     metadata = session.metadata
@@ -103,14 +146,15 @@ def process_session(bsid,complete=True,version=None,format_options={},refit=Fals
         'psydata','cross_results','cv_pred','metadata']       
     fit = dict((x,y) for x,y in zip(labels, output))
     fit['ID'] = bsid
+    fit['optimizer_evaluations'] = counts
 
     if complete:
         fit['models'] = models
 
     print('Saving fit dictionary')
-    save(filename+".pkl", fit) 
+    save_fit(fit, bsid, version)
     summarize_fit(fit, version=version, savefig=True)
-    plt.close('all')
+    close_figures()
 
     print('Saving strategy df')
     build_session_strategy_df(bsid, version,fit=fit,session=session)
@@ -118,9 +162,235 @@ def process_session(bsid,complete=True,version=None,format_options={},refit=Fals
     print('Saving licks df')
     build_session_licks_df(session, bsid, version)
 
+    print('Saving session metrics')
+    build_session_metrics(bsid, version, fit=fit)
+
+    clear_checkpoints(checkpoint_dir)
     print('Done!')
 
 
+def get_checkpoint_directory(bsid, version):
+    '''
+        Returns the directory where the checkpoints of each stage of the fit
+        for this session are saved
+    '''
+    return pgt.get_directory(version, subdirectory='checkpoints')+str(bsid)+'/'
+
+
+def get_session_checkpoint(session):
+    '''
+        Returns the parts of the session the fit uses, which are smaller than
+        the SDK session object and can be pickled
+    '''
+    return pgt.get_session_tables(session)
+
+
+def load_checkpoint(checkpoint_dir, stage, options=None):
+    '''
+        Returns the saved results of this stage, or None if this stage has not 
+        been saved, or checkpoint_dir is None
+
+        options, the options this stage is computed with, see save_checkpoint.
+            A checkpoint saved with different options is discarded, and None
+            is returned
+    '''
+    if checkpoint_dir is None:
+        return None
+    filename = checkpoint_dir+stage+'.pkl'
+    if not os.path.isfile(filename):
+        return None
+    checkpoint = load(filename)
+    if (type(checkpoint) is not dict) or \
+        (set(checkpoint.keys()) != {'options','data'}) or \
+        (checkpoint['options'] != options):
+        print('Discarding checkpoint made with different options: '+stage)
+        os.remove(filename)
+        return None
+    print('Loading checkpoint: '+stage)
+    return checkpoint['data']
+
+
+def save_checkpoint(checkpoint_dir, stage, data, options=None):
+    '''
+        Saves the results of this stage. Writes to a temporary file first, so
+        a job killed while saving never leaves a partial checkpoint
+
+        options, the options this stage was computed with (the format_options,
+            which include the fit backend and warm start). Saved with the 
+            results, so load_checkpoint can discard stale checkpoints
+    '''
+    if checkpoint_dir is None:
+        return
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    filename = checkpoint_dir+stage+'.pkl'
+    save(filename+'.tmp', {'options':options,'data':data})
+    os.replace(filename+'.tmp', filename)
+
+
+def clear_checkpoints(checkpoint_dir):
+    '''
+        Removes the checkpoints for this session
+    '''
+    if (checkpoint_dir is not None) and os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+
+
+def process_sessions(bsids, version, workers=1, complete=True, format_options={},
+    refit=False, progress_file=None, restart=False):
+    '''
+        Fits many sessions from one process pool, so the interpreter, imports, 
+        and SDK cache are set up once per worker instead of once per session. 
+
+        bsids, list of behavior_session_ids
+        version, the model version
+        workers, the number of processes. Each process fits one session at a 
+            time. If 1, the sessions are fit serially in this process
+        complete, refit, format_options, passed to process_session. Sessions
+            with completed fits are skipped unless refit is True
+        progress_file, path of a json record of the progress of this batch. 
+            Defaults to <summary directory>/_process_sessions_progress.json. 
+            If the file exists, sessions it records as completed are skipped
+            if their fit still exists, even if refit is True, so a batch that 
+            was interrupted can be resumed by running it again. The checkpoints 
+            of a refit session are cleared only the first time the session 
+            starts in this record, so an interrupted refit resumes from its 
+            checkpoints
+        restart, if True, starts a new progress record, replacing the record
+            in progress_file. Use this to refit sessions a previous batch 
+            completed
+
+        Returns the progress record, a dictionary with lists of completed, 
+            skipped, and crashed behavior_session_ids
+    '''
+    bsids = [int(bsid) for bsid in bsids]
+    if type(version) is str:
+        version = int(version)
+    if progress_file is None:
+        progress_file = pgt.get_directory(version, subdirectory='summary')+\
+            '_process_sessions_progress.json'
+    progress = load_progress(progress_file, version, restart)
+
+    # Determine which sessions still need to be fit. Sessions are only skipped
+    # if their fit exists, so a record shared across batches, or a fit removed
+    # since the record was saved, never skips a session without a fit
+    completed = set(progress['completed'])
+    todo = []
+    for bsid in bsids:
+        exists = pgt.fit_exists(bsid, version)
+        if (bsid in completed) and exists:
+            continue
+        if exists and (not refit):
+            print('{} already completed, skipping'.format(bsid))
+            update_progress(progress, bsid, 'skipped')
+        else:
+            todo.append(bsid)
+
+    # Clear the checkpoints of refit sessions the first time they start
+    if refit:
+        for bsid in todo:
+            if bsid not in progress['refit_started']:
+                clear_checkpoints(get_checkpoint_directory(bsid, version))
+                progress['refit_started'].append(bsid)
+    save_progress(progress_file, progress)
+    print('Fitting {} sessions across {} workers, {} already finished'.format(
+        len(todo), workers, len(bsids)-len(todo)))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(process_session_safe, bsid, version, 
+                complete, format_options, refit, True):bsid for bsid in todo}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    update_progress(progress, *future.result())
+                    save_progress(progress_file, progress)
+    else:
+        for bsid in todo:
+            update_progress(progress, *process_session_safe(bsid, version, 
+                complete, format_options, refit, True))
+            save_progress(progress_file, progress)
+
+    print('Completed: {}, Skipped: {}, Crashed: {}'.format(
+        len(progress['completed']), len(progress['skipped']),
+        len(progress['crashed'])))
+    return progress
+
+
+def process_session_safe(bsid, version, complete=True, format_options={},
+    refit=False, resume=False):
+    '''
+        Runs process_session, catching any exception so one crashed session 
+        does not stop a batch of sessions
+
+        Returns (bsid, status, message), where status is 'completed' or 'crashed'
+    '''
+    try:
+        process_session(bsid, complete=complete, version=version, 
+            format_options=copy.deepcopy(format_options), refit=refit, 
+            resume=resume)
+        close_figures()
+    except Exception as e:
+        print('crashed - {}: {}'.format(bsid, e))
+        return bsid, 'crashed', repr(e)
+    return bsid, 'completed', ''
+
+
+def close_figures():
+    '''
+        Closes all open figures. Does nothing if matplotlib was never imported,
+        so workers that did not plot do not pay for importing it
+    '''
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+
+
+def load_progress(progress_file, version, restart=False):
+    '''
+        Loads the progress record of a batch of fits, or starts a new one
+
+        restart (bool), if True, starts a new record even if progress_file 
+            exists
+    '''
+    if os.path.isfile(progress_file) and (not restart):
+        print('Resuming from progress record: '+progress_file)
+        with open(progress_file,'r') as json_file:
+            progress = json.load(json_file)
+        if progress['version'] != version:
+            raise Exception('Progress record is for a different model version')
+        progress.setdefault('refit_started',[])
+        return progress
+    return {'version':version,'completed':[],'skipped':[],'crashed':{},
+        'refit_started':[],'updated':''}
+
+
+def update_progress(progress, bsid, status, message=''):
+    '''
+        Records the status of one session in the progress record
+    '''
+    for key in ['completed','skipped']:
+        if bsid in progress[key]:
+            progress[key].remove(bsid)
+    progress['crashed'].pop(str(bsid),None)
+    if status == 'crashed':
+        progress['crashed'][str(bsid)] = message
+    else:
+        progress[status].append(bsid)
+
+
+def save_progress(progress_file, progress):
+    '''
+        Saves the progress record. Writes to a temporary file first, so an 
+        interrupted batch never leaves a partial record
+    '''
+    progress['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    temp_file = progress_file+'.tmp'
+    with open(temp_file, 'w') as json_file:
+        json.dump(progress, json_file, indent=4)
+    os.replace(temp_file, progress_file)
+
+
 def build_session_strategy_df(bsid, version,TRAIN=False,fit=None,session=None):
     '''
         Saves an analysis file in <output_dir> for the model fit of session <id> 
@@ -218,8 +488,8 @@ def build_session_strategy_df(bsid, version,TRAIN=False,fit=None,session=None):
         })
 
     # Save out dataframe
-    model_output.to_csv(pgt.get_directory(version, \
-        subdirectory='strategy_df')+str(bsid)+'.csv') 
+    pgt.save_session_table(model_output.reset_index(), bsid, version, 
+        'strategy_df')
 
 
 def build_session_licks_df(session, bsid, version):
@@ -245,10 +515,162 @@ def build_session_licks_df(session, bsid, version):
     session_licks_df = session.licks
 
     # Save out dataframe
-    filename = pgt.get_directory(version, subdirectory='licks_df')+str(bsid)+'.csv'
-    session_licks_df.to_csv(filename,index=False) 
+    pgt.save_session_table(session_licks_df, bsid, version, 'licks_df')
 
  
+# Fields of the fit used to compute the session metrics
+METRICS_FIELDS = ['psydata/y','psydata/full_df','cv_pred','hyp','wMode',
+    'weights','models/*/1','models/*/6']
+
+
+def compute_session_metrics(fit):
+    '''
+        Computes the scalar summaries of the fit used by the summary tables,
+        so they can be built without loading every fit. 
+
+        Returns a dictionary with the model ROC, the strategy indices, and for
+        each strategy the prior, the dropout scores, and the average weight
+    '''
+    metrics = {}
+    metrics['session_roc'] = compute_model_roc(fit)
+
+    # Trial counts, only defined for fits with trial annotations
+    full_df = fit['psydata']['full_df']
+    for column in ['false_alarm','correct_reject']:
+        if column in full_df:
+            metrics['num_trial_'+column] = np.sum(full_df[column])
+
+    # Get Strategy indices
+    model_dex, taskdex,timingdex = get_timing_index_fit(fit) 
+    metrics['strategy_dropout_index'] = model_dex
+    metrics['visual_only_dropout_index'] = taskdex
+    metrics['timing_only_dropout_index'] = timingdex
+
+    # For each strategy add the hyperparameter, dropout score, and average weight
+    dropout_dict_cv = get_session_dropout(fit,cross_validation=True)
+    dropout_dict_ev = get_session_dropout(fit,cross_validation=False)
+    sigma = fit['hyp']['sigma']
+    wMode = fit['wMode']
+    weights = get_weights_list(fit['weights'])
+    for dex, weight in enumerate(weights):
+        metrics['prior_'+weight] = sigma[dex]
+    for dex, weight in enumerate(weights):
+        metrics['dropout_cv_'+weight] = dropout_dict_cv[weight]
+        metrics['dropout_'+weight] = dropout_dict_ev[weight]
+    for dex, weight in enumerate(weights):
+        metrics['avg_weight_'+weight] = np.mean(wMode[dex,:])
+
+    # Cast numpy scalars so the record can be saved as json
+    return dict((k, float(v)) for k,v in metrics.items())
+
+
+def build_session_metrics(bsid, version, fit=None):
+    '''
+        Saves the session metrics for the model fit of session bsid as a small
+        json file, see compute_session_metrics. If fit is None, loads only
+        the fields of the fit that are needed
+
+        Returns the metrics dictionary
+    '''
+    if fit is None:
+        fit = load_fit(bsid, version=version, fields=METRICS_FIELDS)
+    metrics = compute_session_metrics(fit)
+    directory = pgt.get_directory(version, subdirectory='metrics')
+    os.makedirs(directory, exist_ok=True)
+    filename = directory+str(bsid)+'.json'
+    temp_file = filename+'.tmp'
+    with open(temp_file, 'w') as json_file:
+        json.dump(metrics, json_file, indent=4)
+    os.replace(temp_file, filename)
+    return metrics
+
+
+def load_session_metrics(bsid, version):
+    '''
+        Loads the session metrics for session bsid. If they were not saved,
+        builds them from the model fit and saves them.
+        Raises an exception if the session has no model fit
+    '''
+    filename = pgt.get_directory(version, subdirectory='metrics')+str(bsid)+'.json'
+    if os.path.isfile(filename):
+        with open(filename, 'r') as json_file:
+            return json.load(json_file)
+    return build_session_metrics(bsid, version)
+
+
+def load_session_metrics_safe(bsid, version):
+    '''
+        Returns the session metrics for session bsid, or None if the session
+        has no model fit, or its metrics or fit could not be loaded
+    '''
+    try:
+        return load_session_metrics(bsid, version)
+    except FileNotFoundError:
+        # The session has no model fit
+        return None
+    except Exception as e:
+        print('{} crashed: {}'.format(bsid, e))
+        return None
+
+
+def load_session_metrics_table(bsids, version, workers=1):
+    '''
+        Loads the session metrics of each session in bsids. With workers > 1
+        the sessions are loaded concurrently by a pool of threads, since the
+        time is spent waiting on the filesystem. 
+
+        Returns a dataframe with one row for each session in the order of 
+        bsids, and one column for each metric in the order they appear. 
+        Also returns a boolean array of whether each session has a model fit.
+        Sessions without model fits are NaN
+    '''
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            records = list(tqdm(executor.map(load_session_metrics_safe, bsids, 
+                [version]*len(bsids)), total=len(bsids)))
+    else:
+        records = [load_session_metrics_safe(bsid, version) for bsid in tqdm(bsids)]
+
+    available = np.array([record is not None for record in records])
+    columns = []
+    for record in records:
+        if record is not None:
+            columns += [key for key in record if key not in columns]
+    metrics_df = pd.DataFrame.from_records(
+        [record if record is not None else {} for record in records],
+        columns=columns)
+    return metrics_df, available
+
+
+def backfill_session_metrics(version, bsids=None, refit=False):
+    '''
+        Builds the session metrics for each fit in this version that does not
+        have them. Used for versions fit before the metrics were saved
+
+        bsids, list of sessions to build. If None, every session with a fit
+        refit, if True, rebuilds the metrics for sessions that already have them
+    '''
+    fit_directory = pgt.get_directory(version, subdirectory='fits')
+    metrics_directory = pgt.get_directory(version, subdirectory='metrics')
+    if bsids is None:
+        bsids = sorted(set([int(f[:-4]) for f in os.listdir(fit_directory) \
+            if f.endswith('.npz') or f.endswith('.pkl')]))
+
+    num_built = 0
+    num_crashed = 0
+    for bsid in tqdm(bsids):
+        if (not refit) and os.path.isfile(metrics_directory+str(bsid)+'.json'):
+            continue
+        try:
+            build_session_metrics(bsid, version)
+            num_built +=1
+        except Exception as e:
+            print('{} crashed: {}'.format(bsid, e))
+            num_crashed +=1
+    print('Built metrics for {} sessions, {} crashed'.format(num_built,
+        num_crashed))
+
+
 def annotate_stimulus_presentations_np(session,ignore_trial_errors=False):
     '''
         Adds columns to the stimulus_presentation table describing whether 
@@ -334,58 +756,40 @@ def format_session(session,format_options):
     df = df.rename(columns={'is_change':'change'})
 
     # Process behavior annotations
-    df['y'] = np.array([2 if x else 1 for x in 
-        session.stimulus_presentations_np.bout_start.values])
+    df['y'] = np.where(
+        session.stimulus_presentations_np.bout_start.values.astype(bool),2,1)
     df['images_since_last_lick'] = session.stimulus_presentations_np.groupby(\
         session.stimulus_presentations_np['bout_end'].cumsum()).cumcount(ascending=True)
-    df['timing_input'] = [x+1 for x in df['images_since_last_lick'].shift(fill_value=0)]
+    df['timing_input'] = df['images_since_last_lick'].shift(fill_value=0)+1
     df['included'] = ~df['in_lick_bout']
 
     # Build Strategy regressors
-    df['task0']      = np.array([1 if x else 0 for x in df['change']])
-    df['task1']      = np.array([1 if x else -1 for x in df['change']])
+    change = df['change'].values.astype(bool)
+    df['task0']      = np.where(change,1,0)
+    df['task1']      = np.where(change,1,-1)
     df['late_task0'] = df['task0'].shift(1,fill_value=0)
     df['late_task1'] = df['task1'].shift(1,fill_value=-1)
-    df['taskCR']     = np.array([0 if x else -1 for x in df['change']])
-    df['omissions']  = np.array([1 if x else 0 for x in df['omitted']])
-    df['omissions1'] = np.array([x for x in np.concatenate([[0], 
-                        df['omissions'].values[0:-1]])])
+    df['taskCR']     = np.where(change,0,-1)
+    df['omissions']  = np.where(df['omitted'].values.astype(bool),1,0)
+    df['omissions1'] = np.concatenate([[0], df['omissions'].values[0:-1]])
 
     # Build timing strategy using average timing parameters
-    df['timing1D']          = np.array(\
-        [timing_sigmoid(x,format_options['timing_params']) 
-        for x in df['timing_input']])
+    df['timing1D']          = timing_sigmoid(df['timing_input'].values,
+        format_options['timing_params'])
 
     # Build timing strategy using session timing parameters
-    df['timing1D_session']  = np.array(\
-        [timing_sigmoid(x+1,format_options['timing_params_session']) 
-        for x in df['images_since_last_lick'].shift(fill_value=0)])
+    df['timing1D_session']  = timing_sigmoid(
+        df['images_since_last_lick'].shift(fill_value=0).values+1,
+        format_options['timing_params_session'])
 
     # Build 1-hot timing strategies
     if format_options['timing0/1']:
         min_timing_val = 0
     else:
         min_timing_val = -1
-    df['timing1'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==0])
-    df['timing2'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==1])
-    df['timing3'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==2])
-    df['timing4'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==3])
-    df['timing5'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==4])
-    df['timing6'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==5])
-    df['timing7'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==6])
-    df['timing8'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==7])
-    df['timing9'] =  np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==8])
-    df['timing10'] = np.array([1 if x else min_timing_val 
-        for x in df['images_since_last_lick'].shift() ==9])
+    last_lick = df['images_since_last_lick'].shift().values
+    for k in range(1,11):
+        df['timing'+str(k)] = np.where(last_lick == k-1, 1, min_timing_val)
 
     # Segment out licking bouts
     full_df = copy.copy(df)
@@ -440,18 +844,28 @@ def format_session(session,format_options):
 def timing_sigmoid(x,params,min_val = -1, max_val = 0,tol=1e-3):
     '''
         Evaluates a sigmoid between min_val and max_val with parameters params
+        x can be a scalar or an array, NaN values are treated as 0
+
+        The power is evaluated once for each unique value of x with the scalar
+        power, because numpy's vectorized power can differ in the last bit. 
+        x is usually the number of images since the last lick, which has few 
+        unique values
     '''
-    if np.isnan(x):
-        x = 0 
-    y = min_val+(max_val-min_val)/(1+(x/params[1])**params[0])
-    if (y -min_val) < tol:
-        y = min_val
-    if (max_val - y) < tol:
-        y = max_val
+    x = np.asarray(x, dtype=float)
+    x = np.where(np.isnan(x), 0, x)
+    values, inverse = np.unique(x, return_inverse=True)
+    with np.errstate(divide='ignore'):
+        power = np.array([np.float64(v/params[1])**params[0] for v in values])
+    y = min_val+(max_val-min_val)/(1+power[inverse].reshape(x.shape))
+    y = np.where((y - min_val) < tol, min_val, y)
+    y = np.where((max_val - y) < tol, max_val, y)
+    if y.ndim == 0:
+        return y.item()
     return y
    
 
-def fit_weights(psydata, strategies, fit_overnight=False):
+def fit_weights(psydata, strategies, fit_overnight=False, hyper=None,
+    backend='psytrack'):
     '''
         does weight and hyper-parameter optimization on the data in psydata
         Args: 
@@ -461,12 +875,19 @@ def fit_weights(psydata, strategies, fit_overnight=False):
                 ('random','timing', 'task', etc) each value has a 2D array of 
                 shape (N,M), where N is number of imagees, and M is 1 unless 
                 you want to look at history/image interaction terms
+            hyper, the initial hyperparameters. If None, starts from the 
+                default initial values. Used to warm start the optimization
+                from a previous fit, see get_warm_start_hyper
+            backend, the fitting backend, see hyper_opt
 
         RETURNS:
         hyp
         evd
         wMode
         hess
+        credibleInt
+        weights
+        counts, the number of optimizer evaluations, see hyper_opt
     '''
     # Set up number of regressors
     weights = {}
@@ -476,9 +897,14 @@ def fit_weights(psydata, strategies, fit_overnight=False):
     K = np.sum([weights[i] for i in weights.keys()])
 
     # Set up initial hyperparameters
-    hyper = {'sigInit': 2**4.,
-            'sigma':[2**-4.]*K,
-            'sigDay': 2**4}
+    if hyper is None:
+        hyper = {'sigInit': 2**4.,
+                'sigma':[2**-4.]*K,
+                'sigDay': 2**4}
+    else:
+        hyper = copy.deepcopy(hyper)
+        if len(hyper['sigma']) != K:
+            raise Exception('Initial hyperparameters do not match strategies')
 
     # Only used if we are fitting multiple sessions
     # where we have a different prior
@@ -488,10 +914,100 @@ def fit_weights(psydata, strategies, fit_overnight=False):
         optList=['sigma']
     
     # Do the fit
-    hyp,evd,wMode,hess =psy.hyperOpt(psydata,hyper,weights, optList)
+    hyp,evd,wMode,hess,counts = hyper_opt(psydata,hyper,weights,optList,
+        backend=backend)
     credibleInt = hess['W_std']
     
-    return hyp, evd, wMode, hess, credibleInt, weights
+    return hyp, evd, wMode, hess, credibleInt, weights, counts
+
+
+def hyper_opt(psydata, hyper, weights, optList, backend='psytrack', 
+    hess_calc='weights'):
+    '''
+        Optimizes the hyperparameters and weights with one of two backends, 
+        which have the same inputs and outputs
+
+        backend, 'psytrack' uses psy.hyperOpt. 'banded' uses 
+            psy_banded_tools.hyper_opt, which uses banded solves of the
+            posterior, and analytic gradients of the evidence, so it is 
+            faster and scales linearly with the number of images
+
+        Returns hyp, evd, wMode, hess, and a dictionary of the number of MAP 
+            estimates (num_map_evaluations), and evaluations of the 
+            approximate evidence (num_evidence_evaluations). See 
+            counted_hyper_opt
+    '''
+    if backend == 'psytrack':
+        hyp,evd,wMode,hess,counts = counted_hyper_opt(psydata,hyper,weights,
+            optList,hess_calc=hess_calc)
+    elif backend == 'banded':
+        import licking_behavior_NP.psy_banded_tools as pbt
+        counts = {}
+        hyp,evd,wMode,hess = pbt.hyper_opt(psydata,hyper,weights,optList,
+            hess_calc=hess_calc,counts=counts)
+    else:
+        raise Exception('Unknown fit backend: '+str(backend))
+    return hyp, evd, wMode, hess, counts
+
+
+def counted_hyper_opt(psydata, hyper, weights, optList, hess_calc='weights'):
+    '''
+        Runs psy.hyperOpt, and counts its evaluations. The code of psy.hyperOpt
+        is run with its own copy of the globals of psytrack.hyperOpt, in which 
+        getMAP and hyperOpt_lossfun are wrapped with counters. psytrack itself
+        is not changed, so other fits in this process are not counted.
+
+        Returns hyp, evd, wMode, hess from psy.hyperOpt, and a dictionary of
+            num_map_evaluations, the number of MAP weight estimates, one per 
+                iteration of the outer loop of psy.hyperOpt
+            num_evidence_evaluations, the number of evaluations of the 
+                approximate evidence made by the inner BFGS optimization. 
+                Evaluations for the numerical Hessian of the hyperparameters 
+                (hess_calc 'hyper' or 'All') are not counted
+    '''
+    module = importlib.import_module('psytrack.hyperOpt')
+    counts = {'num_map_evaluations':0,'num_evidence_evaluations':0}
+    counting = [True]
+
+    def counted_getMAP(*args, **kwargs):
+        counts['num_map_evaluations'] += 1
+        return module.getMAP(*args, **kwargs)
+
+    def counted_lossfun(*args, **kwargs):
+        if counting[0]:
+            counts['num_evidence_evaluations'] += 1
+        return module.hyperOpt_lossfun(*args, **kwargs)
+
+    def uncounted_compHess(*args, **kwargs):
+        counting[0] = False
+        return module.compHess(*args, **kwargs)
+
+    namespace = dict(module.__dict__)
+    namespace.update({'getMAP':counted_getMAP, 
+        'hyperOpt_lossfun':counted_lossfun, 'compHess':uncounted_compHess})
+    hyperOpt = types.FunctionType(module.hyperOpt.__code__, namespace,
+        module.hyperOpt.__name__, module.hyperOpt.__defaults__, 
+        module.hyperOpt.__closure__)
+    hyp,evd,wMode,hess = hyperOpt(psydata,hyper,weights,optList,
+        hess_calc=hess_calc)
+    return hyp, evd, wMode, hess, counts
+
+
+def get_warm_start_hyper(hyp, weights, strategy=None):
+    '''
+        Returns initial hyperparameters for a refit, seeded from the converged
+        hyperparameters of a previous fit. 
+
+        hyp, weights, the hyperparameters and weights of the previous fit
+        strategy, if not None, the strategy that is removed in the refit. 
+            The smoothing prior of that strategy is dropped from sigma
+    '''
+    hyper = copy.deepcopy(hyp)
+    sigma = np.atleast_1d(np.array(hyper['sigma'],dtype=float))
+    if strategy is not None:
+        sigma = np.delete(sigma, get_weights_list(weights).index(strategy))
+    hyper['sigma'] = sigma
+    return hyper
 
 
 def compute_ypred(psydata, wMode, weights):
@@ -502,6 +1018,7 @@ def compute_ypred(psydata, wMode, weights):
         pR_each, the contribution of licking from each weight. These contributions 
             interact nonlinearly, so this is an approximation. 
     '''
+    import psytrack as psy
     g = psy.read_input(psydata, weights)
     gw = g*wMode.T
     total_gw = np.sum(gw,axis=1)
@@ -550,6 +1067,8 @@ def plot_weights(wMode,weights,psydata,errorbar=None, ypred=None,START=0, END=0,
     if START >= END: raise Exception("START >= END")
 
     # initialize 
+    import matplotlib.pyplot as plt
+    import licking_behavior_NP.psy_style as pstyle
     weights_list = pgt.get_clean_string(get_weights_list(weights))
     my_colors = pstyle.get_colors()
     if 'dayLength' in psydata:
@@ -654,25 +1173,66 @@ def plot_weights(wMode,weights,psydata,errorbar=None, ypred=None,START=0, END=0,
         plt.savefig(filename+"_weights.png")
   
  
-def compute_cross_validation(psydata, hyp, weights,folds=10):
+def compute_cross_validation(psydata, hyp, weights,folds=10,workers=1,
+    backend='psytrack'):
     '''
         Computes Cross Validation for the data given the regressors as 
         defined in hyp and weights
+
+        workers (int), the number of processes used to fit the folds. If 1, the
+            folds are fit serially. Either way the results are returned in
+            fold order, and are identical
+        backend, the fitting backend, see hyper_opt
     '''
-    trainDs, testDs = split_data(psydata,F=folds)
-    test_results = []
-    for k in range(folds):
-        print("\rrunning fold " +str(k),end="") 
-        _,_,wMode_K,_ = psy.hyperOpt(trainDs[k], hyp, weights, ['sigma'],hess_calc=None)
-        logli, gw = xval_loglike(testDs[k], wMode_K, trainDs[k]['missing_trials'], 
-            weights)
-        res = {'logli' : np.sum(logli), 'gw' : gw, 'test_inds' : testDs[k]['test_inds']}
-        test_results += [res]
+    if workers > 1:
+        print('running {} folds across {} workers'.format(folds,workers))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = submit_cross_validation(executor, psydata, hyp, weights, 
+                folds=folds, backend=backend)
+            test_results = [future.result() for future in futures]
+    else:
+        from psytrack.helper.crossValidation import split_data
+        trainDs, testDs = split_data(psydata,F=folds)
+        test_results = []
+        for k in range(folds):
+            print("\rrunning fold " +str(k),end="") 
+            test_results += [fit_cross_validation_fold(trainDs[k], testDs[k], 
+                hyp, weights, backend=backend)]
    
     print("") 
     return test_results
 
 
+def submit_cross_validation(executor, psydata, hyp, weights, folds=10,
+    backend='psytrack'):
+    '''
+        Splits psydata into folds, and submits the fit of each fold to executor
+
+        Returns a list of futures in fold order, each future resolves to the 
+        results of fit_cross_validation_fold
+    '''
+    from psytrack.helper.crossValidation import split_data
+    trainDs, testDs = split_data(psydata,F=folds)
+    futures = [executor.submit(fit_cross_validation_fold, trainDs[k], testDs[k], 
+        hyp, weights, backend=backend) for k in range(folds)]
+    return futures
+
+
+def fit_cross_validation_fold(trainD, testD, hyp, weights, backend='psytrack'):
+    '''
+        Fits the model to the training set of one cross validation fold, and 
+        evaluates the likelihood of the held out test set. The fit is started
+        from hyp, the hyperparameters of the model fit to all the data
+    '''
+    from psytrack.helper.crossValidation import xval_loglike
+    _,_,wMode_K,hess,counts = hyper_opt(trainD, hyp, weights, ['sigma'], 
+        backend=backend, hess_calc=None)
+    logli, gw = xval_loglike(testD, wMode_K, trainD['missing_trials'], weights)
+    res = {'logli' : np.sum(logli), 'gw' : gw, 'test_inds' : testD['test_inds']}
+    res.update(counts)
+    return res
+
+
 def compute_cross_validation_ypred(psydata,test_results,ypred):
     '''
         Computes the predicted outputs from cross validation results by stitching 
@@ -696,32 +1256,154 @@ def compute_cross_validation_ypred(psydata,test_results,ypred):
     return full_pred
  
  
-def dropout_analysis(psydata, strategies,format_options):
+def dropout_analysis(psydata, strategies,format_options,workers=1,
+    checkpoint_dir=None):
     '''
         Computes a dropout analysis for the data in psydata. 
         In general, computes a full set, and then removes each feature one by one. 
 
+        workers (int), the number of processes. If > 1, the fit of each model,
+            and the fit of each cross validation fold of each model, are 
+            scheduled as tasks on a shared pool of workers
+
+        If format_options['warm_start'], each dropout model is started from the
+        hyperparameters of the full model, with the removed strategy dropped
+
+        checkpoint_dir, if not None, each model is saved as it finishes, and 
+            models saved by an earlier run with the same format_options are 
+            loaded instead of refit
+
         Returns a list of models and a list of labels for each dropout
     '''
-    models =dict()
-
-    hyp, evd, wMode, hess, credibleInt,weights = fit_weights(psydata,strategies)
+    import psytrack as psy
     cross_psydata = psy.trim(psydata, 
         END=int(np.floor(len(psydata['y'])/format_options['num_cv_folds'])\
         *format_options['num_cv_folds'])) 
-    cross_results = compute_cross_validation(cross_psydata, hyp, weights,
-        folds=format_options['num_cv_folds'])
-    models['Full'] = (hyp, evd, wMode, hess, credibleInt,weights,cross_results)
+    warm_start = format_options.get('warm_start',False)
+    backend = format_options.get('fit_backend','psytrack')
 
-    # Iterate through strategies and remove them
+    # The full model, and each model with one strategy removed
+    dropouts = {'Full':strategies}
     for s in strategies:
         dropout_strategies = copy.copy(strategies)
         dropout_strategies.remove(s)
-        hyp, evd, wMode, hess, credibleInt,weights = fit_weights(psydata,
-            dropout_strategies)
+        dropouts[s] = dropout_strategies
+
+    # Load models finished by an earlier run
+    models =dict()
+    for m in dropouts:
+        model = load_checkpoint(checkpoint_dir, 'dropout_'+m, format_options)
+        if model is not None:
+            models[m] = model
+
+    if workers > 1:
+        models = dropout_analysis_parallel(psydata, cross_psydata, dropouts,
+            format_options['num_cv_folds'], workers, warm_start=warm_start,
+            backend=backend, models=models, checkpoint_dir=checkpoint_dir,
+            checkpoint_options=format_options)
+        return dict((m, models[m]) for m in dropouts)
+
+    for m in dropouts:
+        if m in models:
+            continue
+        hyper = None
+        if warm_start and (m != 'Full'):
+            hyper = get_warm_start_hyper(models['Full'][0],models['Full'][5],m)
+        hyp, evd, wMode, hess, credibleInt,weights,counts = fit_weights(
+            psydata,dropouts[m],hyper=hyper,backend=backend)
         cross_results = compute_cross_validation(cross_psydata, hyp, weights,
-            folds=format_options['num_cv_folds'])
-        models[s] = (hyp, evd, wMode, hess, credibleInt,weights,cross_results)
+            folds=format_options['num_cv_folds'],backend=backend)
+        models[m] = (hyp, evd, wMode, hess, credibleInt,weights,cross_results,
+            counts)
+        save_checkpoint(checkpoint_dir, 'dropout_'+m, models[m], 
+            format_options)
+
+    return dict((m, models[m]) for m in dropouts)
+
+
+def dropout_analysis_parallel(psydata, cross_psydata, dropouts, folds, workers,
+    warm_start=False, backend='psytrack', models={}, checkpoint_dir=None,
+    checkpoint_options=None):
+    '''
+        Fits each model in dropouts, and its cross validation folds, across a 
+        pool of workers. The cross validation folds of a model are submitted
+        as soon as the fit of that model finishes, so the pool stays busy 
+        across all (model x fold) fits. The fits and the folds are waited on
+        together, so each model is saved as soon as all of its folds finish,
+        while other models are still fitting
+
+        dropouts (dict), model label -> set of strategies for that model
+        warm_start (bool), if True, the dropout models are submitted once the
+            full model finishes, and are started from its hyperparameters
+        backend, the fitting backend, see hyper_opt
+        models (dict), models that are already finished, and are not refit
+        checkpoint_dir, if not None, each model is saved as soon as all of 
+            its folds finish
+        checkpoint_options, the options saved with each model, see 
+            save_checkpoint
+
+        Returns the same models dictionary as dropout_analysis
+    '''
+    models = dict(models)
+    todo = [m for m in dropouts if m not in models]
+    print('Fitting {} models across {} workers'.format(len(todo),workers))
+    fits = {}
+    cv_futures = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        fit_futures = {}
+        fold_futures = {}
+        pending = set()
+        def submit_fit(m, hyper=None):
+            future = executor.submit(fit_weights, psydata, dropouts[m], 
+                hyper=hyper, backend=backend)
+            fit_futures[future] = m
+            pending.add(future)
+
+        def submit_dropouts(full):
+            for d in todo:
+                if d != 'Full':
+                    hyper = None
+                    if warm_start:
+                        hyper = get_warm_start_hyper(full[0], full[5], d)
+                    submit_fit(d, hyper)
+
+        if not warm_start:
+            submit_dropouts(None)
+            if 'Full' in todo:
+                submit_fit('Full')
+        elif 'Full' in todo:
+            submit_fit('Full')
+        else:
+            submit_dropouts(models['Full'])
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+                if future in fit_futures:
+                    # Submit the folds of this model
+                    m = fit_futures[future]
+                    fits[m] = future.result()
+                    hyp = fits[m][0]
+                    weights = fits[m][5]
+                    cv_futures[m] = submit_cross_validation(executor, 
+                        cross_psydata, hyp, weights, folds=folds, 
+                        backend=backend)
+                    for f in cv_futures[m]:
+                        fold_futures[f] = m
+                        pending.add(f)
+                    if warm_start and (m == 'Full'):
+                        submit_dropouts(fits[m])
+                else:
+                    # Save this model as soon as all of its folds finish
+                    m = fold_futures[future]
+                    if (m not in models) and \
+                        all(f.done() for f in cv_futures[m]):
+                        cross_results = [f.result() for f in cv_futures[m]]
+                        models[m] = (*fits[m][0:6], cross_results, 
+                            fits[m][6])
+                        save_checkpoint(checkpoint_dir, 'dropout_'+m, models[m],
+                            checkpoint_options)
 
     return models
 
@@ -743,7 +1425,9 @@ def compute_model_roc(fit,plot_this=False,cross_validation=True):
         data = copy.copy(fit['psydata']['y']-1)
         model = copy.copy(fit['ypred'])
 
+    from sklearn import metrics
     if plot_this:
+        import matplotlib.pyplot as plt
         plt.figure()
         alarms,hits,thresholds = metrics.roc_curve(data,model)
         plt.plot(alarms,hits,'ko-')
@@ -752,10 +1436,41 @@ def compute_model_roc(fit,plot_this=False,cross_validation=True):
         plt.xlabel('False Alarms')
     return metrics.roc_auc_score(data,model)
 
-def load_fit(bsid, version=None):
+def save_fit(fit, bsid, version):
+    '''
+        Saves the fit dictionary as a fit store, where each field can be 
+        loaded on its own, see psy_storage_tools
+    '''
+    directory = pgt.get_directory(version,subdirectory='fits')
+    pst.save_store(directory + str(bsid) + ".npz", fit)
+
+
+def load_fit(bsid, version=None, fields=None):
     '''
         Loads the fit for session bsid, in directory
         Creates a dictionary for the session
+
+        fields, a list of the fields to load, for example ['hyp','models/*/1'].
+            If None, loads the whole fit. Only the requested fields are read
+            from a fit store. See psy_storage_tools.load_store
+
+        Reads fit stores (.npz), and legacy pickles (.pkl)
+    '''
+    directory = pgt.get_directory(version,subdirectory='fits')
+    filename = directory + str(bsid) + ".npz" 
+    if os.path.isfile(filename):
+        fit = pst.load_store(filename, fields=fields)
+    else:
+        fit = load_legacy_fit(bsid, version)
+        if fields is not None:
+            fit = pst.select_fields(fit, fields)
+    fit['bsid'] = bsid
+    return fit
+
+
+def load_legacy_fit(bsid, version=None):
+    '''
+        Loads the fit for session bsid from a pickle
     '''
     directory = pgt.get_directory(version,subdirectory='fits')
     filename = directory + str(bsid) + ".pkl" 
@@ -767,26 +1482,103 @@ def load_fit(bsid, version=None):
         fit = dict((x,y) for x,y in zip(labels, output))
     else:
         fit = output
-    fit['bsid'] = bsid
     return fit
 
 
-def load_session_strategy_df(bsid, version, TRAIN=False):
+def convert_fits(version, remove_pickles=False):
+    '''
+        Converts every legacy pickle fit for this version into a fit store
+
+        remove_pickles, if True, removes each pickle once it is converted
+    '''
+    directory = pgt.get_directory(version,subdirectory='fits')
+    pickles = sorted([f for f in os.listdir(directory) if f.endswith('.pkl')])
+    for f in tqdm(pickles):
+        bsid = int(f[:-4])
+        fit = load_legacy_fit(bsid, version)
+        save_fit(fit, bsid, version)
+        if remove_pickles:
+            os.remove(directory+f)
+
+
+def compare_fit_storage(version, fields=['hyp','evd','models/*/1']):
+    '''
+        Compares the size and load time of the legacy pickles and fit stores 
+        for every session in this version that has both. 
+
+        fields, the fields used to time a partial load
+
+        Returns a dataframe with one row per session, and prints the totals
+    '''
+    directory = pgt.get_directory(version,subdirectory='fits')
+    bsids = sorted([int(f[:-4]) for f in os.listdir(directory) \
+        if f.endswith('.pkl') and os.path.isfile(directory+f[:-4]+'.npz')])
+    rows = []
+    for bsid in tqdm(bsids):
+        row = {'behavior_session_id':bsid}
+        row['pkl_bytes'] = os.path.getsize(directory+str(bsid)+'.pkl')
+        row['npz_bytes'] = os.path.getsize(directory+str(bsid)+'.npz')
+        row['npz_fields_bytes'] = pst.get_store_size(
+            directory+str(bsid)+'.npz', fields=fields)
+
+        start = time.perf_counter()
+        load_legacy_fit(bsid, version)
+        row['pkl_load_time'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pst.load_store(directory+str(bsid)+'.npz')
+        row['npz_load_time'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pst.load_store(directory+str(bsid)+'.npz', fields=fields)
+        row['npz_fields_load_time'] = time.perf_counter() - start
+        rows.append(row)
+    df = pd.DataFrame.from_records(rows)
+    if len(df) == 0:
+        print('No sessions with both a pickle and a fit store')
+        return df
+
+    totals = df.sum()
+    print('Sessions: {}'.format(len(df)))
+    print('Size: {:.1f} MB pickles, {:.1f} MB fit stores, {:.1f}x smaller'.format(
+        totals['pkl_bytes']/1e6, totals['npz_bytes']/1e6, 
+        totals['pkl_bytes']/totals['npz_bytes']))
+    print('Full load: {:.2f}s pickles, {:.2f}s fit stores'.format(
+        totals['pkl_load_time'], totals['npz_load_time']))
+    print('Load {}: {:.2f}s, {:.1f}x faster than pickles, reads {:.2f} MB'\
+        .format(fields, totals['npz_fields_load_time'], 
+        totals['pkl_load_time']/totals['npz_fields_load_time'],
+        totals['npz_fields_bytes']/1e6))
+    return df
+
+
+def load_session_strategy_df(bsid, version, TRAIN=False, columns=None):
+    '''
+        Loads the strategy_df of this session, see pgt.load_session_table
+
+        columns (list), the columns to load. If None, loads every column
+    '''
     if TRAIN:
         raise Exception('need to implement')
     else:
-        return pd.read_csv(pgt.get_directory(version, subdirectory='strategy_df')+\
-            str(bsid)+'.csv') 
+        return pgt.load_session_table(bsid, version, 'strategy_df', 
+            columns=columns)
 
 
-def load_session_licks_df(bsid, version):
-    licks=pd.read_csv(pgt.get_directory(version,subdirectory='licks_df')+\
-        str(bsid)+'.csv')
+def load_session_licks_df(bsid, version, columns=None):
+    '''
+        Loads the licks_df of this session, see pgt.load_session_table
+
+        columns (list), the columns to load. If None, loads every column
+    '''
+    licks = pgt.load_session_table(bsid, version, 'licks_df', columns=columns)
     licks['behavior_session_id'] = bsid
     return licks
 
 
 def summarize_fit(fit, version=None, savefig=False):
+    import matplotlib.pyplot as plt
+    import licking_behavior_NP.psy_style as pstyle
     directory = pgt.get_directory(version)
 
     fig,ax = plt.subplots(nrows=2,ncols=2, figsize=(10,7))
@@ -970,6 +1762,31 @@ def get_cross_validation_dropout(cv_results):
     return np.sum([i['logli'] for i in cv_results]) 
 
 
+def get_optimizer_evaluations(fit):
+    '''
+        Counts the optimizer evaluations used to fit this session, summed
+        across the initial fit, the cross validation folds, and each dropout 
+        model with its cross validation folds. Used to compare fits with and 
+        without warm starts. 
+
+        Returns a dictionary with num_map_evaluations, and 
+        num_evidence_evaluations. Returns NaN for fits that were saved before
+        the evaluations were recorded. Fits saved before the evaluations were
+        returned separately from hess have them in hess
+    '''
+    keys = ['num_map_evaluations','num_evidence_evaluations']
+    results = [fit.get('optimizer_evaluations',fit['hess'])] + \
+        fit['cross_results']
+    if 'models' in fit:
+        for m in fit['models']:
+            model = fit['models'][m]
+            results += [model[7] if len(model) > 7 else model[3]] + model[6]
+    counts = {}
+    for key in keys:
+        counts[key] = np.sum([r.get(key,np.nan) for r in results])
+    return counts
+
+
 def get_session_dropout(fit, cross_validation=False):
     '''
         Compute the dropout scores for each strategy in this fit
@@ -978,7 +1795,7 @@ def get_session_dropout(fit, cross_validation=False):
 
 
         For each strategy fit['models'][<strategy>] is a tuple
-        (hyp, evd, wMode, hess, credibleInt,weights,cross_results), 
+        (hyp, evd, wMode, hess, credibleInt,weights,cross_results,counts), 
         so we either compare evd or cross_results
 
         Returns a dictionary of strategies. 
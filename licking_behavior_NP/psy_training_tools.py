@@ -1,18 +1,11 @@
 import os
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
-import matplotlib.pyplot as plt
 
 import licking_behavior_NP.psy_tools as ps
-import licking_behavior_NP.psy_style as pstyle
 import licking_behavior_NP.psy_output_tools as po
 import licking_behavior_NP.psy_general_tools as pgt
 
-from allensdk.brain_observatory.behavior.behavior_project_cache import \
-    VisualBehaviorOphysProjectCache
-plt.ion()
-
 BEHAVIOR_VERSION = 21
 TRAINING_VERSION = 22
 
@@ -49,6 +42,8 @@ def get_training_manifest(non_ophys=True,include_non_flashed=False):
         non_ophys, if True (default) removes ophys sessions 
     '''
     cache_dir = r'//allen/programs/braintv/workgroups/nc-ophys/visual_behavior/platform_paper_cache'
+    from allensdk.brain_observatory.behavior.behavior_project_cache import \
+        VisualBehaviorOphysProjectCache
     cache = VisualBehaviorOphysProjectCache.from_s3_cache(cache_dir=cache_dir)
     training = cache.get_behavior_session_table()  
 
@@ -102,14 +97,12 @@ def get_training_inventory(version=None):
     manifest = get_training_manifest()
 
     # Check what is actually available. 
-    fit_directory=pgt.get_directory(version,subdirectory='fits')
-    df_directory=pgt.get_directory(version,subdirectory='strategy_df') 
     for index, row in manifest.iterrows():
-        fit_filename = fit_directory + str(row.behavior_session_id) + ".pkl"         
-        manifest.at[index, 'behavior_fit_available'] = os.path.exists(fit_filename)
-
-        summary_filename = df_directory+ str(row.behavior_session_id)+'.csv'
-        manifest.at[index, 'strategy_df_available'] = os.path.exists(summary_filename)
+        manifest.at[index, 'behavior_fit_available'] = \
+            pgt.fit_exists(row.behavior_session_id, version)
+        manifest.at[index, 'strategy_df_available'] = \
+            pgt.get_session_table_filename(row.behavior_session_id, version,
+            'strategy_df') is not None
 
     # Summarize inventory for this model version
     inventory = {}    
@@ -136,21 +129,23 @@ def get_training_inventory(version=None):
 
 def get_training_summary_table(version):
     model_dir = pgt.get_directory(version,subdirectory='summary')
-    return pd.read_pickle(model_dir+'_training_summary_table.pkl')
+    return po.load_summary_table(model_dir+'_training_summary_table.pkl',
+        po.get_time_aligned_directory(version, 'training_summary_table'))
 
 
-def build_training_summary_table(version):
+def build_training_summary_table(version, workers=1):
     ''' 
         Saves out the training table as a csv file 
     '''
     # Build core table
     print('Building training summary table')
     print('Loading model fits')
-    training_summary = build_core_training_table(version)
+    training_summary = build_core_training_table(version, workers=workers)
     training_summary = po.build_strategy_labels(training_summary)
 
     print('Loading image by image information')
-    training_summary = add_time_aligned_training_info(training_summary, version)
+    training_summary, crashed = add_time_aligned_training_info(
+        training_summary, version)
 
     print('Adding engagement information')
     training_summary = add_training_engagement_metrics(training_summary)
@@ -160,47 +155,21 @@ def build_training_summary_table(version):
 
     print('Saving')
     model_dir = pgt.get_directory(version,subdirectory='summary') 
-    training_summary.to_pickle(model_dir+'_training_summary_table.pkl')
+    po.save_summary_table(training_summary, 
+        model_dir+'_training_summary_table.pkl',
+        po.get_time_aligned_directory(version, 'training_summary_table'))
 
     return training_summary
 
 
-def build_core_training_table(version):
+def build_core_training_table(version, workers=1):
     df = get_training_manifest()
 
-    df['behavior_fit_available'] = df['ophys'] # copying size
-    for index, row in tqdm(df.iterrows(), total=df.shape[0]):
-        try:
-            fit = ps.load_fit(row.behavior_session_id, version=version)
-        except:
-            df.at[index,'behavior_fit_available'] = False
-        else:
-            df.at[index,'behavior_fit_available'] = True
-            df.at[index,'session_roc'] = ps.compute_model_roc(fit)
-            df.at[index,'num_trial_false_alarm'] = \
-                np.sum(fit['psydata']['full_df']['false_alarm'])
-            df.at[index,'num_trial_correct_reject'] = \
-                np.sum(fit['psydata']['full_df']['correct_reject'])
-
-            # Get Strategy indices
-            model_dex, taskdex,timingdex = ps.get_timing_index_fit(fit) 
-            df.at[index,'strategy_dropout_index'] = model_dex
-            df.at[index,'visual_only_dropout_index'] = taskdex
-            df.at[index,'timing_only_dropout_index'] = timingdex
-
-            # For each strategy add the hyperparameter, dropout score, and average weight
-            dropout_dict_cv = ps.get_session_dropout(fit,cross_validation=True)
-            dropout_dict_ev = ps.get_session_dropout(fit,cross_validation=False)
-            sigma = fit['hyp']['sigma']
-            wMode = fit['wMode']
-            weights = ps.get_weights_list(fit['weights'])
-            for dex, weight in enumerate(weights):
-                df.at[index, 'prior_'+weight] =sigma[dex]
-            for dex, weight in enumerate(weights):
-                df.at[index, 'dropout_cv_'+weight] = dropout_dict_cv[weight]
-                df.at[index, 'dropout_'+weight] = dropout_dict_ev[weight]
-            for dex, weight in enumerate(weights):
-                df.at[index, 'avg_weight_'+weight] = np.mean(wMode[dex,:])
+    metrics_df, available = ps.load_session_metrics_table(
+        df['behavior_session_id'].values, version, workers=workers)
+    df['behavior_fit_available'] = available
+    metrics_df.index = df.index
+    df = pd.concat([df, metrics_df], axis=1)
 
     # Return only for sessions with fits
     print(str(len(df.query('not behavior_fit_available')))+\
@@ -215,126 +184,23 @@ def build_core_training_table(version):
 
 
 def add_time_aligned_training_info(summary_df, version):
-    
-    # Initializing empty columns
-    weight_columns = pgt.get_strategy_list(version)
-    columns = {'hit','miss','image_false_alarm','image_correct_reject',
-        'is_change', 'omitted', 'lick_bout_rate','reward_rate','RT','engaged',
-        'lick_bout_start','image_index'} 
-    for column in weight_columns:
-        summary_df['weight_'+column] = [[]]*len(summary_df)
-    for column in columns:
-        summary_df[column] = [[]]*len(summary_df)      
-    summary_df['strategy_weight_index_by_image'] = [[]]*len(summary_df)
-    summary_df['lick_hit_fraction_rate'] = [[]]*len(summary_df)
-
-    crash = 0
-    for index, row in tqdm(summary_df.iterrows(),total=summary_df.shape[0]):
-        try:
-            strategy_dir = pgt.get_directory(version, subdirectory='strategy_df')
-            session_df = pd.read_csv(strategy_dir+str(row.behavior_session_id)+'.csv')
-        except Exception as e:
-            crash +=1
-            print(e)
-            for column in weight_columns:
-                summary_df.at[index, 'weight_'+column] = np.array([np.nan]*4800)
-            for column in columns:
-                summary_df.at[index, column] = np.array([np.nan]*4800) 
-            summary_df.at[index, column] = np.array([np.nan]*4800)
-        else: 
-            # Add session level metrics
-            summary_df.at[index,'num_hits'] = session_df['hit'].sum()
-            summary_df.at[index,'num_miss'] = session_df['miss'].sum()
-            summary_df.at[index,'num_omission_licks'] = \
-                np.sum(session_df['omitted'] & session_df['lick_bout_start']) 
-            summary_df.at[index,'num_post_omission_licks'] = \
-                np.sum(session_df['omitted'].shift(1,fill_value=False) & \
-                session_df['lick_bout_start'])
-            summary_df.at[index,'num_late_task_licks'] = \
-                np.sum(session_df['is_change'].shift(1,fill_value=False) & \
-                session_df['lick_bout_start'])
-            summary_df.at[index,'num_changes'] = session_df['is_change'].sum()
-            summary_df.at[index,'num_omissions'] = session_df['omitted'].sum()
-            summary_df.at[index,'num_image_false_alarm'] = \
-                session_df['image_false_alarm'].sum()
-            summary_df.at[index,'num_image_correct_reject'] = \
-                session_df['image_correct_reject'].sum()
-            summary_df.at[index,'num_lick_bouts'] = session_df['lick_bout_start'].sum()
-            summary_df.at[index,'lick_fraction'] = session_df['lick_bout_start'].mean()
-            summary_df.at[index,'omission_lick_fraction'] = \
-                summary_df.at[index,'num_omission_licks']/\
-                summary_df.at[index,'num_omissions'] 
-            summary_df.at[index,'post_omission_lick_fraction'] = \
-                summary_df.at[index,'num_post_omission_licks']/\
-                summary_df.at[index,'num_omissions'] 
-            summary_df.at[index,'lick_hit_fraction'] = \
-                session_df['rewarded'].sum()/session_df['lick_bout_start'].sum() 
-            summary_df.at[index,'trial_hit_fraction'] = \
-                session_df['rewarded'].sum()/session_df['is_change'].sum() 
-
-            # Add time aligned information
-            for column in weight_columns:
-                summary_df.at[index, 'weight_'+column] = \
-                    pgt.get_clean_rate(session_df[column].values)
-            for column in columns:
-                summary_df.at[index, column] = \
-                    pgt.get_clean_rate(session_df[column].values)
-            summary_df.at[index,'lick_hit_fraction_rate'] = \
-                pgt.get_clean_rate(session_df['lick_hit_fraction'].values)
-
-            # Compute strategy indexes
-            summary_df.at[index,'strategy_weight_index_by_image'] = \
-                pgt.get_clean_rate(session_df['task0'].values) - \
-                pgt.get_clean_rate(session_df['timing1D'].values) 
-            summary_df.at[index,'strategy_weight_index'] = \
-                np.nanmean(summary_df.at[index,'strategy_weight_index_by_image'])
-
-    if crash > 0:
-        print(str(crash) + ' sessions crashed')
-    return summary_df 
+    '''
+        Adds the image by image information of each training session, see
+        po.add_time_aligned_session_info
+    '''
+    return po.add_time_aligned_session_info(summary_df, version,
+        table='training_summary_table', image_column='image_index')
 
 
 def add_training_engagement_metrics(summary_df,min_engaged_fraction=0.05):
 
-    # Add Engaged specific metrics
-    summary_df['fraction_engaged'] = \
-        [np.nanmean(summary_df.loc[x]['engaged']) for x in summary_df.index.values]
-
     # Add average value of strategy weights split by engagement stats
     columns = {
         'task0':'visual',
         'timing1D':'timing',
         'bias':'bias'}
-    for k in columns.keys():  
-        summary_df[columns[k]+'_weight_index_engaged'] = \
-        [np.nanmean(summary_df.loc[x]['weight_'+k][summary_df.loc[x]['engaged'] == True]) 
-            if summary_df.loc[x]['fraction_engaged'] > min_engaged_fraction else np.nan 
-            for x in summary_df.index.values]
-        summary_df[columns[k]+'_weight_index_disengaged'] = \
-        [np.nanmean(summary_df.loc[x]['weight_'+k][summary_df.loc[x]['engaged'] == False])
-            if summary_df.loc[x]['fraction_engaged'] < 1-min_engaged_fraction else np.nan 
-            for x in summary_df.index.values]
-    summary_df['strategy_weight_index_engaged'] = \
-        summary_df['visual_weight_index_engaged'] -\
-        summary_df['timing_weight_index_engaged']
-    summary_df['strategy_weight_index_disengaged'] = \
-        summary_df['visual_weight_index_disengaged'] -\
-        summary_df['timing_weight_index_disengaged']
-
-    # Add average value of columns split by engagement state
-    columns = {'lick_bout_rate','reward_rate','lick_hit_fraction_rate','hit',
-        'miss','image_false_alarm','image_correct_reject','RT'}
-    for column in columns: 
-        summary_df[column+'_engaged'] = \
-        [np.nanmean(summary_df.loc[x][column][summary_df.loc[x]['engaged'] == True]) 
-            if summary_df.loc[x]['fraction_engaged'] > min_engaged_fraction else np.nan
-            for x in summary_df.index.values]
-        summary_df[column+'_disengaged'] = \
-        [np.nanmean(summary_df.loc[x][column][summary_df.loc[x]['engaged'] == False]) 
-            if (summary_df.loc[x]['fraction_engaged'] < 1-min_engaged_fraction) &
-            (not np.all(np.isnan(summary_df.loc[x][column][summary_df.loc[x]['engaged']==False]))) 
-            else np.nan for x in summary_df.index.values]
-    return summary_df
+    return po.add_engagement_split_metrics(summary_df, columns, 
+        min_engaged_fraction)
 
 
 def add_mouse_strategy(df):
@@ -444,6 +310,7 @@ def training_add_rewards_each_image(stimulus_presentations,rewards):#TODO, Issue
 ################################################################################
 
 def plot_average_by_stage_inner(group,color='k',label=None,skip=[],alpha=.2):
+    import matplotlib.pyplot as plt
     group['std_err'] = group['std']/np.sqrt(group['count'])
     for index, row in group.iterrows():
         if (index not in skip) & (index[1:] not in skip):
@@ -498,6 +365,8 @@ def plot_average_by_stage(full_table,metric='strategy_dropout_index',
             'Novel 1':10,
             'Novel +':11
             }
+    import matplotlib.pyplot as plt
+    import licking_behavior_NP.psy_style as pstyle
     colors = pstyle.get_colors()
 
     plt.figure(figsize=(4,2.5))
@@ -697,6 +566,8 @@ def plot_average_by_day(full_table,metric='strategy_dropout_index',version=None,
     numbering = 'session_num'
 
     # Build Plot
+    import matplotlib.pyplot as plt
+    import licking_behavior_NP.psy_style as pstyle
     fig, ax = plt.subplots(figsize=(6,3.75))
     plt.axhline(0, color='k',linestyle='--',alpha=0.5)
     plt.axvline(-.5, color='k',linestyle='--',alpha=0.5)
@@ -0,0 +1,31 @@
+import licking_behavior_NP.psy_tools as ps 
+import argparse
+
+parser = argparse.ArgumentParser(description='build session metrics for existing fits')
+parser.add_argument(
+    '--version', 
+    type=str, 
+    default='',
+    metavar='behavior model version',
+    help='model version to use'
+)
+parser.add_argument(
+    '--bsids', 
+    type=int, 
+    nargs='*',
+    default=None,
+    metavar='bsids',
+    help='behavior session ids, defaults to every session with a fit'
+)
+parser.add_argument(
+    '--force-overwrite', 
+    action='store_true',
+    default=False,
+    dest='force_overwrite', 
+    help='Rebuilds metrics that already exist. Otherwise they are skipped'
+)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    ps.backfill_session_metrics(int(args.version), bsids=args.bsids, 
+        refit=args.force_overwrite)
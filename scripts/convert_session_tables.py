@@ -0,0 +1,32 @@
+import licking_behavior_NP.psy_general_tools as pgt
+import argparse
+
+parser = argparse.ArgumentParser(description='convert the csv session tables '+\
+    'of a model version to Parquet')
+parser.add_argument(
+    '--version', 
+    type=str, 
+    default='',
+    metavar='behavior model version',
+    help='model version to use'
+)
+parser.add_argument(
+    '--tables', 
+    type=str, 
+    nargs='*',
+    default=['strategy_df','licks_df','interval_df'],
+    metavar='tables',
+    help='session tables to convert, defaults to all of them'
+)
+parser.add_argument(
+    '--remove-csv', 
+    action='store_true',
+    default=False,
+    dest='remove_csv', 
+    help='Removes each csv once it is converted'
+)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    pgt.convert_session_tables(int(args.version), subdirectories=args.tables,
+        remove_csv=args.remove_csv)
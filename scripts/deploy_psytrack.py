@@ -1,6 +1,7 @@
 import os
 import time
 import argparse
+import numpy as np
 from simple_slurm import Slurm
 import licking_behavior_NP.psy_general_tools as pgt
 
@@ -8,6 +9,15 @@ import licking_behavior_NP.psy_general_tools as pgt
 parser = argparse.ArgumentParser(description='deploy behavior fits to cluster')
 parser.add_argument('--env-path', type=str, default='np', metavar='path to conda environment to use')
 parser.add_argument('--version', type=str, default='0', metavar='model version')
+parser.add_argument('--workers', type=int, default=1, metavar='number of cpus per job')
+parser.add_argument(
+    '--sessions-per-job', 
+    type=int, 
+    default=1, 
+    dest='sessions_per_job',
+    metavar='number of sessions per job',
+    help='If more than 1, packs sessions into jobs that fit them with fit_psytrack_batch.py'
+)
 parser.add_argument(
     '--force-overwrite', 
     action='store_true',
@@ -16,6 +26,57 @@ parser.add_argument(
     help='Overwrites existing fits for this version if enabled. Otherwise only sessions without existing results are fit'
 )
 
+def deploy_batches(args, python_executable, stdout_location, behavior_session_ids):
+    '''
+        Starts one job for every <sessions_per_job> sessions that need fitting. 
+        Each job fits its sessions from one process pool, and keeps a progress
+        record so a job can be resubmitted and resume where it stopped. The
+        progress records are named by the time of this deployment, so each 
+        deployment starts new records, and a refit with --force-overwrite 
+        refits sessions a previous deployment completed
+    '''
+    python_file = "/allen/programs/braintv/workgroups/nc-ophys/alex.piet/NP/licking_behavior_NP/scripts/fit_psytrack_batch.py"
+    progress_directory = pgt.get_directory(args.version, subdirectory='summary')
+    bsids = [bsid for bsid in behavior_session_ids if args.force_overwrite or \
+        (not pgt.fit_exists(bsid, args.version))]
+    print('{} sessions to fit'.format(len(bsids)))
+    deployment = time.strftime('%Y%m%d_%H%M%S')
+
+    job_string = "--bsids {} --version {} --workers {} --progress-file {}"
+    for job_count, start in enumerate(range(0, len(bsids), args.sessions_per_job)):
+        batch = bsids[start:start+args.sessions_per_job]
+        print('starting cluster job for {} sessions, job count = {}'.format(
+            len(batch), job_count+1))
+        job_title = 'batch_{}_beh_v_{}'.format(job_count, args.version)
+        walltime = '{}:00:00'.format(6*int(np.ceil(len(batch)/args.workers)))
+        mem = '{}gb'.format(4*args.workers)
+        output = stdout_location+"/batch_"+str(job_count)+".out"
+        progress_file = progress_directory+\
+            '_process_sessions_progress_{}_{}.json'.format(deployment, job_count)
+
+        # instantiate a SLURM object
+        slurm = Slurm(
+            cpus_per_task=args.workers,
+            job_name=job_title,
+            time=walltime,
+            mem=mem,
+            output= output,
+            partition="braintv"
+        )
+
+        # Start job
+        args_string = job_string.format(' '.join([str(x) for x in batch]), 
+            args.version, args.workers, progress_file)
+        if args.force_overwrite:
+            args_string += ' --force-overwrite'
+        slurm.sbatch('{} {} {}'.format(
+                python_executable,
+                python_file,
+                args_string,
+            )
+        )
+        time.sleep(0.001)
+
 if __name__ == "__main__":
     
     # Determine python version to use
@@ -37,16 +98,19 @@ if __name__ == "__main__":
     behavior_session_ids = manifest.behavior_session_id.values
     print('behavior_session_ids loaded')
 
+    if args.sessions_per_job > 1:
+        deploy_batches(args, python_executable, stdout_location, 
+            behavior_session_ids)
+        exit()
+
     # Iterate through sessions and start jobs if needed
     job_count = 0
-    job_string = "--bsid {} --version {}"
+    job_string = "--bsid {} --version {} --workers {}"
     print('Starting model version '+str(args.version))
     for behavior_session_id in behavior_session_ids:
 
         # Check if fit already exists
-        fit_directory = pgt.get_directory(args.version, subdirectory='fits')
-        fit_filename = fit_directory + str(behavior_session_id)+'.pkl'
-        already_fit = os.path.exists(fit_filename)
+        already_fit = pgt.fit_exists(behavior_session_id, args.version)
 
         if args.force_overwrite or not already_fit:
         
@@ -55,14 +119,14 @@ if __name__ == "__main__":
             print('starting cluster job for {}, job count = {}'.format(behavior_session_id, job_count))
             job_title = 'bsid_{}_beh_v_{}'.format(behavior_session_id, args.version)
             walltime = '6:00:00'
-            mem = '4gb'
+            mem = '{}gb'.format(4*args.workers)
             job_id = Slurm.JOB_ARRAY_ID
             job_array_id = Slurm.JOB_ARRAY_MASTER_ID
             output = stdout_location+"/"+str(job_array_id)+"_"+str(job_id)+"_"+str(behavior_session_id)+".out"
     
             # instantiate a SLURM object
             slurm = Slurm(
-                cpus_per_task=1,
+                cpus_per_task=args.workers,
                 job_name=job_title,
                 time=walltime,
                 mem=mem,
@@ -71,7 +135,8 @@ if __name__ == "__main__":
             )
 
             # Start job
-            args_string = job_string.format(behavior_session_id, args.version)
+            args_string = job_string.format(behavior_session_id, args.version, 
+                args.workers)
             slurm.sbatch('{} {} {}'.format(
                     python_executable,
                     python_file,
@@ -45,9 +45,7 @@ if __name__ == "__main__":
     for behavior_session_id in behavior_session_ids:
 
         # Check if fit already exists
-        fit_directory = pgt.get_directory(args.version, subdirectory='fits')
-        fit_filename = fit_directory + str(behavior_session_id)+'.pkl'
-        already_fit = os.path.exists(fit_filename)
+        already_fit = pgt.fit_exists(behavior_session_id, args.version)
 
         if args.force_overwrite or not already_fit:
         
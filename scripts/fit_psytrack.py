@@ -16,7 +16,14 @@ parser.add_argument(
     metavar='behavior model version',
     help='model version to use'
 )
+parser.add_argument(
+    '--workers', 
+    type=int, 
+    default=1,
+    metavar='workers',
+    help='number of processes used to fit the cross validation folds and dropout models'
+)
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    ps.process_session(args.bsid, version = int(args.version))
+    ps.process_session(args.bsid, version = int(args.version), workers=args.workers)
@@ -0,0 +1,58 @@
+import licking_behavior_NP.psy_tools as ps 
+import licking_behavior_NP.psy_general_tools as pgt
+import argparse
+
+parser = argparse.ArgumentParser(description='fit behavioral model for many sessions')
+parser.add_argument(
+    '--bsids', 
+    type=int, 
+    nargs='*',
+    default=None,
+    metavar='bsids',
+    help='behavior session ids, defaults to every session in the manifest'
+)
+parser.add_argument(
+    '--version', 
+    type=str, 
+    default='',
+    metavar='behavior model version',
+    help='model version to use'
+)
+parser.add_argument(
+    '--workers', 
+    type=int, 
+    default=1,
+    metavar='workers',
+    help='number of processes, each fits one session at a time'
+)
+parser.add_argument(
+    '--progress-file', 
+    type=str, 
+    default=None,
+    dest='progress_file',
+    metavar='progress file',
+    help='json record of the progress of this batch, used to resume the batch'
+)
+parser.add_argument(
+    '--force-overwrite', 
+    action='store_true',
+    default=False,
+    dest='force_overwrite', 
+    help='Refits sessions with existing fits. Otherwise they are skipped'
+)
+parser.add_argument(
+    '--restart', 
+    action='store_true',
+    default=False,
+    dest='restart', 
+    help='Starts a new progress record instead of resuming the batch'
+)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    bsids = args.bsids
+    if not bsids:
+        bsids = pgt.get_np_manifest().behavior_session_id.values
+    ps.process_sessions(bsids, int(args.version), workers=args.workers, 
+        refit=args.force_overwrite, progress_file=args.progress_file,
+        restart=args.restart)